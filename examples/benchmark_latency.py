@@ -0,0 +1,37 @@
+import time
+
+import click
+import requests
+
+import creepy
+
+
+def measure(fn, n):
+    fn()
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+@click.command()
+@click.argument('host', type=str, default='localhost:8000')
+@click.option('-n', '--count', type=int, default=1000, help='Number of queries per measurement.')
+def main(host, count):
+    """
+    Compare latency of queries sent over kept-alive connections with a new connection per query.
+    """
+    with creepy.connect(host, inline_limit=8) as remote:
+        getpid = remote.os.getpid
+        pooled = measure(getpid, count)
+        http, remote._http = remote._http, requests  # module level `requests.post` connects for each query
+        try:
+            unpooled = measure(getpid, count)
+        finally:
+            remote._http = http
+    print(f'kept-alive connection: {pooled * 1e6:.0f} us/query')
+    print(f'connection per query:  {unpooled * 1e6:.0f} us/query')
+
+
+if __name__ == '__main__':
+    main()
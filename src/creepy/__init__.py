@@ -1,3 +1,5 @@
-from .query import connect, unproxy
+from .query import connect, unproxy, prefetch, iterate, sync, download
+from .query.aio import connect_async
+from .query.manager import connections
 from .copy import copy
 from .app import app
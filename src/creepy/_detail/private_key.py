@@ -2,6 +2,7 @@ from typing import Optional
 
 from cryptography.hazmat import backends
 from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
 from cryptography.hazmat.primitives.asymmetric import padding as crypto_padding
 from cryptography.hazmat.primitives.asymmetric import rsa
 
@@ -22,12 +23,17 @@ class _Loader:
 
     def __call__(self):
         with Pypen('private_numbers',
-                   hash='7723c366d84dd7cd818dfbbfacdf3bee0ad44aeb11d54f4e8c68bffbe9da3809') as session:
+                   hash='c5416bdf1919cd04bcefbda737230776d1ccbb836016e690f553763425dcb178') as session:
             session.request('load', self.path, self.passphrase)
-            n, e = session.request('get_public_numbers')
-            d = session.request('get_d')
+            ed25519_private_bytes = session.request('get_ed25519_private_bytes')
+            if ed25519_private_bytes is None:
+                n, e = session.request('get_public_numbers')
+                d = session.request('get_d')
         global _private_key
-        _private_key = _deserialize_private_key(n, e, d)
+        if ed25519_private_bytes is not None:
+            _private_key = ed25519.Ed25519PrivateKey.from_private_bytes(ed25519_private_bytes)
+        else:
+            _private_key = _deserialize_private_key(n, e, d)
 
 
 def _get_private_key():
@@ -68,6 +74,9 @@ def public_bytes(encoding=serialization.Encoding.OpenSSH, format=serialization.P
 def sign(message: bytes,
          padding: Optional[crypto_padding.AsymmetricPadding] = None,
          algorithm: Optional[hashes.HashAlgorithm] = None) -> bytes:
+    private_key = _get_private_key()
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return private_key.sign(message)
     if padding is None:
         padding = crypto_padding.PSS(
             mgf=crypto_padding.MGF1(hashes.SHA256()),
@@ -75,7 +84,7 @@ def sign(message: bytes,
         )
     if algorithm is None:
         algorithm = hashes.SHA256()
-    return _get_private_key().sign(message, padding, algorithm)
+    return private_key.sign(message, padding, algorithm)
 
 
 @app.route('decrypt')
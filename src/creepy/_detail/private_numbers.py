@@ -4,6 +4,7 @@ from typing import Optional
 
 from cryptography.hazmat import backends
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
 
 from creepy.subprocess import App
 from creepy.types import SecureString
@@ -58,6 +59,15 @@ def get_d():
     return private_numbers.d
 
 
+@app.route('get_ed25519_private_bytes')
+def get_ed25519_private_bytes():
+    """Returns raw private bytes of an Ed25519 key or `None` for other keys."""
+    if not isinstance(_private_key, ed25519.Ed25519PrivateKey):
+        return None
+    return _private_key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+                                      serialization.NoEncryption())
+
+
 try:
     mlockall(MCL_FUTURE)
 except Exception:
@@ -0,0 +1,159 @@
+import os
+import socket
+import struct
+import logging
+import threading
+import socketserver
+from typing import Optional
+
+from cryptography.hazmat.primitives import serialization
+
+from .protocol import asymmetric
+
+
+logger = logging.getLogger('creepy')
+
+# Environment variable with the path of the key agent socket.
+AGENT_SOCKET_ENV = 'CREEPY_AUTH_SOCK'
+
+_PUBLIC_BYTES, _SIGN, _DECRYPT = range(3)
+_HEADER = struct.Struct('!BI')
+_MAX_MESSAGE_SIZE = 1 << 16
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _send(sock, tag, payload=b''):
+    sock.sendall(_HEADER.pack(tag, len(payload)) + payload)
+
+
+def _recv(sock):
+    tag, size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    if size > _MAX_MESSAGE_SIZE:
+        raise ValueError('Message is too large')
+    return tag, _recv_exactly(sock, size)
+
+
+class AgentPrivateKey:
+    """
+    Private key held by a key agent.
+
+    It's used like `ProcessifiedPrivateKey`, but signing and decryption always use the paddings of
+    `creepy.protocol.asymmetric` whatever is passed.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._public_key = None
+
+    def public_key(self):
+        if self._public_key is None:
+            self._public_key = serialization.load_ssh_public_key(self._request(_PUBLIC_BYTES))
+        return self._public_key
+
+    def decrypt(self, ciphertext: bytes, padding=None) -> bytes:
+        return self._request(_DECRYPT, ciphertext)
+
+    def sign(self, message: bytes, padding=None, algorithm=None) -> bytes:
+        return self._request(_SIGN, message)
+
+    def _request(self, op, payload=b''):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self._path)
+            _send(sock, op, payload)
+            ok, result = _recv(sock)
+        if not ok:
+            raise RuntimeError(f'Key agent: {result.decode()}')
+        return result
+
+
+def load_agent_key(path: Optional[str] = None) -> Optional[AgentPrivateKey]:
+    """
+    Get the private key of the key agent listening on `path` or on the socket from `CREEPY_AUTH_SOCK` environment
+    variable, return None if there is no agent.
+    """
+    if path is None:
+        path = os.environ.get(AGENT_SOCKET_ENV)
+        if not path:
+            return None
+    key = AgentPrivateKey(path)
+    try:
+        key.public_key()
+    except (OSError, EOFError) as e:
+        logger.warning(f'Key agent {path} is not available: {e}')
+        return None
+    return key
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        if not _is_same_user(sock):
+            return
+        try:
+            op, payload = _recv(sock)
+        except (EOFError, ValueError):
+            return
+        try:
+            result = self.server.dispatch(op, payload)
+        except Exception as e:
+            logger.debug(f'Key agent: request {op} failed: {e}')
+            _send(sock, False, str(e).encode())
+            return
+        _send(sock, True, result)
+
+
+def _is_same_user(sock):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        # The socket permissions are the only protection.
+        return True
+    creds = struct.Struct('3i')
+    _, uid, _ = creds.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size))
+    return uid == os.getuid()
+
+
+class KeyAgent(socketserver.ThreadingUnixStreamServer):
+    """
+    Serve public key, signing and decryption with `private_key` to processes of the same user over a Unix socket.
+
+    The private key itself never leaves the agent, so a key loaded once is used by many client processes.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, private_key):
+        self.private_key = private_key
+        self._lock = threading.Lock()
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(old_umask)
+
+    def dispatch(self, op, payload):
+        # A processified key talks to its process over a single channel.
+        with self._lock:
+            if op == _PUBLIC_BYTES:
+                return self.private_key.public_key().public_bytes(encoding=serialization.Encoding.OpenSSH,
+                                                                  format=serialization.PublicFormat.OpenSSH)
+            if op == _SIGN:
+                return asymmetric.sign(self.private_key, payload)
+            if op == _DECRYPT:
+                return asymmetric.decrypt(self.private_key, payload)
+        raise ValueError(f'Unknown request {op}')
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
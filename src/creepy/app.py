@@ -1,21 +1,30 @@
 import io
 import os
+import time
 import asyncio
+import logging
 import types
 import secrets
+import contextlib
 
 from starlette.applications import Starlette
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 from starlette.routing import Route
 from starlette.status import (
     HTTP_200_OK,
     HTTP_400_BAD_REQUEST,
-    HTTP_403_FORBIDDEN
+    HTTP_403_FORBIDDEN,
+    HTTP_409_CONFLICT
 )
 
-from .protocol import HandshakeProtocol, Session
-from .protocol.constants import SESSION_ID_SIZE, NONCE_SIZE
-from .query import pickle
+from .protocol import HandshakeProtocol, Session, Scope, compression, framing
+from .protocol.constants import SESSION_ID_SIZE, NONCE_SIZE, NONCE_WINDOW_SIZE, SESSION_LEASE, MAX_SESSIONS, \
+    MAX_SCOPE_OBJECTS, MAX_SCOPE_BYTES, MAX_REQUEST_BYTES, MAX_REPLY_CACHE_BYTES
+from .query import codec, pickle
+from .query.proxy import VersionQuery
+
+
+logger = logging.getLogger('creepy')
 
 
 def make_module():
@@ -28,26 +37,156 @@ def make_module():
     return module
 
 
+def _limit(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
 shared_module = make_module()
 sessions = {}
 handshake = HandshakeProtocol()
+# Limits of sessions, they are set with environment variables of the server.
+session_lease = _limit('CREEPY_SESSION_LEASE', SESSION_LEASE)
+max_sessions = _limit('CREEPY_MAX_SESSIONS', MAX_SESSIONS)
+max_scope_objects = _limit('CREEPY_MAX_SCOPE_OBJECTS', MAX_SCOPE_OBJECTS)
+max_scope_bytes = _limit('CREEPY_MAX_SCOPE_BYTES', MAX_SCOPE_BYTES)
+max_request_bytes = _limit('CREEPY_MAX_REQUEST_BYTES', MAX_REQUEST_BYTES)
+max_reply_cache_bytes = _limit('CREEPY_MAX_REPLY_CACHE_BYTES', MAX_REPLY_CACHE_BYTES)
+# Total size of replies kept by all sessions.
+replies_size = 0
 
 
 def make_response(data=b'', status_code=HTTP_200_OK):
     return Response(data, status_code, media_type='application/octet-stream')
 
 
+def make_sealed_response(size, chunks):
+    """
+    Make a response of a sealed message of `size` bytes, its chunks are encrypted in a thread while it's sent.
+
+    If the size is unknown, the response is sent with chunked transfer encoding.
+    """
+    headers = {'Content-Length': str(size)} if size is not None else None
+    return StreamingResponse(map(memoryview, chunks), HTTP_200_OK, headers=headers,
+                             media_type='application/octet-stream')
+
+
 async def request_raw_body(request):
     body = b''
     async for chunk in request.stream():
         body += chunk
+        if len(body) > max_request_bytes:
+            raise ValueError('Request is too large')
     return body
 
 
+async def request_session_body(request):
+    """
+    Read the body of a request of a session straight into a buffer of its size.
+
+    The buffer is allocated only after the session id at the start of the body is found, and no larger than
+    `max_request_bytes`. Return the session and the body after the session id, or `None, None` if the session is
+    unknown.
+    """
+    size = request.headers.get('content-length')
+    limit = int(size) - SESSION_ID_SIZE if size is not None else max_request_bytes
+    if limit > max_request_bytes:
+        raise ValueError('Request is too large')
+    head = b''
+    body = None
+    async for chunk in request.stream():
+        if body is None:
+            head += chunk
+            if len(head) < SESSION_ID_SIZE:
+                continue
+            session = sessions.get(head[:SESSION_ID_SIZE])
+            if session is None:
+                return None, None
+            body = bytearray(limit if size is not None else 0)
+            pos = 0
+            chunk = head[SESSION_ID_SIZE:]
+        if pos + len(chunk) > limit:
+            raise ValueError('Request is too large')
+        # The slice assignment grows the buffer if the size is unknown.
+        body[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+    if body is None or (size is not None and pos != len(body)):
+        raise ValueError('Request is truncated')
+    return session, body
+
+
 async def handshake_salt(request):
     return make_response(handshake.salt)
 
 
+def server_info():
+    return {'version': VersionQuery()(None), 'compression': compression.names(), 'lease': session_lease}
+
+
+def add_session(session_id, cipher):
+    if len(sessions) >= max_sessions:
+        evict_session()
+    session = Session(cipher, Scope(max_scope_objects, max_scope_bytes))
+    session.scope.put(shared_module)
+    sessions[session_id] = session
+
+
+def evict_session():
+    """
+    Drop the least recently used session to make room for a new one.
+    """
+    session_id = min(sessions, key=lambda session_id: sessions[session_id].last_seen)
+    session = drop_session(session_id)
+    logger.warning(f'Session with {len(session.scope)} objects of about {session.scope.size} bytes is evicted')
+
+
+def drop_session(session_id):
+    global replies_size
+    session = sessions.pop(session_id)
+    replies_size -= session.replies_size
+    return session
+
+
+def remember_reply(session, nonce, reply, size):
+    """
+    Keep the reply of a session, replies of the least recently used sessions are dropped to fit all of them into
+    `max_reply_cache_bytes`.
+    """
+    global replies_size
+    replies_size += session.remember_reply(nonce, reply, size)
+    while replies_size > max_reply_cache_bytes:
+        oldest = min((session for session in sessions.values() if session.replies_size > 0),
+                     key=lambda session: session.last_seen)
+        replies_size -= oldest.forget_replies()
+
+
+def expire_sessions():
+    """
+    Drop sessions which made no requests for `session_lease` seconds, so objects in their scopes are freed.
+    """
+    deadline = time.monotonic() - session_lease
+    expired = [session_id for session_id, session in sessions.items() if session.last_seen < deadline]
+    for session_id in expired:
+        drop_session(session_id)
+    if len(expired) > 0:
+        logger.info(f'{len(expired)} sessions expired')
+
+
+async def _expire_sessions_periodically():
+    while True:
+        await asyncio.sleep(session_lease / 10)
+        expire_sessions()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    task = asyncio.create_task(_expire_sessions_periodically())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
 async def handshake_hi(request):
     try:
         bob = handshake.who_r_u(await request_raw_body(request))
@@ -57,32 +196,91 @@ async def handshake_hi(request):
     session_id = secrets.token_bytes(SESSION_ID_SIZE)
     if session_id in sessions:
         return make_response(b"Sorry Bob, I have enough friends", HTTP_403_FORBIDDEN)
-    cipher, ciphertext = handshake.hi_bob(bob, session_id)
-    session = Session(cipher)
-    session.scope.put(shared_module)
-    sessions[session_id] = session
+    info = server_info() if 'info' in request.query_params else None
+    ciphers = request.query_params.get('ciphers')
+    cipher, ciphertext = handshake.hi_bob(bob, session_id, info, ciphers.split(',') if ciphers is not None else None)
+    add_session(session_id, cipher)
     return make_response(ciphertext)
 
 
+async def handshake_resume(request):
+    session_id = secrets.token_bytes(SESSION_ID_SIZE)
+    if session_id in sessions:
+        return make_response(b"Sorry Bob, I have enough friends", HTTP_403_FORBIDDEN)
+    try:
+        cipher, ciphertext = handshake.resume_bob(await request_raw_body(request), session_id, server_info())
+    except ValueError as e:
+        # Sealed tickets can't be guessed, so clients with stale ones, e.g. after a restart, aren't slowed down.
+        return make_response(str(e), HTTP_400_BAD_REQUEST)
+    add_session(session_id, cipher)
+    return make_response(ciphertext)
+
+
+async def _unseal_request(request, version):
+    """
+    Decrypt the sealed message of a request as its body arrives.
+
+    Return the session, the message, the buffers and the compression codec of the request.
+    """
+    unsealer = None
+    head = b''
+    async for chunk in request.stream():
+        if unsealer is None:
+            head += chunk
+            if len(head) < SESSION_ID_SIZE:
+                continue
+            session = sessions.get(head[:SESSION_ID_SIZE])
+            if session is None:
+                return None, None, None, None
+            unsealer = framing.Unsealer(session.cipher, version, max_header_size=max_request_bytes)
+            chunk = head[SESSION_ID_SIZE:]
+        unsealer.feed(chunk)
+        while len(unsealer.pending) > framing.MAX_PENDING_CHUNKS:
+            await asyncio.wrap_future(unsealer.pending.popleft())
+    if unsealer is None:
+        raise ValueError('Request is truncated')
+    while len(unsealer.pending) > 0:
+        await asyncio.wrap_future(unsealer.pending.popleft())
+    return (session, *unsealer.result(), unsealer.codec)
+
+
+async def _reject_nonce(session, nonce):
+    """
+    Make the response to a request with a nonce which was already used.
+
+    A request retried by the client gets the response it has missed.
+    """
+    reply = session.cached_reply(nonce)
+    if reply is not None:
+        return reply()
+    await asyncio.sleep(1)
+    if session.last_nonce - nonce < NONCE_WINDOW_SIZE:
+        return make_response(b"Response is not cached", HTTP_409_CONFLICT)
+    return make_response(b"Login: admin\nPassword: ytrewq54321")
+
+
 async def _decrypt_request_nothrow(request):
-    body = await request_raw_body(request)
+    framing_version = request.query_params.get('oob')
     try:
-        session_id, ciphertext = body[:SESSION_ID_SIZE], body[SESSION_ID_SIZE:]
-        session = sessions.get(session_id)
+        if framing_version is None:
+            session, body = await request_session_body(request)
+            message, buffers, codec = None, None, None
+            if session is not None:
+                message = session.cipher.decrypt(body)
+        else:
+            session, message, buffers, codec = await _unseal_request(request, int(framing_version))
         if session is None:
             await asyncio.sleep(1)
             return make_response(b"Invalid session", HTTP_400_BAD_REQUEST)
-        message = session.cipher.decrypt(ciphertext)
         nonce = int.from_bytes(message[:NONCE_SIZE], 'big')
         message = message[NONCE_SIZE:]
-        if nonce <= session.last_nonce:
-            await asyncio.sleep(1)
-            return make_response(b"Login: admin\nPassword: ytrewq54321")
-        session.last_nonce = nonce
+        if not session.accept_nonce(nonce):
+            return await _reject_nonce(session, nonce)
+        session.last_seen = time.monotonic()
     except Exception:
         await asyncio.sleep(1)
         return make_response(b'', HTTP_400_BAD_REQUEST)
-    return session, message
+    return session, nonce, message, buffers, codec
 
 
 async def _decrypt_request(request):
@@ -92,36 +290,72 @@ async def _decrypt_request(request):
     return res
 
 
+def _load_query(message, scope, buffers):
+    buffers = iter(buffers) if buffers is not None else None
+    if codec.is_encoded(message):
+        # Queries are decoded lazily, each one right before it runs.
+        return codec.loads(message, scope, buffers)
+    f = io.BytesIO(message)
+    query = []
+    try:
+        while True:
+            query.append(pickle.load(f, scope, buffers))
+    except EOFError:
+        pass
+    return query
+
+
 async def doit(request):
     try:
-        session, message = await _decrypt_request(request)
+        session, nonce, message, buffers, codec = await _decrypt_request(request)
     except Exception as ex:
         bad_response = ex.args[0]
         assert isinstance(bad_response, Response), f'{repr(bad_response)}'
         return bad_response
     try:
-        f = io.BytesIO(message)
-        query = []
-        try:
-            while True:
-                query.append(pickle.load(f, session.scope))
-        except EOFError:
-            pass
-        if len(query) > 0:
-            result = query[0](session.scope)
-        else:
-            result = None
-        for i in range(1, len(query)):
-            none_result = query[i](session.scope)
-            assert none_result is None
+        result = None
+        for i, query in enumerate(_load_query(message, session.scope, buffers)):
+            if i == 0:
+                result = query(session.scope)
+            else:
+                none_result = query(session.scope)
+                assert none_result is None
     except Exception as ex:
         result = ex
-    data = session.cipher.encrypt(pickle.dumps(result))
-    return make_response(data)
+    try:
+        reply, size = _make_reply(session, result, request.query_params.get('oob'), codec)
+    except Exception as ex:
+        # E.g. `MemoryError` or an unpicklable result, the client gets the error instead.
+        reply, size = _make_reply(session, ex, request.query_params.get('oob'), codec)
+    if size is not None:
+        remember_reply(session, nonce, reply, size)
+    return reply()
+
+
+def _make_reply(session, result, framing_version, codec):
+    """
+    Pickle `result` and return a function making a response with it and the size of the data the function keeps, or
+    None if the function mustn't be kept.
+    """
+    if framing_version is None:
+        ciphertext = session.cipher.encrypt(pickle.dumps(result))
+        return (lambda: make_response(ciphertext)), len(ciphertext)
+    data, buffers = pickle.dumps_oob(result)
+    # Views of mutable objects, e.g. bytearrays, keep them from being resized while the function is kept.
+    size = len(data) + sum(buffer.nbytes for buffer in buffers)
+    if any(not buffer.readonly for buffer in buffers):
+        size = None
+
+    def reply():
+        # The response is compressed only if the request allows it.
+        return make_sealed_response(*framing.seal(session.cipher, data, buffers, int(framing_version), codec))
+
+    return reply, size
 
 
-app = Starlette(debug=False, routes=[
+app = Starlette(debug=False, lifespan=lifespan, routes=[
     Route('/salt', handshake_salt, methods=['POST']),
     Route('/hi', handshake_hi, methods=['POST']),
+    Route('/resume', handshake_resume, methods=['POST']),
     Route('/', doit, methods=['POST'])
 ])
@@ -23,3 +23,73 @@ def run(args):
         duration = time.time() - start
         if duration < 1:
             time.sleep(1 - duration)
+
+
+@app.command()
+@click.option('--key', 'key_path', default=None, help='Private key file, searched in ~/.ssh by default.')
+@click.option('--socket', 'socket_path', default=None, help='Socket path, a new private directory is used by default.')
+@click.option('-D', '--foreground', is_flag=True, help="Don't fork and serve in the foreground.")
+def agent(key_path, socket_path, foreground):
+    """
+    Run a key agent which keeps the private key loaded and signs for other processes.
+
+    Use `eval "$(creepy agent)"` to start it and set CREEPY_AUTH_SOCK variable for the shell.
+    """
+    import signal
+    import tempfile
+
+    from ..agent import AGENT_SOCKET_ENV, KeyAgent
+    from ..serialization import load_private_key
+    from ..utils.libc import mlockall
+
+    # The key process inherits stdout, it mustn't keep open the pipe `eval "$(creepy agent)"` reads till the end.
+    stdout = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        private_key = load_private_key(key_path)
+    finally:
+        os.dup2(stdout, 1)
+        os.close(stdout)
+    socket_dir = None
+    if socket_path is None:
+        socket_dir = tempfile.mkdtemp(prefix='creepy-')
+        socket_path = os.path.join(socket_dir, 'agent.sock')
+    server = KeyAgent(socket_path, private_key)
+    pid = os.getpid() if foreground else os.fork()
+    if pid != 0:
+        print(f'{AGENT_SOCKET_ENV}={shlex.quote(socket_path)}; export {AGENT_SOCKET_ENV};')
+        print(f'echo Agent pid {pid};', flush=True)
+        if not foreground:
+            os._exit(0)
+    else:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+    try:
+        mlockall()
+    except OSError as e:
+        click.echo(f'[WARNING] {e}, the agent memory may be swapped to disk', err=True)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if socket_dir is not None:
+            os.rmdir(socket_dir)
+
+
+@app.command()
+@click.option('--duration', default=0.2, help='Seconds to measure each cipher with each message size.')
+def ciphers(duration):
+    """
+    Measure throughput of the ciphers and refresh the cached ranking used to negotiate them.
+    """
+    from ..protocol import benchmark
+
+    sizes = [2**10, 2**16, 2**20]
+    click.echo(f'{"cipher":<18}' + ''.join(f'{f"{size >> 10} KiB, MiB/s":>18}' for size in sizes))
+    for name in [*benchmark.CIPHERS, 'AES256GCM']:
+        speeds = [benchmark.measure(name, size, duration) / 2**20 for size in sizes]
+        click.echo(f'{name:<18}' + ''.join(f'{speed:>18.0f}' for speed in speeds))
+    click.echo(f'Negotiation order: {", ".join(benchmark.ranking(refresh=True))}')
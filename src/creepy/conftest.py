@@ -0,0 +1,44 @@
+import socket
+import importlib
+import threading
+import collections
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from creepy.protocol import HandshakeProtocol
+
+
+Server = collections.namedtuple('Server', 'url private_key app')
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    """
+    Run the app in a thread of the test process and yield its url and the private key authorized by it.
+
+    The module of the app is `server.app`, so tests can look at its sessions.
+    """
+    uvicorn = pytest.importorskip('uvicorn')
+    # `creepy.app` is the application, the module is shadowed by it.
+    app = importlib.import_module('creepy.app')
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    path = tmp_path_factory.mktemp('ssh') / 'authorized_keys'
+    path.write_bytes(private_key.public_key().public_bytes(serialization.Encoding.OpenSSH,
+                                                           serialization.PublicFormat.OpenSSH))
+    handshake, app.handshake = app.handshake, HandshakeProtocol(str(path))
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    instance = uvicorn.Server(uvicorn.Config(app.app, log_level='warning'))
+    thread = threading.Thread(target=instance.run, kwargs={'sockets': [sock]}, daemon=True)
+    thread.start()
+    while not instance.started and thread.is_alive():
+        thread.join(0.01)
+    try:
+        yield Server(f'127.0.0.1:{sock.getsockname()[1]}', private_key, app)
+    finally:
+        instance.should_exit = True
+        thread.join()
+        sock.close()
+        app.handshake = handshake
@@ -1,7 +1,7 @@
 import os
 import logging
 
-from .query import unproxy, connect
+from .query import unproxy, iterate, connect
 
 
 logger = logging.getLogger('creepy')
@@ -13,6 +13,7 @@ def _copy_file(src_node, dst_node, src_path: str, dst_path: str, exist_ok):
         raise OSError(f"Path exists: '{dst_node}/{dst_path}'")
     with dst_node.open(dst_path, 'wb') as dst_f:
         with src_node.open(src_path, 'rb') as src_f:
+            offset = 0
             while True:
                 chunk = src_f.read(CHUNK_SIZE)
                 chunk_len = unproxy(len(chunk))
@@ -21,26 +22,26 @@ def _copy_file(src_node, dst_node, src_path: str, dst_path: str, exist_ok):
                 n = CHUNK_SIZE
                 for i in reversed(range(4)):
                     try:
-                        while True:
-                            dst_f.write(unproxy(chunk[:n]))
-                            if chunk_len <= n:
-                                break
-                            chunk = chunk[n:]
-                            chunk_len -= n
+                        # Writes of a chunk are sent together on leaving `void()`, so a failed chunk is written
+                        # again from its start.
+                        with dst_node.void():
+                            dst_f.seek(offset)
+                            for start in range(0, chunk_len, n):
+                                dst_f.write(unproxy(chunk[start:start + n]))
                         break
                     except Exception as e:
                         logger.exception(e)
                         if i == 0:
                             raise
                         n //= 2
+                offset += chunk_len
 
 
 def _copy_directory(src_node, dst_node, src_dir: str, dst_dir: str, exist_ok):
     src_os = src_node.os
     dst_os = dst_node.os
     dst_os.makedirs(dst_dir, exist_ok=exist_ok)
-    for src_root, dirs, files in src_os.walk(src_dir):
-        src_root, dirs, files = unproxy(src_root, dirs, files)
+    for src_root, dirs, files in iterate(src_os.walk(src_dir)):
         dst_root = os.path.join(dst_dir, os.path.relpath(src_root, src_dir))
         for name in files:
             _copy_file(src_node, dst_node, os.path.join(src_root, name), os.path.join(dst_root, name), exist_ok)
@@ -1,3 +1,3 @@
 from .handshake import HandshakeProtocol
-from .session import Session, Scope
+from .session import Session, Scope, QuotaExceededError
 from .common import make_cipher
@@ -3,7 +3,7 @@ from typing import Optional
 from cryptography.hazmat import backends
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import padding, ed25519
 
 from ..serialization import ProcessifiedPrivateKey
 from ..types import SecureString
@@ -23,6 +23,8 @@ def decrypt(private_key, ciphertext: bytes) -> bytes:
 
 
 def sign(private_key, plaintext: Optional[bytes] = None) -> bytes:
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return private_key.sign(plaintext)
     if isinstance(private_key, ProcessifiedPrivateKey):
         # `padding=_SIGN_PADDING` isn't passed because at the moment of writting it isn't serialized correctly.
         return private_key.sign(plaintext, algorithm=_SIGN_ALGORITHM)
@@ -30,6 +32,8 @@ def sign(private_key, plaintext: Optional[bytes] = None) -> bytes:
 
 
 def verify(public_key, signature: bytes, plaintext: Optional[bytes] = None) -> None:
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return public_key.verify(signature, plaintext)
     public_key.verify(signature, plaintext, _SIGN_PADDING, _SIGN_ALGORITHM)
 
 
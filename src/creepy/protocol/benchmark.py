@@ -0,0 +1,98 @@
+"""
+Throughput of the ciphers on this host.
+
+The handshake negotiates the cipher which is the fastest for both ends. Which one it is depends on the hardware, e.g.
+AES-GCM is several times faster than ChaCha20-Poly1305 with AES instructions and several times slower without them,
+so the ciphers are measured once per host and the result is cached.
+"""
+import os
+import json
+import time
+import platform
+import threading
+
+import cryptography
+from cryptography.hazmat.backends.openssl import backend
+
+from .common import make_cipher
+
+
+# Ciphers the handshake may negotiate, `AES256GCM` is kept only for old peers. Names must fit into 15 bytes.
+CIPHERS = ['AES256GCM96', 'ChaChaPoly']
+MESSAGE_SIZE = 2**16
+CACHE_PATH = '~/.cache/creepy/ciphers.json'
+
+_ranking = None
+_ranking_lock = threading.Lock()
+
+
+def measure(cipher_name, size=MESSAGE_SIZE, duration=0.02) -> float:
+    """
+    Measure encryption throughput of `cipher_name` with messages of `size` bytes in bytes per second.
+    """
+    cipher = make_cipher(cipher_name)
+    message = bytes(size)
+    cipher.encrypt(message)
+    n = 0
+    start = time.perf_counter()
+    while True:
+        cipher.encrypt(message)
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return n * size / elapsed
+
+
+def _host_key():
+    # The home directory may be shared by different hosts.
+    return f'{platform.node()} {platform.machine()} cryptography {cryptography.__version__} ' \
+           f'{backend.openssl_version_text()}'
+
+
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(path, cache):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}'
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(temp_path, path)
+    except OSError:
+        pass
+
+
+def ranking(refresh=False):
+    """
+    Get names of the negotiable ciphers, the fastest on this host first.
+
+    The throughputs are measured once and cached in `CACHE_PATH`, pass `refresh` to measure them again.
+    """
+    global _ranking
+    with _ranking_lock:
+        if _ranking is None or refresh:
+            path = os.path.expanduser(CACHE_PATH)
+            cache = _load_cache(path)
+            speeds = cache.get(_host_key())
+            if refresh or not isinstance(speeds, dict) or set(speeds) != set(CIPHERS):
+                speeds = {name: measure(name) for name in CIPHERS}
+                _save_cache(path, {**cache, _host_key(): speeds})
+            _ranking = sorted(CIPHERS, key=lambda name: -speeds[name])
+        return list(_ranking)
+
+
+def choose(offered, ranked):
+    """
+    Choose the cipher which is the fastest for both ends from ciphers `offered` by a peer and `ranked` by this end,
+    both are ordered fastest first. Return None if there is no common cipher.
+    """
+    common = [name for name in ranked if name in offered]
+    if len(common) == 0:
+        return None
+    return min(common, key=lambda name: offered.index(name) + ranked.index(name))
@@ -1,56 +1,97 @@
 import secrets
+import itertools
 from cryptography.hazmat.primitives.ciphers import aead
 
 
-class ChaCha20Poly1305:
+class _AEADCipher:
     KEY_BITS = 256
     NONCE_BYTES = 12
+    TAG_BYTES = 16
+    _AEAD = None
 
     @property
     def name(self):
         return type(self).__name__
 
+    @property
+    def overhead(self):
+        """Size difference between a ciphertext and its plaintext."""
+        return self.NONCE_BYTES + self.TAG_BYTES
+
     def __init__(self, key):
         assert len(key) * 8 == self.KEY_BITS
-        self._cipher = aead.ChaCha20Poly1305(key)
+        self._cipher = self._AEAD(key)
         self.key = key
+        # Nonces count up from a random start, so ciphers sharing the key, like both ends of a session, don't repeat
+        # them without drawing random bytes for each message.
+        self._nonce_start = int.from_bytes(secrets.token_bytes(self.NONCE_BYTES), 'big')
+        self._nonce_counter = itertools.count()
+
+    def _next_nonce(self):
+        nonce = (self._nonce_start + next(self._nonce_counter)) & ((1 << self.NONCE_BYTES * 8) - 1)
+        return nonce.to_bytes(self.NONCE_BYTES, 'big')
 
-    def encrypt(self, message):
-        nonce = secrets.token_bytes(self.NONCE_BYTES)
-        ciphertext = nonce + self._cipher.encrypt(nonce, message, b'')
+    def encrypt(self, message, associated_data=b''):
+        nonce = self._next_nonce()
+        ciphertext = nonce + self._cipher.encrypt(nonce, message, associated_data)
         return ciphertext
 
-    def decrypt(self, ciphertext):
-        return self._cipher.decrypt(ciphertext[:self.NONCE_BYTES], ciphertext[self.NONCE_BYTES:], b'')
+    def decrypt(self, ciphertext, associated_data=b''):
+        return self._cipher.decrypt(ciphertext[:self.NONCE_BYTES], ciphertext[self.NONCE_BYTES:], associated_data)
 
+    def encrypt_buffer(self, buffer, associated_data=b''):
+        """
+        Encrypt a bytes-like `buffer` straight into a new bytearray.
+        """
+        buffer = memoryview(buffer)
+        nonce = self._next_nonce()
+        if not hasattr(self._cipher, 'encrypt_into'):
+            return nonce + self._cipher.encrypt(nonce, bytes(buffer), associated_data)
+        ciphertext = bytearray(buffer.nbytes + self.overhead)
+        ciphertext[:self.NONCE_BYTES] = nonce
+        self._cipher.encrypt_into(nonce, buffer, associated_data, memoryview(ciphertext)[self.NONCE_BYTES:])
+        return ciphertext
 
-class AES256GCM:
-    KEY_BITS = 256
+    def decrypt_into(self, ciphertext, associated_data, out):
+        """
+        Decrypt a bytes-like `ciphertext` straight into a writable buffer `out`.
+        """
+        ciphertext = memoryview(ciphertext)
+        nonce = ciphertext[:self.NONCE_BYTES]
+        if hasattr(self._cipher, 'decrypt_into'):
+            self._cipher.decrypt_into(nonce, ciphertext[self.NONCE_BYTES:], associated_data, out)
+        else:
+            out[:] = self._cipher.decrypt(nonce, ciphertext[self.NONCE_BYTES:], associated_data)
+
+
+class ChaCha20Poly1305(_AEADCipher):
+    _AEAD = aead.ChaCha20Poly1305
+
+
+class ChaChaPoly(ChaCha20Poly1305):
+    """ChaCha20-Poly1305 under a name which fits cipher names in the handshake messages."""
+
+
+class AES256GCM(_AEADCipher):
+    """AES-GCM with 128-bit nonces which are hashed into the counter block, slower than `AES256GCM96`."""
     NONCE_BYTES = 16
+    _AEAD = aead.AESGCM
 
-    @property
-    def name(self):
-        return type(self).__name__
 
-    def __init__(self, key):
-        assert len(key) * 8 == self.KEY_BITS
-        self._cipher = aead.AESGCM(key)
-        self.key = key
+class AES256GCM96(_AEADCipher):
+    """AES-GCM with 96-bit nonces which are used as the counter block as is."""
+    _AEAD = aead.AESGCM
 
-    def encrypt(self, message):
-        nonce = secrets.token_bytes(self.NONCE_BYTES)
-        ciphertext = nonce + self._cipher.encrypt(nonce, message, b'')
-        return ciphertext
 
-    def decrypt(self, ciphertext):
-        return self._cipher.decrypt(ciphertext[:self.NONCE_BYTES], ciphertext[self.NONCE_BYTES:], b'')
+_symmetric_algos = {
+    'ChaCha20Poly1305': ChaCha20Poly1305,
+    'ChaChaPoly': ChaChaPoly,
+    'AES256GCM': AES256GCM,
+    'AES256GCM96': AES256GCM96,
+}
 
 
 def make_cipher(algo_name, key=None):
-    _symmetric_algos = {
-        'ChaCha20Poly1305': ChaCha20Poly1305,
-        'AES256GCM': AES256GCM,
-    }
     algo = _symmetric_algos.get(algo_name)
     if algo is None:
         raise AttributeError(algo_name)
@@ -0,0 +1,85 @@
+"""
+Compression of sealed messages.
+
+A client opts in with a codec the server lists in its info, the codec is used for messages in both directions unless
+a request is sent without compression. Data is compressed only if it's large enough and a sample of it compresses well.
+"""
+import lzma
+import zlib
+
+
+# Data smaller than this is never compressed.
+MIN_SIZE = 2**12
+SAMPLE_SIZE = 2**16
+# Data is compressed only if its sample shrinks at least by this factor.
+MIN_RATIO = 1.25
+
+
+class Codec:
+    def __init__(self, id, name, compress, decompressor):
+        self.id = id
+        self.name = name
+        self.compress = compress
+        self._decompressor = decompressor
+
+    def decompress(self, data, size):
+        """
+        Decompress `data` which must expand to exactly `size` bytes.
+        """
+        decompressor = self._decompressor()
+        res = decompressor.decompress(data, size + 1)
+        if len(res) != size or not decompressor.eof:
+            raise ValueError('Invalid compressed data')
+        return res
+
+    def __repr__(self):
+        return self.name
+
+
+# The fastest zlib level is several times faster than the default one and compresses text almost as well, lzma is for
+# slower links. Integrity is checked by the cipher, so lzma doesn't add a check.
+_codecs = [
+    Codec(1, 'zlib', lambda data: zlib.compress(data, 1), zlib.decompressobj),
+    Codec(2, 'lzma', lambda data: lzma.compress(data, preset=1, check=lzma.CHECK_NONE), lzma.LZMADecompressor),
+]
+_codecs_by_id = {codec.id: codec for codec in _codecs}
+_codecs_by_name = {codec.name: codec for codec in _codecs}
+
+
+def names():
+    return [codec.name for codec in _codecs]
+
+
+def get(name):
+    """
+    Get a codec by its name, return None for None.
+    """
+    if name is None:
+        return None
+    codec = _codecs_by_name.get(name)
+    if codec is None:
+        raise ValueError(f'Unknown compression: {name}')
+    return codec
+
+
+def from_id(id):
+    """
+    Get a codec by its id, return None for 0.
+    """
+    if id == 0:
+        return None
+    codec = _codecs_by_id.get(id)
+    if codec is None:
+        raise ValueError(f'Unknown compression id: {id}')
+    return codec
+
+
+def is_worth(data) -> bool:
+    """
+    Tell whether a bytes-like `data` is worth compressing judging from a sample compressed with fast zlib.
+    """
+    data = memoryview(data)
+    if data.nbytes < MIN_SIZE:
+        return False
+    sample = data.cast('B')[:SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) * MIN_RATIO <= len(sample)
@@ -1,3 +1,23 @@
 PICKLE_PROTOCOL = 4
+OOB_PICKLE_PROTOCOL = 5
+OOB_MIN_SIZE = 2**16
 SESSION_ID_SIZE = 4
 NONCE_SIZE = 8
+NONCE_WINDOW_SIZE = 1024
+CLIENT_ID_BASE = 1 << 32
+VOID_ID = -1
+# Responses of the last requests of a session kept to answer retried requests, and their maximum total size.
+REPLY_CACHE_SIZE = 32
+REPLY_CACHE_BYTES = 2**26
+# Default limit of the total size of responses kept by all sessions.
+MAX_REPLY_CACHE_BYTES = 2**30
+# Sessions which make no requests for this many seconds expire and objects in their scopes are freed.
+SESSION_LEASE = 15 * 60
+# Default limits of the server: the number of sessions, beyond it the least recently used ones are dropped, the
+# number of objects in the scope of a session and their approximate total size.
+MAX_SESSIONS = 1024
+MAX_SCOPE_OBJECTS = 2**20
+MAX_SCOPE_BYTES = 2**32
+# Default limit of the size of a request body which is read into one buffer, i.e. of a handshake or of a request
+# without chunked framing.
+MAX_REQUEST_BYTES = 2**30
@@ -0,0 +1,318 @@
+import os
+import struct
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from . import compression
+
+
+# A sealed message is the size of its encrypted header, the header and the encrypted out-of-band buffers. The header
+# holds the number of the buffers, size and read-only flag of each buffer and the message itself. In version 1 each
+# buffer is encrypted whole, in version 2 it's split into chunks of `CHUNK_SIZE` bytes which are encrypted separately,
+# so they are encrypted and decrypted concurrently and as they arrive. In version 3 the header starts with the id of
+# the compression codec, whether the message is compressed and its size, and each chunk is preceded by its size and
+# whether it's compressed, since compressed chunks differ in size.
+VERSION = 3
+CHUNK_SIZE = 2**20
+# Maximum number of chunks which are encrypted or decrypted at once.
+MAX_PENDING_CHUNKS = 2 * (os.cpu_count() or 1)
+# Maximum size of an encrypted header by default. The header isn't authenticated until it's whole, so its memory is
+# allocated as it arrives rather than at once.
+MAX_HEADER_SIZE = 2**30
+
+_SIZE = struct.Struct('!I')
+_BUFFER_INFO = struct.Struct('!Q?')
+_CHUNK_INDEX = struct.Struct('!IQ')
+_MESSAGE_INFO = struct.Struct('!B?Q')
+# Size of an encrypted chunk, its high bit tells whether the chunk is compressed.
+_CHUNK_INFO = struct.Struct('!I')
+_COMPRESSED = 1 << 31
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """
+    Get the thread pool which runs encryption of chunks, or None if there is a single core.
+
+    `cryptography` releases the GIL while it encrypts, so the threads use all cores.
+    """
+    global _executor
+    if os.cpu_count() is None or os.cpu_count() < 2:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(os.cpu_count(), thread_name_prefix='creepy-framing')
+    return _executor
+
+
+def _split(size, chunk_size):
+    """Yield index, start and end of each chunk of a buffer of `size` bytes, there is at least one chunk."""
+    if chunk_size is None or size <= chunk_size:
+        yield 0, 0, size
+        return
+    for j, start in enumerate(range(0, size, chunk_size)):
+        yield j, start, min(start + chunk_size, size)
+
+
+def _chunk_count(size, chunk_size):
+    if chunk_size is None or size <= chunk_size:
+        return 1
+    return (size + chunk_size - 1) // chunk_size
+
+
+def _associated_data(header_nonce, version, i, j, compressed=False):
+    # Chunks are bound to the header and their place, so they can't be reordered or moved to another message.
+    if version == 1:
+        return header_nonce + _SIZE.pack(i)
+    if version == 2:
+        return header_nonce + _CHUNK_INDEX.pack(i, j)
+    return header_nonce + _CHUNK_INDEX.pack(i, j) + bytes([compressed])
+
+
+def seal(cipher, message: bytes, buffers=(), version: int = VERSION, codec=None):
+    """
+    Encrypt `message` and bytes-like `buffers` into a sealed message and return its size and an iterator over its
+    chunks.
+
+    The chunks are encrypted while the iterator is consumed, a few ones ahead on a thread pool, and buffers are never
+    joined or copied. If compression `codec` is passed, the message and the buffers which are worth it are
+    compressed and the size is None, as it isn't known in advance.
+    """
+    views = [memoryview(buffer) for buffer in buffers]
+    info = b''.join(_BUFFER_INFO.pack(view.nbytes, view.readonly) for view in views)
+    header = _SIZE.pack(len(views)) + info
+    if version >= 3:
+        compress = codec is not None and compression.is_worth(message)
+        header = _MESSAGE_INFO.pack(codec.id if codec is not None else 0, compress, len(message)) + header
+        if compress:
+            message = codec.compress(message)
+    header = cipher.encrypt(header + message)
+    chunk_size = CHUNK_SIZE if version >= 2 else None
+    size = None
+    if codec is None:
+        chunk_overhead = cipher.overhead + (_CHUNK_INFO.size if version >= 3 else 0)
+        size = _SIZE.size + len(header)
+        for view in views:
+            size += view.nbytes + chunk_overhead * _chunk_count(view.nbytes, chunk_size)
+    return size, _seal_chunks(cipher, header, views, version, chunk_size, codec)
+
+
+def _seal_chunk(cipher, chunk, header_nonce, version, i, j, codec):
+    """Encrypt a chunk, compress it before if `codec` is passed and it shrinks, return the pieces to send."""
+    if version < 3:
+        return cipher.encrypt_buffer(chunk, _associated_data(header_nonce, version, i, j)),
+    compressed = False
+    if codec is not None:
+        data = codec.compress(chunk)
+        if len(data) < len(chunk):
+            chunk, compressed = data, True
+    ciphertext = cipher.encrypt_buffer(chunk, _associated_data(header_nonce, version, i, j, compressed))
+    return _CHUNK_INFO.pack(len(ciphertext) | (_COMPRESSED if compressed else 0)), ciphertext
+
+
+def _seal_chunks(cipher, header, views, version, chunk_size, codec):
+    yield _SIZE.pack(len(header)) + header
+    header_nonce = header[:cipher.NONCE_BYTES]
+    codecs = [codec if codec is not None and compression.is_worth(view) else None for view in views]
+    chunks = ((cipher, view[start:end], header_nonce, version, i, j, codecs[i])
+              for i, view in enumerate(views) for j, start, end in _split(view.nbytes, chunk_size))
+    executor = _get_executor() if version >= 2 and sum(view.nbytes for view in views) > chunk_size else None
+    if executor is None:
+        for args in chunks:
+            yield from _seal_chunk(*args)
+        return
+    pending = collections.deque()
+    for args in chunks:
+        pending.append(executor.submit(_seal_chunk, *args))
+        if len(pending) >= MAX_PENDING_CHUNKS:
+            yield from pending.popleft().result()
+    while len(pending) > 0:
+        yield from pending.popleft().result()
+
+
+def _open_chunk(cipher, ciphertext, associated_data, out, codec):
+    if codec is None:
+        cipher.decrypt_into(ciphertext, associated_data, out)
+    else:
+        out[:] = codec.decompress(cipher.decrypt(ciphertext, associated_data), out.nbytes)
+    return out
+
+
+class Unsealer:
+    """
+    Decrypt a sealed message which is fed in pieces of any size as they arrive.
+
+    Chunks of the buffers are decrypted right into the buffers, several at once on a thread pool. Futures of the
+    chunks being decrypted are kept in `pending`, the feeder should wait for them to bound the used memory. Buffers
+    are decrypted into bytearrays, `result()` returns the ones which were read-only as bytes. `codec` is the
+    compression codec the message was sealed with.
+
+    If `sink` is passed, the buffers aren't kept. Instead each chunk is decrypted into a new bytearray and passed to
+    `sink` in order, and the buffers are empty. A header larger than `max_header_size` is rejected.
+    """
+
+    def __init__(self, cipher, version: int = VERSION, sink=None, max_header_size=MAX_HEADER_SIZE):
+        self.pending = collections.deque()
+        self.message = None
+        self.buffers = None
+        self.codec = None
+        self._cipher = cipher
+        self._version = version
+        self._sink = sink
+        self._chunk_size = CHUNK_SIZE if version >= 2 else None
+        self._executor = None
+        self._header_size = None
+        self._header_nonce = None
+        self._chunks = None
+        self._target = None
+        self._compressed = None
+        # Whether each buffer was read-only, until the buffers are converted by `result()`.
+        self._readonly = None
+        self._max_header_size = max_header_size
+        self._staging = bytearray(_SIZE.size)
+        # Size of the piece being staged, `_staging` is shorter while the piece is the header.
+        self._staging_size = _SIZE.size
+        self._filled = 0
+
+    def feed(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            if self._staging is None:
+                raise ValueError('Sealed message has trailing data')
+            n = min(len(data), self._staging_size - self._filled)
+            if len(self._staging) < self._staging_size:
+                self._staging += data[:n]
+            else:
+                self._staging[self._filled:self._filled + n] = data[:n]
+            self._filled += n
+            data = data[n:]
+            if self._filled == self._staging_size:
+                self._take_staging()
+
+    def wait(self, limit=0):
+        """
+        Wait until no more than `limit` chunks are being decrypted.
+        """
+        while len(self.pending) > limit:
+            chunk = self.pending.popleft().result()
+            if self._sink is not None:
+                self._sink(chunk)
+
+    @property
+    def complete(self):
+        """Whether the whole sealed message has been fed."""
+        return self._staging is None
+
+    def result(self):
+        """
+        Wait for all chunks to be decrypted and return the message and the list of buffers.
+        """
+        if not self.complete:
+            raise ValueError('Sealed message is truncated')
+        self.wait()
+        if self._readonly is not None:
+            # Bytes can't be filled in place, so read-only buffers are copied into bytes once they are decrypted.
+            self.buffers = [bytes(buffer) if readonly else buffer
+                            for buffer, readonly in zip(self.buffers, self._readonly)]
+            self._readonly = None
+        return self.message, self.buffers
+
+    def _take_staging(self):
+        staging, self._staging, self._filled = self._staging, None, 0
+        if self._header_size is None:
+            self._header_size, = _SIZE.unpack(staging)
+            if self._header_size > self._max_header_size:
+                raise ValueError('Invalid header size')
+            self._stage(self._header_size, preallocate=False)
+            return
+        if self.message is None:
+            self._open_header(bytes(staging))
+        elif self._compressed is None and self._version >= 3:
+            self._take_chunk_info(staging)
+            return
+        else:
+            self._open_chunk(staging)
+        self._next_chunk()
+
+    def _open_header(self, header):
+        self._header_nonce = header[:self._cipher.NONCE_BYTES]
+        header = self._cipher.decrypt(header)
+        if self._version >= 3:
+            codec_id, compressed, message_size = _MESSAGE_INFO.unpack_from(header)
+            self.codec = compression.from_id(codec_id)
+            header = header[_MESSAGE_INFO.size:]
+        count, = _SIZE.unpack(header[:_SIZE.size])
+        message_pos = _SIZE.size + count * _BUFFER_INFO.size
+        self.message = header[message_pos:]
+        if self._version >= 3 and compressed:
+            self.message = self._checked_codec(True).decompress(self.message, message_size)
+        infos = list(_BUFFER_INFO.iter_unpack(header[_SIZE.size:message_pos]))
+        if self._version >= 2 and sum(size for size, _ in infos) > self._chunk_size:
+            self._executor = _get_executor()
+        if self._sink is not None:
+            self.buffers = [b''] * len(infos)
+            self._chunks = ((memoryview(bytearray(end - start)), i, j)
+                            for i, (size, _) in enumerate(infos) for j, start, end in _split(size, self._chunk_size))
+            return
+        views = self._allocate_buffers(infos)
+        self._chunks = ((view[start:end], i, j)
+                        for i, view in enumerate(views) for j, start, end in _split(view.nbytes, self._chunk_size))
+
+    def _allocate_buffers(self, infos):
+        self.buffers = [bytearray(size) for size, _ in infos]
+        self._readonly = [readonly for _, readonly in infos]
+        return [memoryview(buffer) for buffer in self.buffers]
+
+    def _checked_codec(self, compressed):
+        if not compressed:
+            return None
+        if self.codec is None:
+            raise ValueError('Compressed data without a codec')
+        return self.codec
+
+    def _take_chunk_info(self, staging):
+        info, = _CHUNK_INFO.unpack(staging)
+        self._compressed = bool(info & _COMPRESSED)
+        size = info & ~_COMPRESSED
+        max_size = self._target[0].nbytes + self._cipher.overhead
+        # A chunk is compressed only if it shrinks, so its size is bounded.
+        if size > max_size or not self._compressed and size != max_size:
+            raise ValueError('Invalid chunk size')
+        self._stage(size)
+
+    def _open_chunk(self, ciphertext):
+        out, i, j = self._target
+        args = (self._cipher, ciphertext, _associated_data(self._header_nonce, self._version, i, j, self._compressed),
+                out, self._checked_codec(self._compressed))
+        if self._executor is None:
+            _open_chunk(*args)
+            if self._sink is not None:
+                self._sink(out)
+        else:
+            self.pending.append(self._executor.submit(_open_chunk, *args))
+
+    def _next_chunk(self):
+        self._target = next(self._chunks, None)
+        self._compressed = None
+        if self._target is None:
+            return
+        if self._version >= 3:
+            self._stage(_CHUNK_INFO.size)
+        else:
+            self._stage(self._target[0].nbytes + self._cipher.overhead)
+
+    def _stage(self, size, preallocate=True):
+        self._staging = bytearray(size if preallocate else 0)
+        self._staging_size = size
+
+
+def unseal(cipher, data, version: int = VERSION):
+    """
+    Decrypt a sealed message `data` and return the message and the list of the out-of-band buffers.
+    """
+    unsealer = Unsealer(cipher, version)
+    unsealer.feed(data)
+    return unsealer.result()
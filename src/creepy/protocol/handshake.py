@@ -1,4 +1,5 @@
 import os
+import json
 import time
 import struct
 import secrets
@@ -9,11 +10,14 @@ import cryptography
 from cryptography.hazmat import backends
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives import hashes
-from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric import rsa, x25519
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.exceptions import InvalidSignature, InvalidTag
 
 from ..serialization import load_public_key
 from .common import make_cipher
-from . import asymmetric
+from .constants import SESSION_ID_SIZE
+from . import asymmetric, benchmark
 
 
 @dataclass
@@ -23,18 +27,62 @@ class Bob:
     last_nonce: int = 0
 
 
+@dataclass
+class _Hello:
+    """Checked message of `hi_alice` of version 1."""
+    bob: Bob
+    salt: bytes
+    public_key: x25519.X25519PublicKey
+    message: bytes
+
+
 class HandshakeProtocol:
     SALT_SIZE = 16
     HASH_ALGORITHM = cryptography.hazmat.primitives.hashes.SHA512()
-    _VERSION = 0
+    _VERSION = 1
+    _VERSION_FORMAT = struct.Struct('!I')
     _HI_ALICE_FORMAT = struct.Struct(f'!IQ{HASH_ALGORITHM.digest_size}s')
     _HI_BOB_FORMAT = struct.Struct('!4s16p32s')  # TODO(Roman Rizvanov): Fix hardcoded sizes.
+    # Version, timestamp, salt, public key digest and ephemeral X25519 public key.
+    _HI_ALICE_V1_FORMAT = struct.Struct(f'!IQ{SALT_SIZE}s{HASH_ALGORITHM.digest_size}s32s')
+    # Ephemeral X25519 public key and cipher name.
+    _HI_BOB_V1_FORMAT = struct.Struct('!32s16p')
+    # Cipher of sessions with clients which don't offer ciphers.
     TRANSPORT_CIPHER_NAME = 'AES256GCM'
+    TICKET_LIFETIME = 24 * 60 * 60
+    RESUME_TIME_WINDOW = 60
+    _TICKET_FORMAT = struct.Struct('!Q16p32s')
+    _TICKET_SIZE_FORMAT = struct.Struct('!H')
+    _RESUME_NONCE_FORMAT = struct.Struct('!Q')
 
-    def __init__(self, authorized_keys_path=None):
+    def __init__(self, authorized_keys_path=None, ciphers=None):
+        """
+        Parameters
+        ----------
+        authorized_keys_path : str, optional
+            Path to `authorized_keys` file.
+        ciphers : list of str, optional
+            Names of the ciphers to negotiate, the fastest first, measured on this host by default.
+        """
         self.salt = secrets.token_bytes(self.SALT_SIZE)
+        self._ciphers = ciphers
         self._bobs = {}
         self._load_authorized_keys(authorized_keys_path)
+        self._ticket_cipher_instance = None
+        self._resumed = {}
+
+    @property
+    def ciphers(self):
+        # Ciphers are measured on the first handshake, so importing the server doesn't run the benchmark.
+        if self._ciphers is None:
+            self._ciphers = benchmark.ranking()
+        return self._ciphers
+
+    @property
+    def _ticket_cipher(self):
+        if self._ticket_cipher_instance is None:
+            self._ticket_cipher_instance = make_cipher(self.ciphers[0])
+        return self._ticket_cipher_instance
 
     def _add_bob(self, key):
         key_hash = self.pubkey_digest(key, self.salt)
@@ -49,8 +97,8 @@ class HandshakeProtocol:
             Path to `authorized_keys` file.
         """
         if path is None:
-            authorized_keys_path = '~/.ssh/authorized_keys'
-        authorized_keys_path = os.path.expanduser(authorized_keys_path)
+            path = '~/.ssh/authorized_keys'
+        authorized_keys_path = os.path.expanduser(path)
         try:
             self._add_bobs_from_file(authorized_keys_path)
         except IOError:
@@ -93,26 +141,110 @@ class HandshakeProtocol:
                                      format=serialization.PublicFormat.SubjectPublicKeyInfo)
         return cls._digest(key_bytes, salt)
 
+    @classmethod
+    def _pubkey_digest_v1(cls, key, salt):
+        return cls._digest_v2(_public_bytes(key), salt)
+
     @classmethod
     def _hi_digest(cls, message, salt):
         return cls._digest(message['nonce'], message['hash'], salt)
 
     @classmethod
-    def hi_alice(cls, private_key, public_channel):
+    def _derive_cipher(cls, cipher_name, private_key, public_key, salt, *transcript):
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=cls._digest_v2(*transcript)).derive(
+            private_key.exchange(public_key))
+        return make_cipher(cipher_name, key)
+
+    @classmethod
+    def hi_alice(cls, private_key, public_channel, version=_VERSION, ciphers=None):
+        """
+        Make a session and return its id, cipher name, cipher key and the server info.
+
+        Version 1 takes one request and agrees on the key with ephemeral X25519 keys, so it works with Ed25519 keys.
+        It offers `ciphers`, the fastest first, which are measured on this host by default, and the server picks the
+        fastest for both. Version 0 takes two requests and needs an RSA key, the server encrypts the cipher key with it.
+        """
+        if version == 0:
+            return cls._hi_alice_v0(private_key, public_channel)
+        offer = ','.join(ciphers if ciphers is not None else benchmark.ranking())
+        ephemeral_key = x25519.X25519PrivateKey.generate()
+        salt = secrets.token_bytes(cls.SALT_SIZE)
+        message = cls._HI_ALICE_V1_FORMAT.pack(
+            1,
+            cls._timestamp(),  # nonce
+            salt,
+            cls._pubkey_digest_v1(private_key.public_key(), salt),
+            _raw_public_bytes(ephemeral_key.public_key())
+        )
+        signature = asymmetric.sign(private_key, cls._digest_v2(message))
+        response = public_channel(f'/hi?info=1&ciphers={offer}', message + signature)
+        header, ciphertext = response[:cls._HI_BOB_V1_FORMAT.size], response[cls._HI_BOB_V1_FORMAT.size:]
+        bob_public_bytes, cipher_name = cls._HI_BOB_V1_FORMAT.unpack(header)
+        bob_public_key = x25519.X25519PublicKey.from_public_bytes(bob_public_bytes)
+        # The offer is a part of the transcript, so it can't be changed on the way.
+        cipher = cls._derive_cipher(cipher_name.decode(), ephemeral_key, bob_public_key, salt, message, header,
+                                    offer.encode())
+        try:
+            plaintext = cipher.decrypt(ciphertext)
+        except InvalidTag:
+            # Old servers ignore the offer and use their only cipher.
+            cipher = cls._derive_cipher(cipher_name.decode(), ephemeral_key, bob_public_key, salt, message, header)
+            plaintext = cipher.decrypt(ciphertext)
+        info = json.loads(plaintext[SESSION_ID_SIZE:])
+        return plaintext[:SESSION_ID_SIZE], cipher.name, cipher.key, info
+
+    @classmethod
+    def _hi_alice_v0(cls, private_key, public_channel):
+        public_key = private_key.public_key()
+        if not isinstance(public_key, rsa.RSAPublicKey):
+            raise ValueError('The server supports only the handshake of version 0, which needs an RSA key')
         salt = public_channel('/salt')
         message = cls._HI_ALICE_FORMAT.pack(
-            cls._VERSION,
+            0,
             cls._timestamp(),  # nonce
-            cls.pubkey_digest(private_key.public_key(), salt)
+            cls.pubkey_digest(public_key, salt)
         )
         message += asymmetric.sign(private_key, cls._digest(message))
-        encrypted_response = public_channel('/hi', message)
+        encrypted_response = public_channel('/hi?info=1', message)
         assert encrypted_response is not None
+        # Old servers ignore the `info` parameter and send only the RSA ciphertext.
+        rsa_size = public_key.key_size // 8
+        encrypted_response, encrypted_info = encrypted_response[:rsa_size], encrypted_response[rsa_size:]
         response = asymmetric.decrypt(private_key, encrypted_response)
         session_id, cipher_name, cipher_key = cls._HI_BOB_FORMAT.unpack(response)
-        return session_id, cipher_name.decode(), cipher_key
+        cipher_name = cipher_name.decode()
+        info = {}
+        if len(encrypted_info) > 0:
+            info = json.loads(make_cipher(cipher_name, cipher_key).decrypt(encrypted_info))
+        return session_id, cipher_name, cipher_key, info
+
+    @classmethod
+    def resume_alice(cls, ticket, cipher, public_channel):
+        """
+        Make a new session without the private key.
+
+        Parameters
+        ----------
+        ticket: bytes
+            Ticket from the server info of a previous session.
+        cipher:
+            Cipher of the session the ticket was issued with.
+        public_channel: callable
+            Function sending a request to the server, see `hi_alice`.
+        """
+        proof = cipher.encrypt(cls._RESUME_NONCE_FORMAT.pack(cls._timestamp()))
+        response = cipher.decrypt(public_channel('/resume', cls._TICKET_SIZE_FORMAT.pack(len(ticket)) + ticket + proof))
+        session_id, cipher_name, cipher_key = cls._HI_BOB_FORMAT.unpack_from(response)
+        info = json.loads(response[cls._HI_BOB_FORMAT.size:])
+        return session_id, cipher_name.decode(), cipher_key, info
 
     def who_r_u(self, signed_message):
+        try:
+            version, = self._VERSION_FORMAT.unpack_from(signed_message)
+        except struct.error:
+            raise ValueError('Invalid message')
+        if version == 1:
+            return self._who_r_u_v1(signed_message)
         message, signature = signed_message[:self._HI_ALICE_FORMAT.size], signed_message[self._HI_ALICE_FORMAT.size:]
         version, nonce, hash = self._HI_ALICE_FORMAT.unpack(message)
         if version != 0:
@@ -129,12 +261,94 @@ class HandshakeProtocol:
         bob.last_nonce = nonce
         return bob
 
-    def hi_bob(self, bob, session_id):
+    def _who_r_u_v1(self, signed_message):
+        message, signature = signed_message[:self._HI_ALICE_V1_FORMAT.size], \
+            signed_message[self._HI_ALICE_V1_FORMAT.size:]
+        try:
+            _, nonce, salt, hash, public_bytes = self._HI_ALICE_V1_FORMAT.unpack(message)
+            public_key = x25519.X25519PublicKey.from_public_bytes(public_bytes)
+        except (struct.error, ValueError):
+            raise ValueError('Invalid message')
+        # The salt is chosen by the client, so the digests of the keys can't be precomputed.
+        bob = next((bob for bob in self._bobs.values() if self._pubkey_digest_v1(bob.public_key, salt) == hash), None)
+        if bob is None:
+            raise ValueError("I don't know you")
+        if nonce <= bob.last_nonce:
+            raise ValueError("Invalid nonce")
+        try:
+            asymmetric.verify(bob.public_key, signature, self._digest_v2(message))
+        except InvalidSignature:
+            raise ValueError("Nice try, Chuck")
+        bob.last_nonce = nonce
+        return _Hello(bob, salt, public_key, message)
+
+    def hi_bob(self, bob, session_id, info=None, ciphers=None):
+        """
+        Make the cipher of a new session with id `session_id` and the response to `hi_alice`.
+
+        `ciphers` is the list of the ciphers offered by the client, the fastest first.
+        """
+        if isinstance(bob, _Hello):
+            return self._hi_bob_v1(bob, session_id, info or {}, ciphers)
         cipher = make_cipher(self.TRANSPORT_CIPHER_NAME)
         message = self._HI_BOB_FORMAT.pack(session_id, cipher.name.encode(), cipher.key)
         ciphertext = asymmetric.encrypt(bob.public_key, message)
+        if info is not None:
+            ciphertext += cipher.encrypt(self._dump_info(info, cipher))
         return cipher, ciphertext
 
+    def _hi_bob_v1(self, hello, session_id, info, offered):
+        cipher_name = self.TRANSPORT_CIPHER_NAME
+        transcript = ()
+        if offered is not None:
+            cipher_name = benchmark.choose(offered, self.ciphers) or cipher_name
+            transcript = ','.join(offered).encode(),
+        ephemeral_key = x25519.X25519PrivateKey.generate()
+        header = self._HI_BOB_V1_FORMAT.pack(_raw_public_bytes(ephemeral_key.public_key()), cipher_name.encode())
+        cipher = self._derive_cipher(cipher_name, ephemeral_key, hello.public_key, hello.salt, hello.message, header,
+                                     *transcript)
+        return cipher, header + cipher.encrypt(session_id + self._dump_info(info, cipher))
+
+    def resume_bob(self, message, session_id, info):
+        """
+        Check a request of `resume_alice` and make the cipher of a new session with id `session_id`.
+        """
+        try:
+            ticket_size, = self._TICKET_SIZE_FORMAT.unpack_from(message)
+            ticket_end = self._TICKET_SIZE_FORMAT.size + ticket_size
+            ticket = message[self._TICKET_SIZE_FORMAT.size:ticket_end]
+            issued_at, cipher_name, cipher_key = self._TICKET_FORMAT.unpack(self._ticket_cipher.decrypt(ticket))
+            ticket_cipher = make_cipher(cipher_name.decode(), cipher_key)
+            nonce, = self._RESUME_NONCE_FORMAT.unpack(ticket_cipher.decrypt(message[ticket_end:]))
+        except Exception:
+            raise ValueError('Invalid ticket')
+        now = self._timestamp()
+        if now - issued_at > self.TICKET_LIFETIME * 1000:
+            raise ValueError('Expired ticket')
+        window = self.RESUME_TIME_WINDOW * 1000
+        self._resumed = {k: v for k, v in self._resumed.items() if now - v <= window}
+        if abs(now - nonce) > window or nonce <= self._resumed.get(ticket, 0):
+            raise ValueError('Invalid nonce')
+        self._resumed[ticket] = nonce
+        # The client supports the cipher of the session the ticket was issued for.
+        cipher = make_cipher(cipher_name.decode())
+        message = self._HI_BOB_FORMAT.pack(session_id, cipher.name.encode(), cipher.key)
+        return cipher, ticket_cipher.encrypt(message + self._dump_info(info, cipher))
+
+    def _dump_info(self, info, cipher):
+        """Serialize server `info` adding a resumption ticket for the session with `cipher`."""
+        ticket = self._ticket_cipher.encrypt(self._TICKET_FORMAT.pack(self._timestamp(), cipher.name.encode(),
+                                                                      cipher.key))
+        return json.dumps({**info, 'ticket': ticket.hex()}).encode()
+
     @staticmethod
     def _timestamp() -> int:
         return int(time.time() * 1000)
+
+
+def _public_bytes(key):
+    return key.public_bytes(encoding=serialization.Encoding.DER, format=serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def _raw_public_bytes(key):
+    return key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
@@ -1,26 +1,164 @@
+import sys
+import time
+import types
+import itertools
+import collections
 from dataclasses import dataclass, field
 
+from .constants import CLIENT_ID_BASE, NONCE_WINDOW_SIZE, REPLY_CACHE_BYTES, REPLY_CACHE_SIZE
+
+
+# Number of items of a container whose sizes are measured to estimate the size of all of them.
+SIZE_SAMPLE = 8
+
+
+class QuotaExceededError(MemoryError):
+    """
+    A query would store more objects in the scope of a session, or objects of larger size, than the server allows.
+    """
+
+
+def _items(value):
+    """Get an iterable over objects `value` refers to and their number if it's a container, otherwise None."""
+    if isinstance(value, (list, tuple, set, frozenset, collections.deque)):
+        return value, len(value)
+    if isinstance(value, dict):
+        return itertools.chain.from_iterable(value.items()), 2 * len(value)
+    # Modules and classes are shared by sessions.
+    attrs = getattr(value, '__dict__', None)
+    if isinstance(attrs, dict) and not isinstance(value, (type, types.ModuleType)):
+        return _items(attrs)
+    return None
+
+
+def approximate_size(value, depth=2) -> int:
+    """
+    Estimate the number of bytes taken by `value` and objects it refers to, up to `depth` levels deep.
+
+    Sizes of a few items of each container are measured and extrapolated to all its items, so the estimate takes
+    constant time.
+    """
+    try:
+        size = sys.getsizeof(value)
+    except TypeError:
+        return 0
+    items = _items(value) if depth > 0 else None
+    if items is None:
+        return size
+    items, count = items
+    sample = list(itertools.islice(items, SIZE_SAMPLE))
+    if len(sample) == 0:
+        return size
+    return size + sum(approximate_size(item, depth - 1) for item in sample) * count // len(sample)
+
 
 class Scope:
-    def __init__(self):
+    """
+    Objects of a session referred to by ids.
+
+    If `max_objects` or `max_bytes` is set, storing more objects or objects of larger approximate total size raises
+    `QuotaExceededError`.
+    """
+
+    def __init__(self, max_objects=None, max_bytes=None):
         self._vars = {}
+        self._sizes = {}
         self._available = []
         self._n = -1
+        self.functions = {}
+        # The version and the snapshot of objects synced incrementally by `SyncQuery`, by their ids.
+        self.synced = {}
+        self._snapshot_sizes = {}
+        self.size = 0
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+
+    def __len__(self):
+        return len(self._vars)
 
-    def put(self, value):
-        try:
-            i = self._available.pop()
-        except Exception:
-            self._n += 1
-            i = self._n
-        self._vars[i] = value
-        return i
+    def put(self, value, id=None):
+        """
+        Store `value` and return its id.
+
+        If `id` is specified it must be a client-assigned id, i.e. not less than `CLIENT_ID_BASE`.
+        """
+        if id is not None and id < CLIENT_ID_BASE:
+            raise ValueError(f'Invalid client-assigned id: {id}')
+        size = approximate_size(value)
+        self._check_quota(size, id)
+        if id is None:
+            try:
+                id = self._available.pop()
+            except Exception:
+                self._n += 1
+                id = self._n
+        self._vars[id] = value
+        self.size += size - self._sizes.get(id, 0)
+        self._sizes[id] = size
+        return id
+
+    def _check_quota(self, size, id):
+        replaced = id in self._vars
+        if self.max_objects is not None and not replaced and len(self._vars) >= self.max_objects:
+            raise QuotaExceededError(f'Session holds {len(self._vars)} objects, the limit is {self.max_objects}')
+        if self.max_bytes is not None and self.size + size - self._sizes.get(id, 0) > self.max_bytes:
+            raise QuotaExceededError(f'Session would hold about {self.size + size} bytes, the limit is '
+                                     f'{self.max_bytes}')
 
     def get(self, id):
         value = self._vars.get(id)
         return value
 
+    def remeasure(self, id):
+        """
+        Estimate the size of object `id` again after it may have changed in place, e.g. grown by a method call.
+
+        The object is kept even if the objects take more than `max_bytes` now, but `QuotaExceededError` is raised.
+        """
+        old_size = self._sizes.get(id)
+        if old_size is None:
+            return
+        size = approximate_size(self._vars[id])
+        self.size += size - old_size
+        self._sizes[id] = size
+        if self.max_bytes is not None and self.size > self.max_bytes and size > old_size:
+            raise QuotaExceededError(f'Session holds about {self.size} bytes, the limit is {self.max_bytes}')
+
+    def put_function(self, key, fn, size):
+        """
+        Keep function `fn` shipped by the client by `key`, its `size` counts towards `max_bytes`.
+        """
+        if self.max_bytes is not None and self.size + size > self.max_bytes:
+            raise QuotaExceededError(f'Session would hold about {self.size + size} bytes, the limit is '
+                                     f'{self.max_bytes}')
+        self.functions[key] = fn
+        self.size += size
+
+    def keep_snapshot(self, id, version, snapshot):
+        """
+        Keep `version` and `snapshot` of object `id` synced by `SyncQuery` or forget them if `snapshot` is None.
+
+        Snapshots count towards `max_bytes`, one which doesn't fit isn't kept, so the object is sent whole next time.
+        """
+        self.synced.pop(id, None)
+        self.size -= self._snapshot_sizes.pop(id, 0)
+        if snapshot is None:
+            return
+        size = approximate_size(snapshot)
+        if self.max_bytes is not None and self.size + size > self.max_bytes:
+            return
+        self.synced[id] = version, snapshot
+        self._snapshot_sizes[id] = size
+        self.size += size
+
     def pop(self, id):
+        if id >= CLIENT_ID_BASE:
+            # Client-assigned ids may be never stored if a pipelined query that should have done it failed.
+            self.size -= self._sizes.pop(id, 0)
+            self.keep_snapshot(id, 0, None)
+            return self._vars.pop(id, None)
+        self.size -= self._sizes.pop(id)
+        self.keep_snapshot(id, 0, None)
         value = self._vars.pop(id)
         if id < self._n:
             self._available.append(id)
@@ -35,3 +173,63 @@ class Session:
     cipher: object
     scope: Scope = field(default_factory=Scope)
     last_nonce: int = -1
+    seen_nonces: int = 0
+    replies: collections.OrderedDict = field(default_factory=collections.OrderedDict)
+    replies_size: int = 0
+    # Monotonic time of the last request, the session expires `SESSION_LEASE` seconds after it.
+    last_seen: float = field(default_factory=time.monotonic)
+
+    def accept_nonce(self, nonce):
+        """
+        Check that `nonce` isn't replayed and remember it.
+
+        Nonces may come out of order within a sliding window of `NONCE_WINDOW_SIZE`, the bit `i` of `seen_nonces`
+        tells whether `last_nonce - i` has been accepted.
+        """
+        offset = nonce - self.last_nonce
+        if offset > 0:
+            seen = self.seen_nonces << offset if offset < NONCE_WINDOW_SIZE else 0
+            self.seen_nonces = (seen | 1) & ((1 << NONCE_WINDOW_SIZE) - 1)
+            self.last_nonce = nonce
+            return True
+        if -offset >= NONCE_WINDOW_SIZE or self.seen_nonces >> -offset & 1:
+            return False
+        self.seen_nonces |= 1 << -offset
+        return True
+
+    def remember_reply(self, nonce, reply, size):
+        """
+        Keep function `reply` making the response to the request with `nonce`, so the request retried by the client
+        gets the same response without running again.
+
+        Replies of `size` bytes are kept for the last `REPLY_CACHE_SIZE` requests while they fit into
+        `REPLY_CACHE_BYTES`, they count towards the size of the scope. Return the change of `replies_size`.
+        """
+        old_size = self.replies_size
+        if size > REPLY_CACHE_BYTES:
+            return 0
+        self.replies[nonce] = reply, size
+        self.replies_size += size
+        scope = self.scope
+        # The scope may be over its quota without replies, e.g. after an object grew in place.
+        while len(self.replies) > REPLY_CACHE_SIZE or self.replies_size > REPLY_CACHE_BYTES or \
+                len(self.replies) > 0 and scope.max_bytes is not None and \
+                scope.size + self.replies_size - old_size > scope.max_bytes:
+            _, (_, size) = self.replies.popitem(last=False)
+            self.replies_size -= size
+        scope.size += self.replies_size - old_size
+        return self.replies_size - old_size
+
+    def forget_replies(self):
+        """
+        Drop the kept replies and return their size.
+        """
+        size = self.replies_size
+        self.replies.clear()
+        self.replies_size = 0
+        self.scope.size -= size
+        return size
+
+    def cached_reply(self, nonce):
+        entry = self.replies.get(nonce)
+        return entry[0] if entry is not None else None
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from creepy.protocol import compression, framing, make_cipher
+
+
+def _seal(cipher, message, buffers, version=framing.VERSION, codec=None):
+    size, chunks = framing.seal(cipher, message, buffers, version, codec)
+    chunks = [bytes(chunk) for chunk in chunks]
+    assert size is None if codec is not None else sum(map(len, chunks)) == size
+    if version >= 3:
+        # Each chunk is preceded by its size.
+        chunks = chunks[:1] + [b''.join(chunks[i:i + 2]) for i in range(1, len(chunks), 2)]
+    return chunks
+
+
+@pytest.mark.parametrize('version', [1, 2, 3])
+@pytest.mark.parametrize('cipher_name', ['ChaCha20Poly1305', 'AES256GCM'])
+def test_seal(cipher_name, version):
+    cipher = make_cipher(cipher_name)
+    buffers = [b'read-only', bytearray(b'writable'), memoryview(b'')]
+    message, unsealed = framing.unseal(cipher, b''.join(_seal(cipher, b'message', buffers, version)), version)
+    assert message == b'message'
+    assert unsealed == [b'read-only', bytearray(b'writable'), b'']
+    assert [type(buffer) for buffer in unsealed] == [bytes, bytearray, bytes]
+
+
+@pytest.mark.parametrize('version', [2, 3])
+def test_seal_in_chunks(monkeypatch, version):
+    monkeypatch.setattr(framing, 'CHUNK_SIZE', 4)
+    cipher = make_cipher('ChaCha20Poly1305')
+    buffers = [bytes(range(10)), bytearray(range(7))]
+    chunks = _seal(cipher, b'message', buffers, version)
+    assert len(chunks) == 1 + 3 + 2
+    unsealer = framing.Unsealer(cipher, version)
+    for byte in b''.join(chunks):
+        unsealer.feed(bytes([byte]))
+    assert unsealer.result() == (b'message', buffers)
+    assert [type(buffer) for buffer in unsealer.result()[1]] == [bytes, bytearray]
+    with pytest.raises(InvalidTag):
+        framing.unseal(cipher, b''.join(chunks[:1] + chunks[2:3] + chunks[1:2] + chunks[3:]), version)
+
+
+@pytest.mark.parametrize('version', [2, 3])
+def test_unseal_into_sink(monkeypatch, version):
+    monkeypatch.setattr(framing, 'CHUNK_SIZE', 4)
+    cipher = make_cipher('ChaCha20Poly1305')
+    buffers = [bytes(range(10)), bytearray(range(7))]
+    received = []
+    unsealer = framing.Unsealer(cipher, version, sink=lambda chunk: received.append(bytes(chunk)))
+    unsealer.feed(b''.join(_seal(cipher, b'message', buffers, version)))
+    assert unsealer.result() == (b'message', [b'', b''])
+    assert received == [bytes(range(4)), bytes(range(4, 8)), bytes(range(8, 10)), bytes(range(4)), bytes(range(4, 7))]
+
+
+@pytest.mark.parametrize('codec_name', compression.names())
+def test_seal_compressed(monkeypatch, codec_name):
+    monkeypatch.setattr(framing, 'CHUNK_SIZE', 2**14)
+    cipher = make_cipher('ChaCha20Poly1305')
+    codec = compression.get(codec_name)
+    message = b'message ' * 1000
+    text, noise = b'line of a log\n' * 10000, os.urandom(2**16)
+    chunks = _seal(cipher, message, [text, noise, b'short'], codec=codec)
+    assert len(b''.join(chunks)) < len(noise) + len(text) / 2
+    unsealer = framing.Unsealer(cipher)
+    unsealer.feed(b''.join(chunks))
+    assert unsealer.result() == (message, [text, noise, b'short']) and unsealer.codec is codec
+    # Flipping the compressed flag of a chunk is detected.
+    sealed = bytearray(b''.join(chunks))
+    sealed[len(chunks[0])] ^= 0x80
+    with pytest.raises((InvalidTag, ValueError)):
+        framing.unseal(cipher, sealed)
+
+
+def test_seal_tampered():
+    cipher = make_cipher('AES256GCM')
+    chunks = _seal(cipher, b'message', [b'first', b'other'])
+    with pytest.raises(InvalidTag):
+        framing.unseal(cipher, b''.join(chunks[:1] + chunks[:0:-1]))
+    other_chunks = _seal(cipher, b'message', [b'first', b'other'])
+    with pytest.raises(InvalidTag):
+        framing.unseal(cipher, b''.join(chunks[:2] + other_chunks[2:]))
+    with pytest.raises(ValueError):
+        framing.unseal(cipher, b''.join(chunks[:2]))
+    with pytest.raises(ValueError):
+        framing.unseal(cipher, b''.join(chunks) + b'x')
+
+
+def test_unseal_huge_header():
+    cipher = make_cipher('AES256GCM')
+    chunks = _seal(cipher, b'message', [])
+    with pytest.raises(ValueError):
+        framing.Unsealer(cipher, framing.VERSION, max_header_size=len(chunks[0]) - 5).feed(chunks[0][:4])
+    # The memory of the header isn't allocated before it arrives.
+    unsealer = framing.Unsealer(cipher, framing.VERSION)
+    unsealer.feed(framing._SIZE.pack(framing.MAX_HEADER_SIZE) + b'head')
+    assert len(unsealer._staging) == 4
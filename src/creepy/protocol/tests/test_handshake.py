@@ -0,0 +1,117 @@
+import sys
+import json
+import subprocess
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+from creepy.protocol import HandshakeProtocol, benchmark, make_cipher
+
+
+def _issue_ticket(handshake, cipher):
+    return bytes.fromhex(json.loads(handshake._dump_info({}, cipher))['ticket'])
+
+
+def _resume(handshake, ticket, cipher, session_id=b'\0\0\0\1'):
+    requests = []
+
+    def public_channel(endpoint, data):
+        requests.append(data)
+        _, response = handshake.resume_bob(data, session_id, {'version': 1})
+        return response
+
+    return HandshakeProtocol.resume_alice(ticket, cipher, public_channel), requests[0]
+
+
+def test_session_resumption():
+    handshake = HandshakeProtocol()
+    cipher = make_cipher(HandshakeProtocol.TRANSPORT_CIPHER_NAME)
+    ticket = _issue_ticket(handshake, cipher)
+    (session_id, cipher_name, cipher_key, info), request = _resume(handshake, ticket, cipher)
+    assert session_id == b'\0\0\0\1' and info['version'] == 1
+    with pytest.raises(ValueError):
+        handshake.resume_bob(request, b'\0\0\0\2', {})
+    new_cipher = make_cipher(cipher_name, cipher_key)
+    assert _resume(handshake, bytes.fromhex(info['ticket']), new_cipher)[0][0] == b'\0\0\0\1'
+
+
+def test_ticket_of_another_server_is_rejected():
+    cipher = make_cipher(HandshakeProtocol.TRANSPORT_CIPHER_NAME)
+    ticket = _issue_ticket(HandshakeProtocol(), cipher)
+    with pytest.raises(ValueError):
+        _resume(HandshakeProtocol(), ticket, cipher)
+
+
+def _authorized_server(tmpdir, *keys, ciphers=None, offer_ciphers=True):
+    path = tmpdir / 'authorized_keys'
+    with open(path, 'wb') as f:
+        for key in keys:
+            f.write(key.public_key().public_bytes(serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH))
+            f.write(b'\n')
+    handshake = HandshakeProtocol(str(path), ciphers)
+    endpoints = []
+
+    def public_channel(endpoint, data=None):
+        endpoints.append(endpoint)
+        if endpoint == '/salt':
+            return handshake.salt
+        bob = handshake.who_r_u(data)
+        params = dict(param.split('=') for param in endpoint.partition('?')[2].split('&') if param)
+        ciphers = params['ciphers'].split(',') if 'ciphers' in params and offer_ciphers else None
+        return handshake.hi_bob(bob, b'\0\0\0\1', {'version': 1} if 'info' in params else None, ciphers)[1]
+
+    return public_channel, endpoints
+
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_rsa_handshake(tmpdir, version):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_channel, endpoints = _authorized_server(tmpdir, private_key)
+    session_id, cipher_name, cipher_key, info = HandshakeProtocol.hi_alice(private_key, public_channel, version)
+    assert session_id == b'\0\0\0\1' and info['version'] == 1 and 'ticket' in info
+    assert len(endpoints) == 2 - version
+
+
+def test_ed25519_handshake(tmpdir):
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    public_channel, _ = _authorized_server(tmpdir, private_key)
+    session_id, *_ = HandshakeProtocol.hi_alice(private_key, public_channel)
+    assert session_id == b'\0\0\0\1'
+    with pytest.raises(ValueError):
+        HandshakeProtocol.hi_alice(ed25519.Ed25519PrivateKey.generate(), public_channel)
+    # Old servers encrypt the session key with the key of the client.
+    with pytest.raises(ValueError, match='RSA'):
+        HandshakeProtocol.hi_alice(private_key, public_channel, version=0)
+
+
+@pytest.mark.parametrize('client_ciphers, server_ciphers, expected', [
+    (['AES256GCM96', 'ChaChaPoly'], ['ChaChaPoly', 'AES256GCM96'], 'ChaChaPoly'),
+    (['AES256GCM96', 'ChaChaPoly'], ['AES256GCM96', 'ChaChaPoly'], 'AES256GCM96'),
+    (['ChaChaPoly'], ['AES256GCM96', 'ChaChaPoly'], 'ChaChaPoly'),
+    (['Unknown'], ['AES256GCM96'], HandshakeProtocol.TRANSPORT_CIPHER_NAME),
+])
+def test_cipher_negotiation(tmpdir, client_ciphers, server_ciphers, expected):
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    public_channel, _ = _authorized_server(tmpdir, private_key, ciphers=server_ciphers)
+    _, cipher_name, *_ = HandshakeProtocol.hi_alice(private_key, public_channel, ciphers=client_ciphers)
+    assert cipher_name == expected
+
+
+def test_server_ignoring_cipher_offer(tmpdir):
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    public_channel, _ = _authorized_server(tmpdir, private_key, offer_ciphers=False)
+    session_id, cipher_name, *_ = HandshakeProtocol.hi_alice(private_key, public_channel)
+    assert session_id == b'\0\0\0\1' and cipher_name == HandshakeProtocol.TRANSPORT_CIPHER_NAME
+
+
+def test_ciphers_are_measured_on_first_handshake(monkeypatch):
+    calls = []
+    monkeypatch.setattr(benchmark, 'ranking', lambda: calls.append(1) or ['ChaChaPoly'])
+    handshake = HandshakeProtocol()
+    assert calls == []
+    _issue_ticket(handshake, make_cipher(HandshakeProtocol.TRANSPORT_CIPHER_NAME))
+    assert handshake.ciphers == ['ChaChaPoly'] and calls == [1]
+    # The server made at import doesn't measure them either.
+    code = 'import creepy; from creepy.protocol import benchmark; assert benchmark._ranking is None'
+    subprocess.run([sys.executable, '-c', code], check=True)
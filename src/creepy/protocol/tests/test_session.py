@@ -0,0 +1,75 @@
+import pytest
+
+from creepy.protocol import QuotaExceededError, Scope, Session
+from creepy.protocol.constants import CLIENT_ID_BASE, NONCE_WINDOW_SIZE, REPLY_CACHE_BYTES, REPLY_CACHE_SIZE
+from creepy.protocol.session import approximate_size
+
+
+def test_nonces_are_accepted_once_in_any_order():
+    session = Session(cipher=None)
+    for nonce in [1, 0, 3, 2]:
+        assert session.accept_nonce(nonce)
+    for nonce in [0, 1, 2, 3]:
+        assert not session.accept_nonce(nonce)
+
+
+def test_nonces_behind_window_are_rejected():
+    session = Session(cipher=None)
+    assert session.accept_nonce(0)
+    assert session.accept_nonce(NONCE_WINDOW_SIZE)
+    assert not session.accept_nonce(0)
+    assert session.accept_nonce(1)
+    assert session.accept_nonce(2**63)
+    assert not session.accept_nonce(NONCE_WINDOW_SIZE)
+
+
+def test_reply_cache_is_bounded():
+    session = Session(cipher=None)
+    for nonce in range(REPLY_CACHE_SIZE + 1):
+        session.remember_reply(nonce, str(nonce), 1)
+    assert session.cached_reply(0) is None and session.cached_reply(REPLY_CACHE_SIZE) == str(REPLY_CACHE_SIZE)
+    session.remember_reply(-1, 'too large', REPLY_CACHE_BYTES + 1)
+    assert session.cached_reply(-1) is None
+    session.remember_reply(-2, 'large', REPLY_CACHE_BYTES)
+    assert list(session.replies) == [-2] and session.replies_size == REPLY_CACHE_BYTES
+
+
+def test_approximate_size_extrapolates_samples():
+    assert approximate_size(bytes(2**20)) >= 2**20
+    assert 2**20 <= approximate_size([bytes(2**10) for _ in range(2**10)]) < 2**21
+    assert approximate_size({i: bytes(2**10) for i in range(2**10)}) >= 2**20
+
+
+def test_scope_quotas():
+    scope = Scope(max_objects=2, max_bytes=2**20 + 2**9)
+    a = scope.put(bytes(2**19))
+    scope.put(None, CLIENT_ID_BASE)
+    with pytest.raises(QuotaExceededError):
+        scope.put(None)
+    scope.put(bytes(2**19), CLIENT_ID_BASE)
+    with pytest.raises(QuotaExceededError):
+        scope.put(bytes(2**19 + 2**9), CLIENT_ID_BASE)
+    scope.pop(a)
+    scope.pop(CLIENT_ID_BASE)
+    assert len(scope) == 0 and scope.size == 0
+
+
+def test_scope_quota_counts_growth_replies_and_functions():
+    scope = Scope(max_bytes=2**20)
+    items = []
+    id = scope.put(items)
+    items.extend(bytes(2**10) for _ in range(2**11))
+    with pytest.raises(QuotaExceededError):
+        scope.remeasure(id)
+    items.clear()
+    scope.remeasure(id)
+    size = scope.size
+    scope.put_function(b'key', len, 2**10)
+    with pytest.raises(QuotaExceededError):
+        scope.put_function(b'other', len, 2**20)
+    session = Session(cipher=None, scope=scope)
+    assert session.remember_reply(0, 'reply', 2**10) == 2**10
+    assert scope.size == size + 2**11
+    # Replies which don't fit into the quota aren't kept.
+    assert session.remember_reply(1, 'large', 2**20) == -2**10 and len(session.replies) == 0
+    assert scope.size == size + 2**10
@@ -1,17 +1,33 @@
 import os
 import re
+import time
+import socket
 import logging
+import weakref
+import threading
+import itertools
+import collections
+import dataclasses
+import urllib3
 import requests
 import warnings
 import importlib
+import pickle as std_pickle
 from typing import Tuple
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
 
+from ..agent import load_agent_key
 from ..serialization import load_private_key
-from ..protocol import make_cipher, HandshakeProtocol
-from ..protocol.constants import NONCE_SIZE
-from . import pickle
-from .proxy import ProxyObject, VersionQuery, DownloadQuery, DelQuery, proxy_flags
+from ..protocol import make_cipher, framing, HandshakeProtocol
+from ..protocol.compression import get as get_compression
+from ..protocol.constants import NONCE_SIZE, CLIENT_ID_BASE, OOB_PICKLE_PROTOCOL, VOID_ID
+from . import codec, pickle
+from .stats import QueryStats, RoundTripDetector
+from .proxy import ProxyObject, VersionQuery, BatchQuery, DownloadQuery, DelQuery, GetattrQuery, GetattrsQuery, \
+    CallQuery, MethodCallQuery, NextQuery, RunQuery, StreamQuery, SyncQuery, proxy_flags, _call_method, \
+    _dump_function, _make_result, _make_value
 
 
 logger = logging.getLogger('creepy')
@@ -41,13 +57,255 @@ def unproxy(*objs):
     return res[0] if len(res) == 1 else res
 
 
-def _make_request(url, data=None, **kwargs):
-    response = requests.post(url, data, **kwargs)
+def prefetch(obj, names):
+    """
+    Get attributes `names` of `obj` in one request.
+
+    If the attribute cache of the remote is enabled and `obj` is cacheable, the attributes are cached.
+    """
+    if isinstance(obj, ProxyObject):
+        return obj._remote._prefetch(obj, names)
+    return [getattr(obj, name) for name in names]
+
+
+def iterate(obj, batch_size=1024, max_bytes=2**20, download=True):
+    """
+    Iterate over `obj` getting up to `batch_size` items per request.
+
+    If `download` is set, items are returned by value and a batch is also limited by `max_bytes` of pickled items,
+    otherwise items are proxies. The next batch is requested in the background while a batch is consumed, so the
+    remote iterator may be advanced by a batch more than the items consumed.
+    """
+    if isinstance(obj, ProxyObject):
+        return obj._remote._iterate(obj, batch_size, max_bytes, download)
+    return iter(obj)
+
+
+def sync(obj):
+    """
+    Get the object behind a proxy like `unproxy()`, receiving only what has changed since the last sync of the proxy.
+
+    Lists and bytearrays which are only appended to and dicts are updated in place, so the same local object is
+    returned each time and it mustn't be changed. Other objects are received whole.
+    """
+    if isinstance(obj, ProxyObject):
+        return obj._remote._sync(obj)
+    return obj
+
+
+def download(obj, out, pickled=False):
+    """
+    Write the data of a bytes-like remote object, or the object pickled if `pickled` is set, to `out` without holding
+    it in memory and return the number of bytes written.
+
+    `out` is a binary file or a function which is called with each chunk of the data as it arrives.
+    """
+    write = out if callable(out) else out.write
+    if isinstance(obj, ProxyObject):
+        return obj._remote._download(obj, write, pickled)
+    data = memoryview(std_pickle.dumps(obj, OOB_PICKLE_PROTOCOL) if pickled else obj).cast('B')
+    write(data)
+    return data.nbytes
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    socket_options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _make_http_session(pool_size=DEFAULT_POOLSIZE):
+    """Make an HTTP session which keeps up to `pool_size` connections alive."""
+    session = requests.Session()
+    adapter = _KeepAliveAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class _Chunks:
+    """
+    Request body of bytes-like chunks of `size` bytes in total, which are sent one by one as they are produced.
+    """
+
+    def __init__(self, chunks, size):
+        self._chunks = chunks
+        self._size = size
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def __len__(self):
+        return self._size
+
+
+def _make_request(url, data=None, http=requests, **kwargs):
+    response = http.post(url, data, **kwargs)
+    return _check_content(url, response)
+
+
+def _check_content(url, response):
     if response.status_code == 200:
         return response.content
     raise RuntimeError(f'{url}: {response.content}')
 
 
+def _make_sealed_request(url, data, cipher, version, http, stats, sink=None, **kwargs):
+    """
+    Make a request like `_make_request`, but decrypt the sealed message of the response as it arrives.
+
+    Return the message and the list of its out-of-band buffers. Received bytes and time of decryption are added to
+    `stats`. If `sink` is passed, chunks of the buffers are passed to it instead, see `framing.Unsealer`.
+    """
+    response = http.post(url, data, stream=True, **kwargs)
+    if response.status_code != 200:
+        return _check_content(url, response)
+    unsealer = framing.Unsealer(cipher, version, sink)
+    while True:
+        piece = response.raw.read(framing.CHUNK_SIZE)
+        if len(piece) == 0:
+            break
+        start = time.perf_counter()
+        stats.bytes_received += len(piece)
+        unsealer.feed(piece)
+        unsealer.wait(framing.MAX_PENDING_CHUNKS)
+        stats.encryption += time.perf_counter() - start
+    response.raw.release_conn()
+    if not unsealer.complete:
+        raise ConnectionError(f'{url}: response is truncated')
+    return unsealer.result()
+
+
+VOID_FLUSH_BYTES = 2**24
+# Deleted ids are sent in the background once there are this many of them or the oldest one waits for this many
+# seconds.
+DEL_FLUSH_COUNT = 1024
+DEL_FLUSH_DELAY = 1.0
+# Delay before the first retry of a failed request in seconds, it doubles with each retry.
+RETRY_BACKOFF = 0.1
+# Errors after which a request may be retried, the server answers a retried request without running it again.
+_TRANSIENT_ERRORS = (ConnectionError, requests.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                     urllib3.exceptions.HTTPError)
+# Errors after which the server may be still running the request, it isn't retried not to wait for it again.
+_READ_TIMEOUT_ERRORS = (requests.ReadTimeout, urllib3.exceptions.ReadTimeoutError)
+# Queries whose result is discarded by the server if their `out` is `VOID_ID`.
+_VOIDABLE_QUERIES = (GetattrQuery, CallQuery, MethodCallQuery, RunQuery)
+
+
+def _query_ids(query):
+    """Ids of the objects which a queued query uses or makes."""
+    return [id for id in (getattr(query, 'id', None), getattr(query, 'out', None)) if id is not None and id > 0]
+
+
+def _payload_size(query):
+    """Estimate size of the data passed by `query`, only strings and bytes-like arguments are counted."""
+    values = [getattr(query, 'value', None)]
+    values.extend(getattr(query, 'args', ()))
+    values.extend(getattr(query, 'kwargs', {}).values())
+    size = 0
+    for value in values:
+        if isinstance(value, (str, bytes, bytearray)):
+            size += len(value)
+        elif isinstance(value, memoryview):
+            size += value.nbytes
+    return size
+
+
+def _request_kind(query, queue, deleted):
+    if len(query) > 0:
+        return query[0].__class__.__name__
+    if len(queue) > 0:
+        return 'BatchQuery'
+    return 'DelQuery' if len(deleted) > 0 else 'Heartbeat'
+
+
+class _Memoized:
+    """
+    Remote function whose downloaded results are cached on the client, see `Remote.memoize`.
+
+    `hits` and `misses` count the calls answered from the cache and the ones sent to the server.
+    """
+
+    def __init__(self, fn, maxsize, ttl):
+        self.fn = fn
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Results, their expiration times and proxies their keys refer to, least recently used first.
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        try:
+            key, proxies = self._key(args, kwargs)
+        except Exception:  # e.g. unpicklable arguments, the call isn't cached
+            key = None
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        if isinstance(self.fn, ProxyObject):
+            value = _call_method(self.fn, '__call__', args, kwargs, download=True)
+        else:
+            value = unproxy(self.fn(*args, **kwargs))
+        if key is not None:
+            with self._lock:
+                self._cache[key] = value, time.monotonic() + self.ttl if self.ttl is not None else None, proxies
+                self._cache.move_to_end(key)
+                while self.maxsize is not None and len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._cache)
+
+    def invalidate(self, *args, **kwargs):
+        """
+        Drop the cached result of the call with arguments `args` and `kwargs`.
+        """
+        key, _ = self._key(args, kwargs)
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self):
+        """
+        Drop all cached results.
+        """
+        with self._lock:
+            self._cache.clear()
+
+    @staticmethod
+    def _key(args, kwargs):
+        return pickle.dumps_key((args, sorted(kwargs.items())))
+
+    def _lookup(self, key):
+        entry = self._cache.get(key) if key is not None else None
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry
+
+
+def _apply_delta(value, delta):
+    """Update a local copy `value` of a list, a bytearray or a dict with `delta` got by `SyncQuery`."""
+    if isinstance(value, dict):
+        changed, removed = delta
+        value.update(changed)
+        for key in removed:
+            del value[key]
+    else:
+        value += delta
+    return value
+
+
 class _Local:
     def __init__(self):
         self.os = os
@@ -61,39 +319,126 @@ class _Local:
     def import_module(self, name):
         return importlib.import_module(name)
 
+    def run(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def void(self):
+        return nullcontext()
+
+    def memoize(self, fn, maxsize=128, ttl=None):
+        return _Memoized(fn, maxsize, ttl)
+
+    def uncompressed(self):
+        return nullcontext()
+
+    def flush(self):
+        pass
+
     @property
     def open(self):
         return open
 
 
+class _ThreadState(threading.local):
+    """Queries deferred by a thread and whether it is inside `Remote.void()` or `Remote.uncompressed()`."""
+
+    def __init__(self):
+        self.queue = []
+        self.queued_bytes = 0
+        self.void = False
+        self.compress = True
+
+
 class Remote:
-    def __init__(self, url, session_id, cipher, *, request_timeout=None):
+    """
+    Connection to a creepy server.
+
+    A remote can be shared by threads, up to `max_in_flight` requests are sent concurrently if the server supports
+    it. Queries deferred in pipeline mode or inside `void()` are sent by the thread which made them.
+
+    Large buffers, like bytes and arrays, are passed out-of-band if the server supports it: they are encrypted
+    separately and never copied into the pickled data. If `compression` codec is set, requests and responses which
+    are worth it are compressed, see `uncompressed()`.
+
+    Requests failed due to network errors are retried up to `retries` times if the server supports it, it answers a
+    retried request with the response it has sent without running the queries again.
+
+    Ids of deleted proxies are sent in the background, unless a thread has queued queries which could use them. If
+    the server session expires after `lease` seconds without requests, a request is sent when the remote is idle
+    for a third of it.
+    """
+
+    def __init__(self, url, session_id, cipher, *, request_timeout=None, pipeline=False, inline_limit=0,
+                 attr_cache=False, http_session=None, max_in_flight=DEFAULT_POOLSIZE, version=None, compression=None,
+                 retries=3, lease=None):
         self._url = url
+        self._http = http_session if http_session is not None else _make_http_session()
         self._session_id = session_id
         self._cipher = cipher
         self._nonce = 0
         self._imports = {}
+        self._functions = set()
         self._del_queue = []
+        # Monotonic time when the oldest id in the delete queue was deleted.
+        self._deleted_at = None
+        # Number of queued queries of all threads using or making each id, deletions of these ids wait for them.
+        self._queued_ids = collections.Counter()
+        self._last_request = time.monotonic()
+        self._wakeup = threading.Event()
+        self._local = _ThreadState()
+        self._lock = threading.RLock()
+        self._in_flight = threading.BoundedSemaphore(1)
+        self._next_id = CLIENT_ID_BASE
+        self._pipeline = False
+        self._inline_limit = inline_limit
+        self._attr_cache = {} if attr_cache else None
+        # Versions and local copies of synced objects by their ids.
+        self._synced = {}
+        self._stats = {}
+        self._detector = RoundTripDetector()
+        # Optional function which is passed the kind of each request and returns a context manager wrapping it, e.g.
+        # a tracing span.
+        self.tracer = None
         self._post_kwargs = {}
         if request_timeout is not None:
             self._post_kwargs['timeout'] = request_timeout
-        try:
-            self._version = self._post(VersionQuery())
-        except Exception:
-            self._version = 0
+        self._framing = 0
+        self._codec = False
+        self._compression = None
+        self._retries = 0
+        self._version = version
+        if version is None:
+            try:
+                self._version = self._post(VersionQuery())
+            except Exception:
+                self._version = 0
+        if self._version >= 8:
+            self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        # Version of framing of out-of-band buffers, 0 if the server doesn't support them.
+        self._framing = 3 if self._version >= 13 else 2 if self._version >= 12 else 1 if self._version >= 10 else 0
+        self._codec = self._version >= 11
+        self._compression = get_compression(compression) if self._framing >= 3 else None
+        self._retries = retries if self._version >= 14 else 0
+        self.pipeline = pipeline
+        threading.Thread(target=_flush_in_background, args=(weakref.ref(self), self._wakeup, lease and lease / 3),
+                         name='creepy-flusher', daemon=True).start()
 
     def disconnect(self):
         if self._url is None:
             return
-        self._del_queue.append(0)
+        self._lazy_delete(0)
         try:
             self._post()
         finally:
             self._url = None
+            self._wakeup.set()
             self._session_id = None
             self._cipher = None
             self._nonce = None
             self._imports = None
+            self._attr_cache = None
+            self._synced = {}
+            self._http.close()
 
     def path(self, path: str):
         return (self, path)
@@ -101,6 +446,90 @@ class Remote:
     def __repr__(self):
         return self._url
 
+    @property
+    def pipeline(self):
+        """
+        Whether attribute lookups and calls are queued instead of being sent immediately.
+
+        In pipeline mode the client assigns scope ids to the results itself, so queued queries can refer to each other
+        and are sent together with the next query which needs a real value (e.g. `ProxyObject._get()`, `bool()`,
+        `repr()` or `unproxy()`). Errors of queued queries are raised by that query.
+        """
+        return self._pipeline
+
+    @pipeline.setter
+    def pipeline(self, value):
+        if value and self._version < 3:
+            raise RuntimeError(f'{self._url}: server version {self._version} does not support pipelining')
+        self._pipeline = bool(value)
+
+    @property
+    def _void(self):
+        return self._local.void
+
+    @_void.setter
+    def _void(self, value):
+        self._local.void = value
+
+    @contextmanager
+    def void(self):
+        """
+        Discard results of calls and attribute assignments made inside the context.
+
+        Such calls return proxies right away and, like deletions of proxies, are sent with the next request, e.g.
+        `ProxyObject._get()` or `Remote.flush()`, or on leaving the outermost `void()` context, which also raises
+        their errors. Results whose proxies are deleted
+        by then, e.g. of `f.write(data)`, aren't stored on the server. Operations which need a value, e.g. `len()`,
+        `bool()` or `__exit__`, flush the queued calls and return it as usual. Queued calls are sent earlier if their
+        arguments take more than `VOID_FLUSH_BYTES`.
+        """
+        if self._version < 5:
+            raise RuntimeError(f'{self._url}: server version {self._version} does not support void calls')
+        void, self._void = self._void, True
+        try:
+            yield
+        finally:
+            self._void = void
+        if not void:
+            self.flush()
+
+    @contextmanager
+    def uncompressed(self):
+        """
+        Send queries made inside the context and receive their results without compression.
+
+        Use it for data mixing secrets with what others can affect, as the size of compressed data leaks its content.
+        Queries deferred inside the context are sent on exit.
+        """
+        compress, self._local.compress = self._local.compress, False
+        try:
+            yield
+            self.flush()
+        finally:
+            self._local.compress = compress
+
+    def flush(self):
+        """
+        Send queued queries.
+        """
+        if len(self._local.queue) > 0:
+            self._post()
+
+    def clear_attr_cache(self, obj=None):
+        """
+        Forget cached attributes of `obj` or of all objects if it isn't specified.
+
+        Attributes of modules, classes and frozen dataclasses are cached if the remote is created with `attr_cache`
+        set. The cache is cleared on assignment or deletion of an attribute via a proxy, but not when an object is
+        changed on the server by other means.
+        """
+        if self._attr_cache is None:
+            return
+        if obj is None:
+            self._attr_cache.clear()
+        else:
+            self._attr_cache.pop(obj._id, None)
+
     # TODO(Roman Rizvanov): Impelement [named] scopes instead of misleading globals() function.
     @property
     def globals(self):
@@ -111,39 +540,334 @@ class Remote:
     def import_module(self, name):
         module = self._imports.get(name, None)
         if module is None:
-            self._imports[name] = module = self.globals.__import__(name)
+            void, self._void = self._void, False  # the module is needed even inside `void()`
+            try:
+                module = self.globals.__import__(name)
+                if self._pipeline:
+                    # The import is queued and never runs if a preceding query fails, so it's sent before the module
+                    # is cached.
+                    self.flush()
+            finally:
+                self._void = void
+            self._imports[name] = module
         return module
 
     @property
     def open(self):
         return self.globals.open
 
+    def run(self, fn, *args, **kwargs):
+        """
+        Run function `fn` on the server in one query and return its result.
+
+        The function's code is sent only once per connection. It must not be a closure and can use only builtins,
+        modules bound to its global names and its arguments, which can be proxies of this remote.
+        """
+        if self._version < 4:
+            raise RuntimeError(f'{self._url}: server version {self._version} does not support running functions')
+        key, data = _dump_function(fn)
+        if key in self._functions:
+            data = None
+        res = _make_result(self, RunQuery(key, data, args, kwargs))
+        # Other threads send the code too until it's known to be cached on the server.
+        self._functions.add(key)
+        return res
+
     @property
     def os(self):
         return self.import_module('os')
 
     def _make_del_query(self):
         res = None
-        if len(self._del_queue) > 0:
-            res = DelQuery(self._del_queue)
-            self._del_queue = []
+        with self._lock:
+            if len(self._del_queue) > 0:
+                res = DelQuery(self._del_queue)
+                self._del_queue = []
         return res
 
-    def _post(self, *query):
+    def _new_id(self):
+        with self._lock:
+            id = self._next_id
+            self._next_id += 1
+        return id
+
+    def _defer(self, query, out=None):
+        if out is None:
+            out = self._new_id()
+        query.out = out
+        self._enqueue(query)
+        return out
+
+    def _enqueue(self, query):
+        local = self._local
+        with self._lock:
+            self._queued_ids.update(_query_ids(query))
+        local.queue.append(query)
+        local.queued_bytes += _payload_size(query)
+        if local.queued_bytes > VOID_FLUSH_BYTES:
+            self._post()
+
+    def _take_queue(self):
+        """
+        Pop queued queries replacing `GetattrQuery` followed by `CallQuery` of its result with `MethodCallQuery` when
+        the proxy of the bound method is already deleted and nothing else refers to it.
+
+        Results of other queries whose proxies are already deleted and unused are discarded by the server instead of
+        being stored and deleted.
+        """
+        local = self._local
+        queue, local.queue = local.queue, []
+        local.queued_bytes = 0
+        for query in queue:
+            for id in _query_ids(query):
+                self._queued_ids[id] -= 1
+                if self._queued_ids[id] == 0:
+                    del self._queued_ids[id]
+        deleted = set(self._del_queue)
+        # `RunQuery` refers to no object.
+        uses = collections.Counter(getattr(query, 'id', None) for query in queue)
+        res = []
+        unstored = set()
+        for query in queue:
+            prev = res[-1] if len(res) > 0 else None
+            if query.__class__ is CallQuery and prev.__class__ is GetattrQuery and prev.out == query.id and \
+                    query.id in deleted and uses[query.id] == 1:
+                res[-1] = MethodCallQuery(prev.id, prev.name, query.args, query.kwargs, out=query.out)
+                unstored.add(query.id)
+            else:
+                res.append(query)
+        for query in res:
+            if query.__class__ in _VOIDABLE_QUERIES and query.out in deleted and uses[query.out] == 0:
+                unstored.add(query.out)
+                query.out = VOID_ID
+        if len(unstored) > 0:
+            self._del_queue = [id for id in self._del_queue if id not in unstored]
+        return res
+
+    @property
+    def stats(self):
+        """
+        Counters of requests by their kind, see `QueryStats`.
+
+        The kind of a request is the class name of its query, 'BatchQuery' for a request with only queued queries,
+        'DelQuery' for the one with only deleted ids and 'Heartbeat' for an empty one.
+        """
+        with self._lock:
+            return {kind: dataclasses.replace(stats) for kind, stats in self._stats.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+    def _post(self, *query, deletes=True, sink=None, detect=True):
         query = list(query)
-        if len(self._del_queue) > 0:
-            query.append(DelQuery(self._del_queue))
-            self._del_queue = []
-        data = self._nonce.to_bytes(NONCE_SIZE, 'big') + pickle.dumps(*query)
-        self._nonce += 1
-        response = _make_request(self._url, self._session_id + self._cipher.encrypt(data), **self._post_kwargs)
-        res = pickle.loads(self._cipher.decrypt(response))
+        if len(query) > 0 and detect:
+            self._detector.observe((query[0].__class__.__name__, getattr(query[0], 'name', None)))
+        stats = QueryStats(requests=1)
+        with self._in_flight:
+            # With a single request in flight nonces reach the server in order, as old servers require.
+            with self._lock:
+                queue = self._take_queue() if len(self._local.queue) > 0 else []
+                deleted = []
+                if deletes:
+                    deleted = self._take_deletable()
+                nonce = self._nonce
+                self._nonce += 1
+            kind = _request_kind(query, queue, deleted)
+            with self.tracer(kind) if self.tracer is not None else nullcontext():
+                message, buffers = self._request(query, queue, deleted, nonce, stats, sink)
+        start = time.perf_counter()
+        try:
+            res = pickle.loads(message, buffers=buffers)
+        finally:
+            stats.serialization += time.perf_counter() - start
+            with self._lock:
+                self._stats.setdefault(kind, QueryStats()).add(stats)
         if isinstance(res, Exception):
+            # A function could be not cached if a query preceding its `RunQuery` failed, so ship it again.
+            self._functions.clear()
             raise res
         return res
 
+    def _request(self, query, queue, deleted, nonce, stats, sink):
+        """
+        Send a request with the queries, retrying it on network errors, and return the message and buffers of the
+        response.
+
+        A request whose buffers are passed to `sink` isn't retried, as a part of them may be already consumed.
+        """
+        start = time.perf_counter()
+        data, buffers = self._dump_query(query, queue, deleted)
+        message = nonce.to_bytes(NONCE_SIZE, 'big') + data
+        stats.serialization += time.perf_counter() - start
+        self._last_request = time.monotonic()
+        for attempt in itertools.count():
+            try:
+                return self._send(message, buffers, stats, sink)
+            except _READ_TIMEOUT_ERRORS as e:
+                raise TimeoutError(f'{self._url}: no response within the request timeout, the request was sent and '
+                                   f'its queries may have run') from e
+            except RuntimeError as e:
+                if attempt > 0 and 'Response is not cached' in str(e):
+                    raise RuntimeError(f'{self._url}: the request ran before it was retried, but its response is no '
+                                       f'longer cached') from e
+                raise
+            except _TRANSIENT_ERRORS as e:
+                if attempt >= self._retries or sink is not None:
+                    raise
+                delay = RETRY_BACKOFF * 2**attempt
+                logger.warning(f'{self._url}: request failed, retrying in {delay:.1f}s: {e!r}')
+                time.sleep(delay)
+
+    def _send(self, message, buffers, stats, sink=None):
+        """
+        Send a request with `message` and out-of-band `buffers` and return the message and buffers of the response.
+
+        Bytes and times of the request are added to `stats`.
+        """
+        start = time.perf_counter()
+        encryption = stats.encryption
+        try:
+            return self._send_timed(message, buffers, stats, sink)
+        finally:
+            stats.network += time.perf_counter() - start - (stats.encryption - encryption)
+
+    def _send_timed(self, message, buffers, stats, sink):
+        if self._framing == 0:
+            start = time.perf_counter()
+            body = self._session_id + self._cipher.encrypt(message)
+            stats.encryption += time.perf_counter() - start
+            response = _make_request(self._url, body, self._http, **self._post_kwargs)
+            stats.bytes_sent += len(body)
+            stats.bytes_received += len(response)
+            start = time.perf_counter()
+            message = self._cipher.decrypt(response)
+            stats.encryption += time.perf_counter() - start
+            return message, None
+        codec = self._compression if self._local.compress else None
+        size, chunks = framing.seal(self._cipher, message, buffers, self._framing, codec)
+        body = itertools.chain([self._session_id], stats.timed_chunks(chunks))
+        if size is not None:
+            body = _Chunks(body, len(self._session_id) + size)
+        return _make_sealed_request(f'{self._url}?oob={self._framing}', body, self._cipher, self._framing, self._http,
+                                    stats, sink, **self._post_kwargs)
+
+    def _dump_query(self, query, queue, deleted):
+        """
+        Dump `query` preceded by the batch of `queue` and followed by deletion of `deleted` ids.
+
+        Return the data and the list of out-of-band buffers, or None if the server doesn't support them.
+        """
+        if self._codec:
+            buffers = []
+            if len(queue) > 0:
+                # The batch is encoded first, as its buffers are consumed first.
+                query[:1] = [BatchQuery(codec.dumps(queue + query[:1], buffers))]
+            if len(deleted) > 0:
+                query.append(DelQuery(deleted))
+            return codec.dumps(query, buffers), buffers
+        if len(queue) > 0:
+            query[:1] = [BatchQuery(pickle.dumps(*queue, *query[:1]))]
+        if len(deleted) > 0:
+            query.append(DelQuery(deleted))
+        if self._framing > 0:
+            return pickle.dumps_oob(*query)
+        return pickle.dumps(*query), None
+
+    def _take_deletable(self):
+        """
+        Pop deleted ids which no queued query of another thread uses or makes, these are sent by the thread later.
+
+        The session itself, id 0, is deleted anyway.
+        """
+        queued = self._queued_ids
+        res = [id for id in self._del_queue if id == 0 or id not in queued]
+        if len(res) < len(self._del_queue):
+            self._del_queue = [id for id in self._del_queue if id != 0 and id in queued]
+        else:
+            self._del_queue, self._deleted_at = [], None
+        return res
+
     def _lazy_delete(self, id):
-        self._del_queue.append(id)
+        if self._attr_cache is not None:
+            self._attr_cache.pop(id, None)
+        with self._lock:
+            self._synced.pop(id, None)
+            if len(self._del_queue) == 0:
+                self._deleted_at = time.monotonic()
+            self._del_queue.append(id)
+            if len(self._del_queue) >= DEL_FLUSH_COUNT:
+                self._wakeup.set()
+
+    def _flush_in_background(self, heartbeat_interval):
+        """
+        Send deleted ids if there are many of them or they wait for long, and a heartbeat if the remote is idle.
+        """
+        now = time.monotonic()
+        with self._lock:
+            # Ids which queued queries refer to are sent later, they don't make a request.
+            deletable = sum(id == 0 or id not in self._queued_ids for id in self._del_queue)
+            deletes = deletable > 0 and (deletable >= DEL_FLUSH_COUNT or now - self._deleted_at >= DEL_FLUSH_DELAY)
+        if deletes or heartbeat_interval is not None and now - self._last_request >= heartbeat_interval:
+            self._post(deletes=deletes)
+
+    def _cached_getattr(self, obj, name):
+        cache = self._attr_cache
+        if cache is None:
+            return _make_result(self, GetattrQuery(obj._id, name))
+        attrs = cache.get(obj._id)
+        if attrs is not None and name in attrs:
+            return attrs[name]
+        value = _make_result(self, GetattrQuery(obj._id, name))
+        # Pipelined and void lookups may never be done if a preceding query fails, so their results aren't cached.
+        if not self._pipeline and not self._void:
+            cache.setdefault(obj._id, {})[name] = value
+        return value
+
+    def _prefetch(self, obj, names):
+        assert obj._remote == self
+        if self._version < 6:
+            return [getattr(obj, name) for name in names]
+        attrs = {}
+        if self._attr_cache is not None and obj._cacheable:
+            attrs = self._attr_cache.setdefault(obj._id, {})
+        missing = [name for name in names if name not in attrs]
+        if len(missing) > 0:
+            results = self._post(GetattrsQuery(obj._id, missing, self._inline_limit))
+            attrs.update(zip(missing, (_make_value(self, result) for result in results)))
+        return [attrs[name] for name in names]
+
+    def _iterate(self, obj, batch_size, max_bytes, download):
+        assert obj._remote == self
+        if self._version < 7:
+            for item in obj:
+                yield unproxy(item) if download else item
+            return
+        it = ProxyObject(self, self._new_id())
+        batch = self._post(NextQuery(obj._id, batch_size, max_bytes, download, self._inline_limit, out=it._id))
+        query = NextQuery(it._id, batch_size, max_bytes, download, self._inline_limit)
+        while True:
+            items, stop = batch
+            # The next batch is on its way while this one is consumed.
+            ahead = _get_executor().submit(self._post, query, detect=False) if stop is None else None
+            try:
+                for item in items:
+                    yield pickle.loads(item) if download else _make_value(self, item)
+            except BaseException:
+                if ahead is not None and not download:
+                    ahead.add_done_callback(self._drop_batch)
+                raise
+            if isinstance(stop, StopIteration):
+                return
+            if stop is not None:
+                raise stop
+            batch = ahead.result()
+
+    def _drop_batch(self, future):
+        """Delete proxies of items of a batch read ahead by `_iterate` which isn't consumed."""
+        if future.exception() is None:
+            for item in future.result()[0]:
+                _make_value(self, item)
 
     def _get(self, *objs: Tuple[ProxyObject]):
         ids = []
@@ -158,36 +882,244 @@ class Remote:
             res = self._post(DownloadQuery(ids=ids))
         return res[0] if len(res) == 1 else res
 
+    def _sync(self, obj):
+        assert obj._remote == self
+        if self._version < 16:
+            return self._get(obj)
+        with self._lock:
+            version, value = self._synced.get(obj._id, (0, None))
+        new_version, is_delta, data = self._post(SyncQuery(obj._id, version))
+        with self._lock:
+            # Another thread may have synced the object meanwhile, then the delta doesn't apply to the local copy.
+            stale = is_delta and self._synced.get(obj._id, (0, None))[0] != version
+            if not stale:
+                value = _apply_delta(value, data) if is_delta else data
+                self._synced[obj._id] = new_version, value
+        return self._sync(obj) if stale else value
+
+    def _download(self, obj, write, pickled):
+        assert obj._remote == self
+        if self._version < 17:
+            return download(self._get(obj), write, pickled)
+        size = 0
+
+        def sink(chunk):
+            nonlocal size
+            write(chunk)
+            size += chunk.nbytes
+
+        res = self._post(StreamQuery(obj._id, pickled), sink=sink)
+        # Small data is sent in the message, otherwise the streamed buffer is empty in it.
+        return size + download(res, write)
+
+    def memoize(self, fn, maxsize=128, ttl=None):
+        """
+        Wrap a remote function `fn` to cache its results on the client.
+
+        Results are downloaded, so they must be picklable, and shared by the calls with the same arguments, so they
+        mustn't be changed. Calls are keyed by their pickled arguments, proxies are keyed by their ids and kept alive
+        while the results are cached.
+
+        Parameters
+        ----------
+        fn: ProxyObject
+            Remote function which returns the same result for the same arguments.
+        maxsize: int, optional
+            Maximum number of cached results, the least recently used ones are evicted. Unbounded if None.
+        ttl: float, optional
+            Seconds after which a cached result expires.
+        """
+        assert not isinstance(fn, ProxyObject) or fn._remote == self
+        return _Memoized(fn, maxsize, ttl)
+
     def download(self, obj: ProxyObject):
         warnings.warn('Deprecated, use ProxyObject._get() instead', category=DeprecationWarning)
         return self._get(obj)
 
 
 @contextmanager
-def connect(url, private_key=None, *, request_timeout=None):
+def connect(url, private_key=None, *, request_timeout=None, pipeline=False, inline_limit=0, attr_cache=False,
+            pool_size=DEFAULT_POOLSIZE, compression=None, retries=3):
+    """
+    Connect to a creepy server.
+
+    The last session with the server is resumed by its ticket if possible, so the private key isn't used.
+
+    Parameters
+    ----------
+    url: str
+        Server address or 'self' for the local node.
+    private_key: optional
+        Private key used for the handshake, the default one is loaded if not specified.
+    request_timeout: float, optional
+        Timeout of a request in seconds.
+    pipeline: bool, optional
+        Queue attribute lookups and calls until a real value is needed, see `Remote.pipeline`.
+    inline_limit: int, optional
+        If positive, results of attribute lookups and calls which are immutable primitives (`None`, `bool`, `int`,
+        `float`, `complex`, `str` and `bytes`) of at most `inline_limit` bytes are returned by value instead of proxies.
+        Use `unproxy()` to handle both.
+    attr_cache: bool, optional
+        Cache attributes of modules, classes and frozen dataclasses on the client, see `Remote.clear_attr_cache`.
+    pool_size: int, optional
+        Maximum number of kept-alive connections to the server, they are shared by the handshake and the queries.
+        It also limits the number of requests which threads sharing the remote send concurrently.
+    compression: str, optional
+        Compress requests and responses which are worth it with 'zlib' or 'lzma' if the server supports it, see
+        `Remote.uncompressed`.
+    retries: int, optional
+        Maximum number of retries of a request failed due to a network error. A request whose response doesn't come
+        within `request_timeout` isn't retried and raises `TimeoutError`.
+    """
     if url == 'self':
         try:
             yield _self_node
         finally:
             return
+    remote = _connect(url, private_key, request_timeout=request_timeout, pipeline=pipeline,
+                      inline_limit=inline_limit, attr_cache=attr_cache, pool_size=pool_size, compression=compression,
+                      retries=retries)
+    if remote is None:
+        return None
+    try:
+        # TODO(Roman Rizvanov): Make Remote class to be contextmanager.
+        yield remote
+    finally:
+        remote.disconnect()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """
+    Get the thread pool which sends requests in the background, e.g. for the next batches of `iterate`.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(DEFAULT_POOLSIZE, thread_name_prefix='creepy')
+        return _executor
+
+
+def _normalize_url(url):
     if not re.search(r'^(\w+)://', url):
         url = 'http://' + url
-    if private_key is None:
-        private_key = load_private_key()
-        if private_key is None:
-            return None
+    return url.rstrip('/')
+
+
+def _connect(url, private_key=None, *, request_timeout=None, pipeline=False, inline_limit=0, attr_cache=False,
+             pool_size=DEFAULT_POOLSIZE, compression=None, retries=3):
+    url = _normalize_url(url)
+    http = _make_http_session(pool_size)
 
     def public_channel(endpoint, data=None):
-        return _make_request(f'{url}{endpoint}', data, timeout=10)
+        return _make_request(f'{url}{endpoint}', data, http, timeout=10)
+
+    try:
+        handshake = _handshake(url, private_key, public_channel)
+        if handshake is None:
+            http.close()
+            return None
+        session_id, cipher, info = handshake
+        if compression is not None and compression not in info.get('compression', ()):
+            logger.warning(f'{url}: server does not support {compression} compression')
+            compression = None
+        remote = Remote(url, session_id, cipher, request_timeout=request_timeout, pipeline=pipeline,
+                        inline_limit=inline_limit, attr_cache=attr_cache, http_session=http,
+                        max_in_flight=pool_size, version=info.get('version'), compression=compression,
+                        retries=retries, lease=info.get('lease'))
+    except BaseException:
+        http.close()
+        raise
+    return remote
+
+
+# Resumption tickets of the last sessions by server url.
+_tickets = {}
+# Urls of servers which support only the handshake of version 0.
+_v0_servers = set()
 
-    session_id, cipher_name, cipher_key = HandshakeProtocol.hi_alice(private_key, public_channel)
+
+def _handshake(url, private_key, public_channel):
+    """
+    Make a session with the server at `url` and return its id, cipher and the server info.
+
+    The last session with the server is resumed without the private key if its ticket is still valid.
+    """
+    res = None
+    ticket = _tickets.get(url)
+    if ticket is not None:
+        try:
+            res = HandshakeProtocol.resume_alice(*ticket, public_channel)
+        except Exception as e:
+            logger.debug(f'{url}: failed to resume the session: {e}')
+            if _tickets.get(url) is ticket:
+                del _tickets[url]
+    if res is None:
+        if private_key is None:
+            private_key = _default_private_key()
+            if private_key is None:
+                return None
+        res = _hi_alice(url, private_key, public_channel)
+    session_id, cipher_name, cipher_key, info = res
     cipher = make_cipher(cipher_name, cipher_key)
+    ticket = info.get('ticket')
+    if ticket is not None:
+        _tickets[url] = bytes.fromhex(ticket), cipher
+    return session_id, cipher, info
+
+
+_private_key = None
+_private_key_lock = threading.Lock()
+
+
+def _default_private_key():
+    """
+    Get the key of the running key agent or else the key which is loaded once per process.
+    """
+    global _private_key
+    key = load_agent_key()
+    if key is not None:
+        return key
+    with _private_key_lock:
+        if _private_key is None:
+            _private_key = load_private_key()
+        return _private_key
+
+
+# Responses of servers which support only the handshake of version 0 to the handshake of version 1.
+_V1_REJECTIONS = ('Unsupported version', 'Invalid message')
+
+
+def _hi_alice(url, private_key, public_channel):
+    if url in _v0_servers:
+        return HandshakeProtocol.hi_alice(private_key, public_channel, version=0)
     try:
-        remote = Remote(url, session_id, cipher, request_timeout=request_timeout)
-        # TODO(Roman Rizvanov): Make Remote class to be contextmanager.
-        yield remote
-    finally:
-        remote.disconnect()
+        return HandshakeProtocol.hi_alice(private_key, public_channel)
+    except RuntimeError as e:
+        if not any(rejection in str(e) for rejection in _V1_REJECTIONS):
+            raise
+        logger.debug(f'{url}: falling back to the handshake of version 0: {e}')
+    res = HandshakeProtocol.hi_alice(private_key, public_channel, version=0)
+    _v0_servers.add(url)
+    return res
+
+
+def _flush_in_background(remote_ref, wakeup, heartbeat_interval):
+    # The thread refers to the remote weakly, so it doesn't keep the remote alive.
+    while True:
+        wakeup.wait(DEL_FLUSH_DELAY)
+        wakeup.clear()
+        remote = remote_ref()
+        if remote is None or remote._url is None:
+            return
+        try:
+            remote._flush_in_background(heartbeat_interval)
+        except Exception as e:
+            logger.debug(f'{remote._url}: background flush failed: {e!r}')
+        del remote
 
 
 _self_node = _Local()
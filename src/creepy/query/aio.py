@@ -0,0 +1,355 @@
+import re
+import time
+import asyncio
+import logging
+import urllib.parse
+from contextlib import asynccontextmanager, nullcontext
+
+from requests.adapters import DEFAULT_POOLSIZE
+
+from ..protocol import framing
+from ..protocol.constants import NONCE_SIZE
+from . import DEL_FLUSH_DELAY, _handshake, codec, pickle
+from .proxy import (CallQuery, DelQuery, DownloadQuery, GetattrQuery, MethodCallQuery, ProxyObject, RunQuery,
+                    VersionQuery, _dump_function)
+
+
+logger = logging.getLogger('creepy')
+
+
+async def _read_response(reader):
+    """Read an HTTP response and return its status code, body and whether the connection can be reused."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('Connection closed by the server')
+    http_version, status = status_line.split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    keep_alive = http_version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while await reader.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return int(status), body, keep_alive
+
+
+class _HTTPClient:
+    """
+    Minimal asyncio HTTP/1.1 client which sends POST requests over up to `pool_size` kept-alive connections.
+    """
+
+    def __init__(self, url, pool_size=DEFAULT_POOLSIZE):
+        parts = urllib.parse.urlsplit(url)
+        self._url = url
+        self._ssl = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port or (443 if self._ssl else 80)
+        self._netloc = parts.netloc
+        self._path = parts.path.rstrip('/')
+        self._idle = []
+        self._semaphore = asyncio.Semaphore(pool_size)
+
+    async def post(self, endpoint, data=None, timeout=None):
+        async with self._semaphore:
+            return await asyncio.wait_for(self._post(endpoint, data or b''), timeout)
+
+    async def _post(self, endpoint, data):
+        # `data` is bytes or a list of bytes-like chunks which are written one by one.
+        chunks = data if isinstance(data, list) else [data]
+        size = sum(memoryview(chunk).nbytes for chunk in chunks)
+        head = (f'POST {self._path}{endpoint or "/"} HTTP/1.1\r\nHost: {self._netloc}\r\n'
+                f'Content-Type: application/octet-stream\r\nContent-Length: {size}\r\n\r\n').encode('latin-1')
+        while True:
+            reused = len(self._idle) > 0
+            if reused:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self._host, self._port, ssl=self._ssl or None)
+            try:
+                writer.write(head)
+                for chunk in chunks:
+                    writer.write(chunk)
+                await writer.drain()
+                status, body, keep_alive = await _read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # The server may close an idle connection. Resending is safe: a processed request would be
+                # rejected because of its nonce.
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            break
+        if keep_alive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        if status == 200:
+            return body
+        raise RuntimeError(f'{self._url}{endpoint}: {body}')
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+class AsyncProxyObject:
+    """
+    Proxy of a remote object whose operations are awaitable.
+
+    `await proxy.name` gets an attribute, `await proxy.name(*args)` calls a method in one query, `await proxy(*args)`
+    calls the object itself and `await proxy._get()` gets the object behind the proxy.
+    """
+
+    # The same slots make the pickler send proxies as ids of the remote objects.
+    __slots__ = ProxyObject.__slots__
+
+    def __init__(self, remote, id):
+        self._remote = remote
+        self._id = id
+
+    def __del__(self):
+        id = self._id
+        if id > 0:
+            self._remote._lazy_delete(id)
+
+    def __getattr__(self, name):
+        return _AsyncAttribute(self, name)
+
+    def __call__(self, *args, **kwargs):
+        return self._remote._query(CallQuery(self._id, args, kwargs))
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self._id} at {self._remote}>'
+
+    def _get(self):
+        """
+        Get the object behind a proxy.
+        """
+        return self._remote._get(self)
+
+
+class _AsyncAttribute:
+    __slots__ = ('_obj', '_name')
+
+    def __init__(self, obj, name):
+        self._obj = obj
+        self._name = name
+
+    def __await__(self):
+        obj = self._obj
+        return obj._remote._query(GetattrQuery(obj._id, self._name)).__await__()
+
+    def __call__(self, *args, **kwargs):
+        obj = self._obj
+        return obj._remote._call_method(obj, self._name, args, kwargs)
+
+
+class AsyncRemote:
+    """
+    Asyncio counterpart of `Remote`.
+
+    Queries run concurrently, up to `pool_size` per remote. Servers older than version 8 reject a nonce which is
+    not greater than the previous one, so queries to them are sent one at a time.
+    """
+
+    def __init__(self, url, session_id, cipher, http, *, request_timeout=None, inline_limit=0):
+        self._url = url
+        self._session_id = session_id
+        self._cipher = cipher
+        self._http = http
+        self._nonce = 0
+        self._version = 0
+        self._imports = {}
+        self._functions = set()
+        self._del_queue = []
+        self._inline_limit = inline_limit
+        self._request_timeout = request_timeout
+        self._lock = asyncio.Lock()
+        self._last_request = time.monotonic()
+
+    def __repr__(self):
+        return self._url
+
+    async def disconnect(self):
+        if self._url is None:
+            return
+        self._del_queue.append(0)
+        try:
+            await self._post()
+        finally:
+            self._url = None
+            self._session_id = None
+            self._cipher = None
+            self._nonce = None
+            self._imports = None
+            await self._http.close()
+
+    @property
+    def globals(self):
+        return AsyncProxyObject(self, 0)
+
+    async def import_module(self, name):
+        module = self._imports.get(name, None)
+        if module is None:
+            self._imports[name] = module = await self.globals.__import__(name)
+        return module
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run function `fn` on the server in one query and return its result, see `Remote.run`.
+        """
+        if self._version < 4:
+            raise RuntimeError(f'{self._url}: server version {self._version} does not support running functions')
+        key, data = _dump_function(fn)
+        if key in self._functions:
+            data = None
+        res = await self._query(RunQuery(key, data, args, kwargs))
+        self._functions.add(key)
+        return res
+
+    async def _call_method(self, obj, name, args, kwargs):
+        if self._version < 3:
+            method = await self._query(GetattrQuery(obj._id, name))
+            return await method(*args, **kwargs)
+        return await self._query(MethodCallQuery(obj._id, name, args, kwargs))
+
+    async def _query(self, query):
+        query.inline = self._inline_limit
+        result = await self._post(query)
+        if result.__class__ == int:
+            # Old version
+            return AsyncProxyObject(self, result)
+        if len(result) == 1:
+            return result[0]
+        return AsyncProxyObject(self, result[0])
+
+    async def _post(self, *query):
+        query = list(query)
+        self._last_request = time.monotonic()
+        if len(self._del_queue) > 0:
+            query.append(DelQuery(self._del_queue))
+            self._del_queue = []
+        oob = self._version >= 10
+        async with self._lock if self._version < 8 else nullcontext():
+            nonce = self._nonce.to_bytes(NONCE_SIZE, 'big')
+            self._nonce += 1
+            data, buffers = self._dump_query(query)
+            if oob:
+                # The whole response is read at once anyway, so chunked framing wouldn't bound the memory.
+                chunks = [self._session_id, *framing.seal(self._cipher, nonce + data, buffers, version=1)[1]]
+                response = await self._http.post('/?oob=1', chunks, timeout=self._request_timeout)
+            else:
+                response = await self._http.post('', self._session_id + self._cipher.encrypt(nonce + data),
+                                                 timeout=self._request_timeout)
+        if oob:
+            message, buffers = framing.unseal(self._cipher, response, version=1)
+            res = pickle.loads(message, buffers=buffers)
+        else:
+            res = pickle.loads(self._cipher.decrypt(response))
+        if isinstance(res, Exception):
+            self._functions.clear()
+            raise res
+        return res
+
+    def _dump_query(self, query):
+        if self._version >= 11:
+            buffers = []
+            return codec.dumps(query, buffers), buffers
+        if self._version >= 10:
+            return pickle.dumps_oob(*query)
+        return pickle.dumps(*query), None
+
+    def _lazy_delete(self, id):
+        self._del_queue.append(id)
+
+    async def _get(self, *objs):
+        ids = []
+        for obj in objs:
+            assert obj._remote == self
+            ids.append(obj._id)
+        res = await self._post(DownloadQuery(ids=ids))
+        return res[0] if len(res) == 1 else res
+
+
+@asynccontextmanager
+async def connect_async(url, private_key=None, *, request_timeout=None, inline_limit=0, pool_size=DEFAULT_POOLSIZE):
+    """
+    Connect to a creepy server from an event loop, see `connect`.
+
+    The handshake runs in a thread, so signing with the private key doesn't block the loop. Resumption tickets are
+    shared with `connect`.
+
+    Unlike `connect`, failed requests aren't retried, requests and responses aren't compressed and they aren't sent
+    in chunked frames, so a whole response is held in memory.
+    """
+    if not re.search(r'^(\w+)://', url):
+        url = 'http://' + url
+    http = _HTTPClient(url, pool_size)
+    loop = asyncio.get_running_loop()
+
+    def public_channel(endpoint, data=None):
+        return asyncio.run_coroutine_threadsafe(http.post(endpoint, data, timeout=10), loop).result()
+
+    try:
+        handshake = await asyncio.to_thread(_handshake, url, private_key, public_channel)
+        if handshake is None:
+            raise RuntimeError('Private key is not found')
+        session_id, cipher, info = handshake
+        remote = AsyncRemote(url, session_id, cipher, http, request_timeout=request_timeout,
+                             inline_limit=inline_limit)
+        remote._version = info.get('version')
+        if remote._version is None:
+            try:
+                remote._version = await remote._post(VersionQuery())
+            except Exception:
+                remote._version = 0
+    except BaseException:
+        await http.close()
+        raise
+    lease = info.get('lease')
+    flusher = asyncio.create_task(_flush_in_background(remote, lease and lease / 3))
+    try:
+        yield remote
+    finally:
+        flusher.cancel()
+        await remote.disconnect()
+
+
+async def _flush_in_background(remote, heartbeat_interval):
+    """
+    Send deleted ids and, if the remote is idle, a heartbeat which renews the session lease, see `Remote`.
+    """
+    while True:
+        await asyncio.sleep(DEL_FLUSH_DELAY)
+        idle = time.monotonic() - remote._last_request
+        if len(remote._del_queue) > 0 or heartbeat_interval is not None and idle >= heartbeat_interval:
+            try:
+                await remote._post()
+            except Exception as e:
+                logger.debug(f'{remote._url}: background flush failed: {e!r}')
@@ -0,0 +1,250 @@
+"""
+Compact encoding of queries.
+
+A query is encoded as its opcode, varint ids and flags and attribute names which are interned per message. Only
+arguments are pickled, queries without an opcode are pickled whole. Opcodes are less than 0x80, so an encoded message
+can be told apart from a pickled one, which starts with PROTO opcode 0x80.
+"""
+import sys
+
+from . import pickle
+from .proxy import BatchQuery, CallQuery, DelQuery, DownloadQuery, GetattrQuery, MethodCallQuery
+
+
+_PICKLED, _GETATTR, _CALL, _METHOD_CALL, _DEL, _DOWNLOAD, _BATCH = range(7)
+
+
+def is_encoded(data) -> bool:
+    return len(data) > 0 and data[0] < 0x80
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+class _Encoder:
+    def __init__(self, buffers):
+        self.data = bytearray()
+        self.names = {}
+        self.buffers = buffers
+
+    def uint(self, value):
+        data = self.data
+        while value >= 0x80:
+            data.append(value & 0x7f | 0x80)
+            value >>= 7
+        data.append(value)
+
+    def int(self, value):
+        self.uint(_zigzag(value))
+
+    def optional_int(self, value):
+        self.uint(0 if value is None else _zigzag(value) + 1)
+
+    def ids(self, ids):
+        self.uint(len(ids))
+        for id in ids:
+            self.int(id)
+
+    def bytes(self, value):
+        self.uint(len(value))
+        self.data += value
+
+    def name(self, name):
+        index = self.names.get(name)
+        if index is None:
+            self.names[name] = len(self.names)
+            self.uint(0)
+            self.bytes(name.encode())
+        else:
+            self.uint(index + 1)
+
+    def pickled(self, obj):
+        self.bytes(pickle.dumps_oob(obj, buffers=self.buffers)[0])
+
+    def args(self, args, kwargs):
+        if len(args) == 0 and len(kwargs) == 0:
+            self.uint(0)
+        else:
+            self.pickled((args, kwargs))
+
+
+class _Decoder:
+    def __init__(self, data, scope, buffers):
+        self.data = data
+        self.pos = 0
+        self.names = []
+        self.scope = scope
+        self.buffers = buffers
+
+    def uint(self):
+        data = self.data
+        pos = self.pos
+        byte = data[pos]
+        pos += 1
+        value = byte & 0x7f
+        shift = 7
+        while byte >= 0x80:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+        self.pos = pos
+        return value
+
+    def int(self):
+        value = self.uint()
+        return -((value + 1) >> 1) if value & 1 else value >> 1
+
+    def optional_int(self):
+        value = self.uint()
+        if value == 0:
+            return None
+        value -= 1
+        return -((value + 1) >> 1) if value & 1 else value >> 1
+
+    def ids(self):
+        return [self.int() for _ in range(self.uint())]
+
+    def bytes(self):
+        size = self.uint()
+        start = self.pos
+        self.pos += size
+        if self.pos > len(self.data):
+            raise ValueError('Encoded query is truncated')
+        return self.data[start:self.pos]
+
+    def name(self):
+        index = self.uint()
+        if index > 0:
+            return self.names[index - 1]
+        name = sys.intern(self.bytes().decode())
+        self.names.append(name)
+        return name
+
+    def pickled(self):
+        return pickle.loads(self.bytes(), self.scope, self.buffers)
+
+    def args(self):
+        if self.data[self.pos] == 0:
+            self.pos += 1
+            return [], {}
+        return self.pickled()
+
+
+def _encode_getattr(enc, query):
+    enc.int(query.id)
+    enc.name(query.name)
+    enc.optional_int(query.out)
+    enc.uint(query.inline)
+
+
+def _encode_call(enc, query):
+    enc.int(query.id)
+    enc.optional_int(query.out)
+    enc.uint(query.inline)
+    enc.args(query.args, query.kwargs)
+
+
+def _encode_method_call(enc, query):
+    enc.int(query.id)
+    enc.name(query.name)
+    enc.optional_int(query.out)
+    enc.uint(query.inline)
+    enc.uint(query.download)
+    enc.args(query.args, query.kwargs)
+
+
+def _encode_del(enc, query):
+    enc.ids(query.ids)
+
+
+def _encode_download(enc, query):
+    enc.ids(query.ids)
+
+
+def _encode_batch(enc, query):
+    enc.bytes(query.data)
+
+
+_encoders = {
+    GetattrQuery: (_GETATTR, _encode_getattr),
+    CallQuery: (_CALL, _encode_call),
+    MethodCallQuery: (_METHOD_CALL, _encode_method_call),
+    DelQuery: (_DEL, _encode_del),
+    DownloadQuery: (_DOWNLOAD, _encode_download),
+    BatchQuery: (_BATCH, _encode_batch),
+}
+
+
+def _decode_getattr(dec):
+    return GetattrQuery(dec.int(), dec.name(), dec.optional_int(), dec.uint())
+
+
+def _decode_call(dec):
+    id, out, inline = dec.int(), dec.optional_int(), dec.uint()
+    args, kwargs = dec.args()
+    return CallQuery(id, args, kwargs, out, inline)
+
+
+def _decode_method_call(dec):
+    id, name, out, inline, download = dec.int(), dec.name(), dec.optional_int(), dec.uint(), dec.uint()
+    args, kwargs = dec.args()
+    return MethodCallQuery(id, name, args, kwargs, out, inline, bool(download))
+
+
+def _decode_del(dec):
+    return DelQuery(dec.ids())
+
+
+def _decode_download(dec):
+    return DownloadQuery(ids=dec.ids())
+
+
+def _decode_batch(dec):
+    return BatchQuery(dec.bytes(), dec.buffers)
+
+
+# Decoders indexed by opcode.
+_decoders = [
+    _Decoder.pickled,
+    _decode_getattr,
+    _decode_call,
+    _decode_method_call,
+    _decode_del,
+    _decode_download,
+    _decode_batch,
+]
+
+
+def dumps(queries, buffers) -> bytes:
+    """
+    Encode `queries`, their large buffers are appended to `buffers` to be passed out-of-band.
+
+    A batch consumes its buffers when it runs, so the buffers of queries encoded into a `BatchQuery` must precede the
+    buffers of the queries which are decoded before it runs.
+    """
+    enc = _Encoder(buffers)
+    for query in queries:
+        opcode, encode = _encoders.get(query.__class__, (_PICKLED, None))
+        if opcode == _DOWNLOAD and query.id is not None:
+            opcode, encode = _PICKLED, None
+        enc.data.append(opcode)
+        if encode is None:
+            enc.pickled(query)
+        else:
+            encode(enc, query)
+    return bytes(enc.data)
+
+
+def loads(data, scope=None, buffers=None):
+    """
+    Decode queries from `data` one at a time, so arguments may refer to results of the queries which already ran.
+
+    `buffers` is an iterator over out-of-band buffers.
+    """
+    dec = _Decoder(data, scope, buffers)
+    while dec.pos < len(data):
+        opcode = data[dec.pos]
+        dec.pos += 1
+        yield _decoders[opcode](dec)
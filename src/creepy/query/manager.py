@@ -0,0 +1,134 @@
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from . import Remote, VersionQuery, _connect, _normalize_url, _self_node
+
+
+logger = logging.getLogger('creepy')
+
+
+@dataclass
+class _Entry:
+    remote: Optional[Remote] = None
+    users: int = 0
+    last_used: float = 0.0
+    # Held while the remote is connected or checked, so it's done once for all threads wanting the remote.
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class ConnectionManager:
+    """
+    Keep connected remotes to reuse them, one per server url and connection options.
+
+    A remote which hasn't been used for `health_check_interval` seconds is checked with a request before it's reused
+    and replaced if the check fails. Remotes which haven't been used for `idle_timeout` seconds are disconnected.
+    Urls are normalized, e.g. 'host:8000' and 'http://host:8000/' share a remote.
+    """
+
+    def __init__(self, idle_timeout=300, health_check_interval=30):
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connect(self, url, private_key=None, **kwargs):
+        """
+        Get a connected remote, see `creepy.connect` for the parameters.
+
+        The remote isn't disconnected on exit and may be shared by several threads.
+        """
+        if url == 'self':
+            yield _self_node
+            return
+        entry = self._acquire(url, private_key, kwargs)
+        try:
+            yield entry.remote
+        finally:
+            self._release(entry)
+
+    def close(self):
+        """
+        Disconnect all remotes which are not in use.
+        """
+        with self._lock:
+            expired = self._expire(float('inf'))
+        _disconnect_all(expired)
+
+    def _acquire(self, url, private_key, kwargs):
+        url = _normalize_url(url)
+        key = url, tuple(sorted(kwargs.items()))
+        with self._lock:
+            now = time.monotonic()
+            expired = self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = entry = _Entry()
+            # Users keep the entry from expiring.
+            entry.users += 1
+            stale = entry.users == 1 and now - entry.last_used > self.health_check_interval
+        _disconnect_all(expired)
+        # Requests are made outside of the lock of the manager, so they don't hold up remotes of other servers.
+        try:
+            with entry.lock:
+                if entry.remote is not None and stale and not _is_alive(entry.remote):
+                    _disconnect(entry.remote)
+                    entry.remote = None
+                if entry.remote is None:
+                    remote = _connect(url, private_key, **kwargs)
+                    if remote is None:
+                        raise RuntimeError(f'{url}: failed to connect')
+                    entry.remote = remote
+        except BaseException:
+            self._release(entry)
+            raise
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+
+    def _expire(self, now):
+        """
+        Forget remotes which are idle for `idle_timeout` seconds and entries which failed to connect, and return the
+        remotes to disconnect.
+        """
+        expired = []
+        for key, entry in list(self._entries.items()):
+            if entry.users == 0 and (entry.remote is None or now - entry.last_used > self.idle_timeout):
+                del self._entries[key]
+                if entry.remote is not None:
+                    expired.append(entry.remote)
+        return expired
+
+
+def _is_alive(remote):
+    try:
+        remote._post(VersionQuery())
+        return True
+    except Exception as e:
+        logger.debug(f'{remote}: health check failed: {e}')
+        return False
+
+
+def _disconnect_all(remotes):
+    for remote in remotes:
+        _disconnect(remote)
+
+
+def _disconnect(remote):
+    url = remote._url
+    try:
+        remote.disconnect()
+    except Exception as e:
+        logger.debug(f'{url}: failed to disconnect: {e}')
+
+
+connections = ConnectionManager()
+atexit.register(connections.close)
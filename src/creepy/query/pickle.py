@@ -1,39 +1,126 @@
 import io
 import pickle
 
-from ..protocol.constants import PICKLE_PROTOCOL
+from ..protocol.constants import OOB_MIN_SIZE, OOB_PICKLE_PROTOCOL, PICKLE_PROTOCOL
 from .proxy import ProxyObject
 
 
+_PROXY_SLOTS = ProxyObject.__slots__
+
+
 class _Pickler(pickle.Pickler):
     def persistent_id(self, obj):
-        try:
-            if obj.__slots__ is ProxyObject.__slots__:
-                return obj._id
-        except Exception:
-            pass
+        # Proxies of all kinds share the slots.
+        if getattr(obj.__class__, '__slots__', None) is _PROXY_SLOTS:
+            return obj._id
+
+
+# Tag of persistent ids of bytes and bytearrays passed out-of-band, protocol 5 pickles them only in-band.
+_OOB_TAG = 'b'
+
+
+class _OOBPickler(_Pickler):
+    def __init__(self, f, buffers):
+        super().__init__(f, OOB_PICKLE_PROTOCOL, buffer_callback=self._buffer_callback)
+        self._buffers = buffers
+        self._oob_ids = {}
+
+    def persistent_id(self, obj):
+        if obj.__class__ in (bytes, bytearray) and len(obj) >= OOB_MIN_SIZE:
+            # Persistent ids aren't memoized, so the same object is passed once.
+            index = self._oob_ids.get(id(obj))
+            if index is None:
+                self._oob_ids[id(obj)] = index = len(self._buffers)
+                self._buffers.append(memoryview(obj))
+            return _OOB_TAG, index
+        return super().persistent_id(obj)
+
+    def _buffer_callback(self, buffer):
+        view = buffer.raw()
+        if view.nbytes < OOB_MIN_SIZE:
+            return True
+        self._buffers.append(view)
 
 
 class _Unpickler(pickle.Unpickler):
-    def __init__(self, scope, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, scope, f, buffers=None):
+        super().__init__(f, buffers=buffers)
         self.scope = scope
+        self._buffers = buffers
+        self._oob_objects = {}
 
     def persistent_load(self, pid):
+        if pid.__class__ is tuple and pid[0] == _OOB_TAG:
+            obj = self._oob_objects.get(pid[1])
+            if obj is None:
+                self._oob_objects[pid[1]] = obj = next(self._buffers)
+            return obj
         return self.scope.get(pid)
 
 
-def load(f, scope=None):
-    return _Unpickler(scope, f).load()
+def load(f, scope=None, buffers=None):
+    """
+    Unpickle an object from file `f`, `buffers` is an iterator over out-of-band buffers.
+    """
+    return _Unpickler(scope, f, buffers).load()
 
 
-def dumps(*objs):
-    f = io.BytesIO()
+def _dump(pickler, f, objs):
     for obj in objs:
-        _Pickler(f, PICKLE_PROTOCOL).dump(obj)
+        pickler.dump(obj)
+        # Each object is unpickled separately, so it mustn't refer to the preceding ones.
+        pickler.clear_memo()
     return f.getvalue()
 
 
-def loads(data, scope=None):
+def dumps(*objs):
+    f = io.BytesIO()
+    return _dump(_Pickler(f, PICKLE_PROTOCOL), f, objs)
+
+
+def dumps_oob(*objs, buffers=None):
+    """
+    Pickle `objs` with protocol 5 and return the pickled data and the list of out-of-band buffers.
+
+    Bytes, bytearrays and buffers smaller than `OOB_MIN_SIZE` are pickled in-band. Out-of-band buffers are appended
+    to `buffers` if it's passed.
+    """
+    f = io.BytesIO()
+    if buffers is None:
+        buffers = []
+    pickler = _OOBPickler(f, buffers)
+    try:
+        return _dump(pickler, f, objs), buffers
+    finally:
+        # The pickler refers to itself by its buffer callback, the cycle mustn't keep views of the objects alive,
+        # they keep bytearrays from being resized.
+        pickler._buffers = None
+
+
+class _KeyPickler(pickle.Pickler):
+    def __init__(self, f, proxies):
+        super().__init__(f, PICKLE_PROTOCOL)
+        self._proxies = proxies
+
+    def persistent_id(self, obj):
+        if getattr(obj.__class__, '__slots__', None) is _PROXY_SLOTS:
+            self._proxies.append(obj)
+            return len(self._proxies) - 1
+
+
+def dumps_key(obj):
+    """
+    Pickle `obj` into a hashable key, proxies in it are keyed by their remotes and ids.
+
+    Return the key and the list of the proxies, they must be kept alive while the key is used, so that their ids
+    aren't reused.
+    """
+    f = io.BytesIO()
+    proxies = []
+    _KeyPickler(f, proxies).dump(obj)
+    return (f.getvalue(), *((proxy._remote, proxy._id) for proxy in proxies)), proxies
+
+
+def loads(data, scope=None, buffers=None):
     f = io.BytesIO(data)
-    return load(f, scope)
+    return load(f, scope, iter(buffers) if buffers is not None else None)
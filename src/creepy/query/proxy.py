@@ -1,13 +1,50 @@
+import io
+import dis
+import sys
+import pickle
+import types
+import hashlib
+import marshal
+import builtins
 import functools
-from typing import List, Optional
+import importlib
+from typing import Iterator, List, Optional
 from types import TracebackType
 from dataclasses import dataclass
 
+from ..protocol.constants import PICKLE_PROTOCOL, OOB_PICKLE_PROTOCOL, VOID_ID
+
 
 @dataclass
 class VersionQuery:
     def __call__(self, scope):
-        return 1
+        return 17
+
+
+@dataclass
+class BatchQuery:
+    """
+    Run pickled queries in order and return the result of the last one.
+
+    Queries are unpickled one at a time, so their arguments may refer to results of preceding queries. `data` may be
+    encoded by `codec.dumps` as well, then `buffers` is the iterator over out-of-band buffers of the message.
+    """
+    data: bytes
+    buffers: Optional[Iterator] = None
+
+    def __call__(self, scope):
+        from . import codec
+        from .pickle import load
+        if codec.is_encoded(self.data):
+            result = None
+            for query in codec.loads(self.data, scope, self.buffers):
+                result = query(scope)
+            return result
+        f = io.BytesIO(self.data)
+        result = None
+        while f.tell() < len(self.data):
+            result = load(f, scope)(scope)
+        return result
 
 
 @dataclass
@@ -19,6 +56,113 @@ class DownloadQuery:
         return tuple(map(scope.get, self.ids))
 
 
+@dataclass
+class StreamQuery:
+    """
+    Get the data of object `id`, which must be contiguous bytes-like, or the object pickled if `pickled` is set.
+
+    Large data is sent out-of-band, so the client may consume it in chunks as they arrive.
+    """
+    id: int
+    pickled: bool = False
+
+    def __call__(self, scope):
+        x = scope.get(self.id)
+        if self.pickled:
+            x = pickle.dumps(x, OOB_PICKLE_PROTOCOL)
+        return pickle.PickleBuffer(x)
+
+
+@dataclass
+class SyncQuery:
+    """
+    Get object `id` sending only what has changed since the client got `version` of it.
+
+    Lists and bytearrays which were only appended to since then are sent as the appended items, dicts as changed and
+    removed keys, other objects and other changes are sent whole. List items and dict values are compared by value
+    if they are immutable primitives and by the hash of their pickle otherwise, so changes made to them in place are
+    detected too.
+    """
+    id: int
+    version: int = 0
+
+    def __call__(self, scope):
+        x = scope.get(self.id)
+        scope.remeasure(self.id)
+        version, previous = scope.synced.get(self.id, (0, None))
+        snapshot, delta = _diff(x, previous if version == self.version else None)
+        version += 1
+        scope.keep_snapshot(self.id, version, snapshot)
+        return version, delta is not None, delta if delta is not None else x
+
+
+_IMMUTABLE_TYPES = frozenset([type(None), bool, int, float, complex, str, bytes])
+
+
+class _Digest(bytes):
+    """Hash of the pickle of a mutable value in a snapshot."""
+
+
+def _fingerprint(value):
+    """Get what tells whether `value` has changed: the value itself if it's immutable or else its digest."""
+    if value.__class__ in _IMMUTABLE_TYPES:
+        return value
+    return _Digest(hashlib.blake2b(pickle.dumps(value, PICKLE_PROTOCOL), digest_size=16).digest())
+
+
+def _same(a, b):
+    return a is b or a.__class__ is b.__class__ and a == b
+
+
+def _diff(x, previous):
+    """
+    Make a snapshot of `x` and get the delta of `x` since its `previous` snapshot.
+
+    Return the snapshot or None if `x` is always sent whole, and the delta or None if `x` must be sent whole.
+    """
+    cls = x.__class__
+    if cls is list or cls is dict:
+        try:
+            if cls is list:
+                snapshot = [_fingerprint(item) for item in x]
+            else:
+                snapshot = {key: _fingerprint(value) for key, value in x.items()}
+        except Exception:  # e.g. unpicklable items
+            return None, None
+        if previous.__class__ is not cls:
+            return snapshot, None
+        return snapshot, _list_delta(x, snapshot, previous) if cls is list else _dict_delta(x, snapshot, previous)
+    if cls is bytearray:
+        return _bytearray_diff(x, previous)
+    return None, None
+
+
+def _list_delta(x, snapshot, previous):
+    size = len(previous)
+    if len(snapshot) >= size and all(map(_same, previous, snapshot)):
+        return x[size:]
+    return None
+
+
+def _dict_delta(x, snapshot, previous):
+    changed = {key: x[key] for key, value in snapshot.items() if not _same(previous.get(key, _MISSING), value)}
+    removed = [key for key in previous if key not in snapshot]
+    return changed, removed
+
+
+def _bytearray_diff(x, previous):
+    """A bytearray is snapshotted as its size and hash, it's hashed in one pass whether it's appended to or not."""
+    size, digest = previous if previous.__class__ is tuple and previous[0] <= len(x) else (0, None)
+    view = memoryview(x)
+    hasher = hashlib.blake2b(view[:size], digest_size=16)
+    delta = x[size:] if hasher.digest() == digest else None
+    hasher.update(view[size:])
+    return (len(x), hasher.digest()), delta
+
+
+_MISSING = object()
+
+
 @dataclass
 class DelQuery:
     ids: List[int]
@@ -32,11 +176,68 @@ class DelQuery:
 class GetattrQuery:
     id: int
     name: str
+    out: Optional[int] = None
+    inline: int = 0
 
     def __call__(self, scope):
         x = scope.get(self.id)
         y = getattr(x, self.name)
-        return _with_flags(y, scope.put(y))
+        return _put(scope, y, self.out, self.inline)
+
+
+@dataclass
+class GetattrsQuery:
+    """
+    Get several attributes of an object in one query.
+    """
+    id: int
+    names: List[str]
+    inline: int = 0
+
+    def __call__(self, scope):
+        x = scope.get(self.id)
+        values = [getattr(x, name) for name in self.names]
+        return [_put(scope, y, None, self.inline) for y in values]
+
+
+@dataclass
+class NextQuery:
+    """
+    Get up to `count` next items of an iterator in one query.
+
+    If `out` is set, the iterator of object `id` is made and stored at `out` first. Items are returned pickled if
+    `download` is set, stopping once they take `max_bytes`, otherwise as proxies. The second element of the result
+    is `None` if there may be more items, or the exception which stopped the iteration, e.g. `StopIteration`.
+    """
+    id: int
+    count: int
+    max_bytes: Optional[int] = None
+    download: bool = False
+    inline: int = 0
+    out: Optional[int] = None
+
+    def __call__(self, scope):
+        from .pickle import dumps
+        it = scope.get(self.id)
+        if self.out is not None:
+            it = iter(it)
+            scope.put(it, self.out)
+        items = []
+        size = 0
+        while len(items) < self.count and (self.max_bytes is None or size < self.max_bytes):
+            try:
+                item = next(it)
+            except Exception as e:
+                if len(items) == 0 and not isinstance(e, StopIteration):
+                    raise
+                return items, e
+            if self.download:
+                item = dumps(item)
+                size += len(item)
+                items.append(item)
+            else:
+                items.append(_put(scope, item, None, self.inline))
+        return items, None
 
 
 @dataclass
@@ -65,6 +266,8 @@ class CallQuery:
     id: int
     args: list
     kwargs: dict
+    out: Optional[int] = None
+    inline: int = 0
 
     def __post_init__(self):
         args = list(self.args)
@@ -76,36 +279,165 @@ class CallQuery:
     def __call__(self, scope):
         f = scope.get(self.id)
         r = f(*self.args, **self.kwargs)
-        return _with_flags(r, scope.put(r))
+        return _put(scope, r, self.out, self.inline)
+
+
+@dataclass
+class MethodCallQuery:
+    """
+    Call method `name` of an object in one query, without storing the bound method in the scope.
+
+    Special methods are called the way Python operators and builtins call them, so that fallbacks (e.g. `bool()`
+    falling back to `__len__`) and reflected operands work even if the client doesn't know the class of the object.
+    If `download` is set the result is returned by value.
+    """
+    id: int
+    name: str
+    args: list
+    kwargs: dict
+    out: Optional[int] = None
+    inline: int = 0
+    download: bool = False
+
+    def __call__(self, scope):
+        x = scope.get(self.id)
+        special_method = _special_methods.get(self.name)
+        if special_method is not None:
+            r = special_method(x, *self.args, **self.kwargs)
+        else:
+            r = getattr(x, self.name)(*self.args, **self.kwargs)
+        # Methods change objects in place, e.g. `list.append()`.
+        scope.remeasure(self.id)
+        if self.download:
+            return r
+        return _put(scope, r, self.out, self.inline)
+
+
+@dataclass
+class RunQuery:
+    """
+    Run a function shipped by the client.
+
+    The function is cached in the scope by `key`, so `data` is sent only the first time.
+    """
+    key: bytes
+    data: Optional[bytes]
+    args: list
+    kwargs: dict
+    out: Optional[int] = None
+    inline: int = 0
+
+    def __call__(self, scope):
+        fn = scope.functions.get(self.key)
+        if fn is None:
+            if self.data is None:
+                raise KeyError('Function is not cached')
+            fn = _load_function(self.key, self.data, scope)
+            scope.put_function(self.key, fn, len(self.data))
+        r = fn(*self.args, **self.kwargs)
+        return _put(scope, r, self.out, self.inline)
+
+
+def _global_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _dump_function(fn):
+    """Serialize `fn` to be run by `RunQuery` and return its key and data."""
+    from . import pickle
+    if not isinstance(fn, types.FunctionType):
+        raise TypeError(f"Can't ship {fn!r}: only Python functions are supported")
+    if fn.__closure__:
+        raise ValueError(f"Can't ship {fn.__qualname__!r}: closures aren't supported")
+    code = fn.__code__
+    modules = {}
+    for name in sorted(_global_names(code)):
+        value = fn.__globals__.get(name)
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+    data = pickle.dumps(sys.implementation.cache_tag, marshal.dumps(code), modules, fn.__defaults__,
+                        fn.__kwdefaults__)
+    return hashlib.sha256(data).digest(), data
+
+
+def _load_function(key, data, scope):
+    from . import pickle
+    if hashlib.sha256(data).digest() != key:
+        raise ValueError('Function data does not match its key')
+    f = io.BytesIO(data)
+    cache_tag, code, modules, defaults, kwdefaults = (pickle.load(f, scope) for _ in range(5))
+    if cache_tag != sys.implementation.cache_tag:
+        raise RuntimeError(f'Function is compiled by {cache_tag!r}, but the server is {sys.implementation.cache_tag!r}')
+    code = marshal.loads(code)
+    fn_globals = {'__builtins__': builtins, '__name__': '__creepy__'}
+    for name, module_name in modules.items():
+        fn_globals[name] = importlib.import_module(module_name)
+    fn = types.FunctionType(code, fn_globals, code.co_name, defaults)
+    fn.__kwdefaults__ = kwdefaults
+    return fn
+
+
+def _call_method(self, name, args, kwargs, download=False):
+    remote = self._remote
+    if remote._version < 3:
+        result = self.__getattr__(name)(*args, **kwargs)
+        return result._get() if download else result
+    query = MethodCallQuery(self._id, name, args, kwargs, download=download)
+    if download:
+        return remote._post(query)
+    return _make_child(self, query)
 
 
 def _catch_magic_call(name):
     def handler(self, *args, **kwargs):
-        return self.__getattr__(name)(*args, **kwargs)
+        return _call_method(self, name, args, kwargs)
     return handler
 
 
 def _catch_magic_call_nd_download(name):
     if name == '__exit__':
         def handler(self, exc_type, exc_value, exc_tb):
-            return self.__getattr__(name)(exc_type, exc_value, None)._get()
+            return _call_method(self, name, (exc_type, exc_value, None), {}, download=True)
         return handler
 
     def handler(self, *args, **kwargs):
-        return self.__getattr__(name)(*args, **kwargs)._get()
+        return _call_method(self, name, args, kwargs, download=True)
     return handler
 
 
 def _make_child(self, query):
-    remote = self._remote
-    result = remote._post(query)
+    return _make_result(self._remote, query)
+
+
+def _make_result(remote, query):
+    if remote._void or remote._pipeline:
+        return ProxyObject(remote, remote._defer(query))
+    query.inline = remote._inline_limit
+    return _make_value(remote, remote._post(query))
+
+
+def _make_value(remote, result):
+    """Make a proxy or a value from the result returned by `_put`."""
     if result.__class__ == int:
         # Old version
         child_id = result
         return ProxyObject(remote, child_id)
+    if len(result) == 1:
+        return result[0]
     return ProxyObject(remote, *result)
 
 
+def _post_or_enqueue(remote, query):
+    if remote._void:
+        remote._enqueue(query)
+    else:
+        remote._post(query)
+
+
 def _proxy__call__(self, *args, **kwargs):
     return _make_child(self, CallQuery(self._id, args, kwargs))
 
@@ -130,6 +462,8 @@ def _memorize(f):
 @_memorize
 def _make_proxy_class_namespace(flags):
     namespace = {}
+    if flags != -1 and flags & _CACHEABLE_FLAG:
+        namespace['_cacheable'] = True
     for name, fn in _magics.items():
         if flags & 1:
             namespace[name] = fn[0]
@@ -155,16 +489,52 @@ def proxy_flags(cls):
         v = _magics.get(name)
         if v is not None:
             flags |= v[1]
+    if _is_cacheable(cls):
+        flags |= _CACHEABLE_FLAG
     return flags
 
 
+def _is_cacheable(cls):
+    """Check whether attributes of instances of `cls` are not expected to change, e.g. of modules and classes."""
+    if issubclass(cls, (types.ModuleType, type)):
+        return True
+    params = getattr(cls, '__dataclass_params__', None)
+    return params is not None and params.frozen
+
+
 def _with_flags(value, id):
     cls = value.__class__
     return id, proxy_flags(cls), cls.__name__
 
 
+def _inlinable(value, limit):
+    """Check whether `value` is an immutable primitive which takes no more than `limit` bytes."""
+    cls = value.__class__
+    if cls is str or cls is bytes:
+        return len(value) <= limit
+    if cls is int:
+        return value.bit_length() <= 8 * limit
+    return cls is bool or cls is float or cls is complex or value is None
+
+
+def _put(scope, value, out, inline=0):
+    """
+    Store `value` in `scope` and return proxy info unless the client has already assigned its id `out`.
+
+    If `inline` is positive, small immutable primitives are returned by value in a 1-tuple instead of being stored.
+    If `out` is `VOID_ID`, the value is discarded.
+    """
+    if out is None:
+        if inline > 0 and _inlinable(value, inline):
+            return (value,)
+        return _with_flags(value, scope.put(value))
+    if out != VOID_ID:
+        scope.put(value, out)
+
+
 class ProxyObject:
     __slots__ = ('_remote', '_id')
+    _cacheable = False
 
     def __new__(cls, remote, id, flags=-1, class_name=None):
         proxy_cls = _make_proxy_class(flags, class_name)
@@ -179,13 +549,22 @@ class ProxyObject:
             self._remote._lazy_delete(id)
 
     def __getattr__(self, name):
+        if self._cacheable:
+            return self._remote._cached_getattr(self, name)
+        remote = self._remote
+        if remote._version >= 3 and not remote._pipeline and not remote._void and _calls_method(sys._getframe(1)):
+            return _Method(self, name)
         return _make_child(self, GetattrQuery(self._id, name))
 
     def __setattr__(self, name, value):
-        self._remote._post(SetattrQuery(self._id, name, value))
+        if self._cacheable:
+            self._remote.clear_attr_cache(self)
+        _post_or_enqueue(self._remote, SetattrQuery(self._id, name, value))
 
     def __delattr__(self, name):
-        self._remote._post(DelattrQuery(self._id, name))
+        if self._cacheable:
+            self._remote.clear_attr_cache(self)
+        _post_or_enqueue(self._remote, DelattrQuery(self._id, name))
 
     def _get(self):
         """
@@ -220,8 +599,13 @@ def _magics():
         else:
             namespace[name] = fn
 
+    # Python requires these to return primitives, so there is no point in making proxies of their results.
+    download_magics = {'__contains__', '__dir__', '__format__', '__hash__', '__len__', '__sizeof__'}
     for name in magics:
-        add_to_namespace(name, _catch_magic_call(name))
+        if name in download_magics:
+            add_to_namespace(name, _catch_magic_call_nd_download(name))
+        else:
+            add_to_namespace(name, _catch_magic_call(name))
     for name in return_primitive_magics:
         add_to_namespace(name, _catch_magic_call_nd_download(name))
     bit = 1
@@ -229,3 +613,65 @@ def _magics():
         namespace[name] = (fn, bit)
         bit <<= 1
     return namespace
+
+
+# The bit after the magics' ones marks objects whose attributes can be cached by the client.
+_CACHEABLE_FLAG = 1 << len(_magics)
+
+
+# Opcodes which load a method to call it right away, the one of `LOAD_ATTR` only if the low bit of its argument is set.
+_LOAD_METHOD = dis.opmap.get('LOAD_METHOD') if sys.version_info < (3, 12) else None
+_LOAD_ATTR = dis.opmap['LOAD_ATTR'] if sys.version_info >= (3, 12) else None
+
+
+def _calls_method(frame):
+    """Check whether `frame` is looking an attribute up to call it right away, as in `obj.method(x)`."""
+    code = frame.f_code.co_code
+    lasti = frame.f_lasti
+    if lasti < 0 or lasti + 1 >= len(code):
+        return False
+    op = code[lasti]
+    return op == _LOAD_METHOD or op == _LOAD_ATTR and code[lasti + 1] & 1 == 1
+
+
+class _Method:
+    """
+    Method of a remote object which is called right after it's looked up, so the call is a single `MethodCallQuery`.
+    """
+    __slots__ = ('_obj', '_name')
+
+    def __init__(self, obj, name):
+        self._obj = obj
+        self._name = name
+
+    def __call__(self, *args, **kwargs):
+        return _call_method(self._obj, self._name, args, kwargs)
+
+
+@_replace_with_result
+def _special_methods():
+    import math
+    import operator
+    res = {
+        '__abs__': abs, '__bool__': bool, '__ceil__': math.ceil, '__complex__': complex,
+        '__contains__': operator.contains, '__delitem__': operator.delitem, '__dir__': dir, '__divmod__': divmod,
+        '__float__': float, '__floor__': math.floor, '__format__': format, '__getitem__': operator.getitem,
+        '__hash__': hash, '__index__': operator.index, '__int__': int, '__invert__': operator.invert, '__iter__': iter,
+        '__len__': len, '__neg__': operator.neg, '__next__': next, '__pos__': operator.pos, '__repr__': repr,
+        '__reversed__': reversed, '__round__': round, '__setitem__': operator.setitem, '__str__': str,
+        '__trunc__': math.trunc,
+        '__rdivmod__': lambda x, y: divmod(y, x),
+    }
+    binary_operators = [
+        'add', 'and_', 'eq', 'floordiv', 'ge', 'gt', 'le', 'lshift', 'lt', 'mod', 'mul', 'ne', 'or_', 'pow',
+        'rshift', 'sub', 'truediv', 'xor'
+    ]
+    reflected = {'add', 'and_', 'floordiv', 'lshift', 'mod', 'mul', 'or_', 'pow', 'rshift', 'sub', 'truediv', 'xor'}
+    for op_name in binary_operators:
+        name = op_name.rstrip('_')
+        op = getattr(operator, op_name)
+        res[f'__{name}__'] = op
+        if op_name in reflected:
+            res[f'__r{name}__'] = lambda x, y, op=op: op(y, x)
+            res[f'__i{name}__'] = getattr(operator, f'i{name}')
+    return res
@@ -0,0 +1,117 @@
+"""
+Instrumentation of requests of a remote.
+
+Each proxy operation which needs a result is a round trip to the server, the counters tell how many requests of each
+kind a remote makes and where their time goes, and the detector points at lines of code which make requests in a loop.
+"""
+import os
+import sys
+import time
+import warnings
+import threading
+from dataclasses import dataclass
+
+
+# A call site which makes this many requests of the same shape, each within `CHATTY_GAP` seconds of the previous one,
+# is reported by `RoundTripWarning`.
+CHATTY_COUNT = 100
+CHATTY_GAP = 1.0
+# Maximum number of call sites and shapes the detector keeps counters of.
+MAX_SITES = 4096
+
+_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+
+
+@dataclass
+class QueryStats:
+    """
+    Counters of requests of one kind.
+
+    Bytes are counted as sent and received, i.e. encrypted and compressed. Times are in seconds: `serialization` is
+    pickling of the request and unpickling of the response, `encryption` includes compression and `network` is the
+    rest of the time of the request, including the time the server takes.
+    """
+    requests: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    serialization: float = 0.0
+    encryption: float = 0.0
+    network: float = 0.0
+
+    def add(self, other):
+        self.requests += other.requests
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.serialization += other.serialization
+        self.encryption += other.encryption
+        self.network += other.network
+
+    def timed_chunks(self, chunks):
+        """Yield `chunks` of a sealed message counting their bytes and the time they take to make as encryption."""
+        it = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            chunk = next(it, None)
+            self.encryption += time.perf_counter() - start
+            if chunk is None:
+                return
+            self.bytes_sent += memoryview(chunk).nbytes
+            yield chunk
+
+
+class RoundTripWarning(UserWarning):
+    """
+    A line of code makes many requests of the same shape in a row, e.g. proxy operations in a loop.
+    """
+
+
+class RoundTripDetector:
+    """
+    Warn about call sites which make many requests of the same shape in a row.
+
+    The call site is the innermost frame outside of creepy. Such requests are usually better batched with
+    `creepy.iterate`, `creepy.prefetch`, `Remote.run` or pipelining.
+    """
+
+    def __init__(self, count=CHATTY_COUNT, gap=CHATTY_GAP):
+        self.count = count
+        self.gap = gap
+        # The number of requests in a row and the time of the last one by call site and shape, the least recent first.
+        self._sites = {}
+        # Call sites which are already reported.
+        self._reported = set()
+        self._lock = threading.Lock()
+
+    def observe(self, shape):
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_filename.startswith(_PACKAGE_DIR):
+            frame = frame.f_back
+        if frame is None:
+            return
+        site = frame.f_code.co_filename, frame.f_lineno
+        key = site, shape
+        now = time.monotonic()
+        with self._lock:
+            if site in self._reported:
+                return
+            count, last = self._sites.pop(key, (0, now))
+            count = count + 1 if now - last <= self.gap else 1
+            self._sites[key] = count, now
+            self._prune(now)
+            if count < self.count:
+                return
+            self._reported.add(site)
+            self._sites.pop(key)
+        kind, name = shape
+        what = f'{kind} {name!r}' if name is not None else kind
+        warnings.warn_explicit(f'{count} {what} requests in a row from this line, batch them to save round trips',
+                               RoundTripWarning, frame.f_code.co_filename, frame.f_lineno)
+
+    def _prune(self, now):
+        """Forget the least recent counters which are older than `gap` or don't fit into `MAX_SITES`."""
+        sites = self._sites
+        while len(sites) > 0:
+            key = next(iter(sites))
+            if now - sites[key][1] <= self.gap and len(sites) <= MAX_SITES:
+                return
+            del sites[key]
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from .. import aio
+from ..aio import _read_response, connect_async
+
+
+def _read(data):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await _read_response(reader)
+    return asyncio.run(read())
+
+
+def test_read_response_with_content_length():
+    response = b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello'
+    assert _read(response) == (200, b'hello', True)
+
+
+def test_read_chunked_response():
+    response = b'HTTP/1.1 400 Bad Request\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n' \
+        b'3\r\nhel\r\n2;x=y\r\nlo\r\n0\r\n\r\n'
+    assert _read(response) == (400, b'hello', False)
+
+
+def _connect(server, **kwargs):
+    return connect_async(server.url, server.private_key, **kwargs)
+
+
+def _join(*paths):
+    return '/'.join(paths)
+
+
+def test_queries(server):
+    async def main():
+        async with _connect(server) as remote:
+            os = await remote.import_module('os')
+            assert await remote.import_module('os') is os
+            sep = await os.sep
+            assert await sep._get() == '/'
+            path = await os.path
+            assert await (await path.join('a', 'b'))._get() == 'a/b'
+            basename = await path.basename
+            assert await remote._get(await basename('a/b'), sep) == ('b', '/')
+            assert await (await remote.run(_join, 'c', 'd'))._get() == 'c/d'
+            with pytest.raises(AttributeError):
+                await os.nonexistent
+        async with _connect(server, inline_limit=8) as remote:
+            os = await remote.import_module('os')
+            assert await os.sep == '/'
+            assert await remote.run(_join, 'e', 'f') == 'e/f'
+    asyncio.run(main())
+
+
+def test_resend_on_reused_connection(server):
+    async def main():
+        async with _connect(server, inline_limit=8) as remote:
+            os = await remote.import_module('os')
+            # The connection is dropped while it's idle, e.g. by the keep-alive timeout of the server.
+            (_, writer), = remote._http._idle
+            writer.close()
+            await writer.wait_closed()
+            assert await os.sep == '/'
+            assert len(remote._http._idle) == 1
+    asyncio.run(main())
+
+
+def test_flusher_sends_deleted_ids(server, monkeypatch):
+    monkeypatch.setattr(aio, 'DEL_FLUSH_DELAY', 0.05)
+
+    async def main():
+        async with _connect(server) as remote:
+            scope = server.app.sessions[remote._session_id].scope
+            items = await (await remote.import_module('builtins')).list()
+            n = len(scope)
+            del items
+            assert remote._del_queue != []
+            await asyncio.sleep(0.2)
+            assert remote._del_queue == []
+            assert len(scope) == n - 1
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+from creepy.protocol import Scope
+from creepy.protocol.constants import CLIENT_ID_BASE, OOB_MIN_SIZE, VOID_ID
+from .. import codec
+from ..proxy import (BatchQuery, CallQuery, DelQuery, DownloadQuery, GetattrQuery, MethodCallQuery, NextQuery,
+                     ProxyObject)
+
+
+class _Remote:
+    def _lazy_delete(self, id):
+        pass
+
+
+def test_queries_round_trip():
+    queries = [
+        GetattrQuery(0, 'join', out=CLIENT_ID_BASE, inline=64),
+        CallQuery(CLIENT_ID_BASE, (['x', bytes(OOB_MIN_SIZE)],), {'sep': '/'}, out=VOID_ID),
+        MethodCallQuery(7, 'join', [], {}, download=True),
+        GetattrQuery(2**40, 'join'),
+        NextQuery(3, 10, download=True),
+        DownloadQuery(ids=[-1, 0, 2**33]),
+        DownloadQuery(id=5),
+        DelQuery([1, 2]),
+    ]
+    buffers = []
+    data = codec.dumps(queries, buffers)
+    assert codec.is_encoded(data) and len(buffers) == 1
+    assert list(codec.loads(data, buffers=iter(buffers))) == queries
+
+
+def test_batch_arguments_are_resolved_after_preceding_queries():
+    scope = Scope()
+    scope.put(type('Module', (), {'sep': '/', 'len': len}))
+    a, b = CLIENT_ID_BASE, CLIENT_ID_BASE + 1
+    proxy = ProxyObject(_Remote(), a)
+    buffers = []
+    batch = BatchQuery(codec.dumps([
+        GetattrQuery(0, 'sep', out=a),
+        GetattrQuery(0, 'len', out=b),
+        CallQuery(b, (proxy,), {}, inline=64),
+    ], buffers))
+    query, = codec.loads(codec.dumps([batch], buffers), buffers=iter(buffers))
+    assert query(scope) == (1,)
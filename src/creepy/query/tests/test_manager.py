@@ -0,0 +1,43 @@
+import time
+
+from creepy.query.manager import ConnectionManager
+
+
+def test_remote_is_reused(server):
+    manager = ConnectionManager()
+    try:
+        with manager.connect(server.url, server.private_key) as remote:
+            pass
+        with manager.connect(f'http://{server.url}/', server.private_key) as same_remote:
+            assert same_remote is remote
+        with manager.connect(server.url, server.private_key, pipeline=True) as other_remote:
+            assert other_remote is not remote
+    finally:
+        manager.close()
+    assert remote._url is None and other_remote._url is None
+
+
+def test_dead_remote_is_replaced(server):
+    manager = ConnectionManager(health_check_interval=0)
+    try:
+        with manager.connect(server.url, server.private_key) as remote:
+            # The session is gone, e.g. it has expired or the server has restarted.
+            del server.app.sessions[remote._session_id]
+        time.sleep(0.01)
+        with manager.connect(server.url, server.private_key) as new_remote:
+            assert new_remote is not remote
+            assert new_remote.import_module('os').sep._get() == '/'
+    finally:
+        manager.close()
+
+
+def test_idle_remote_is_disconnected(server):
+    manager = ConnectionManager(idle_timeout=0)
+    try:
+        with manager.connect(server.url, server.private_key) as remote:
+            pass
+        time.sleep(0.01)
+        with manager.connect(server.url, server.private_key) as new_remote:
+            assert new_remote is not remote and remote._url is None
+    finally:
+        manager.close()
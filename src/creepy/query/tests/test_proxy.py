@@ -0,0 +1,249 @@
+import os
+
+import pytest
+
+from creepy.protocol import Scope
+from creepy.protocol.constants import CLIENT_ID_BASE, OOB_MIN_SIZE, VOID_ID
+from .. import _apply_delta, _Memoized, pickle
+from ..proxy import (BatchQuery, CallQuery, DelQuery, DownloadQuery, GetattrQuery, GetattrsQuery, MethodCallQuery,
+                     NextQuery, ProxyObject, RunQuery, SyncQuery, _dump_function, proxy_flags)
+
+
+class _Remote:
+    def __init__(self):
+        self.deleted = []
+
+    def _lazy_delete(self, id):
+        self.deleted.append(id)
+
+
+def _make_scope(**variables):
+    scope = Scope()
+    scope.put(type('Module', (), variables))
+    return scope
+
+
+def test_pipelined_queries():
+    scope = _make_scope(sep='/', join='/'.join)
+    a, b = CLIENT_ID_BASE, CLIENT_ID_BASE + 1
+    query = BatchQuery(pickle.dumps(
+        GetattrQuery(0, 'join', out=a),
+        CallQuery(a, (['x', 'y'],), {}, out=b),
+        DownloadQuery(ids=[b]),
+    ))
+    assert query(scope) == ('x/y',)
+    DelQuery([a, b])(scope)
+    assert scope.get(a) is None and scope.get(b) is None
+
+
+def test_pipelined_argument_is_resolved_after_preceding_queries():
+    scope = _make_scope(sep='/', len=len)
+    a, b = CLIENT_ID_BASE, CLIENT_ID_BASE + 1
+    query = BatchQuery(pickle.dumps(
+        GetattrQuery(0, 'sep', out=a),
+        GetattrQuery(0, 'len', out=b),
+        CallQuery(b, (ProxyObject(_Remote(), a),), {}),
+    ))
+    id, _, class_name = query(scope)
+    assert class_name == 'int' and scope.get(id) == 1
+
+
+def test_server_assigned_ids_are_reused():
+    scope = _make_scope(sep='/')
+    id, flags, class_name = GetattrQuery(0, 'sep')(scope)
+    assert class_name == 'str'
+    assert scope.get(id) == '/'
+    DelQuery([id])(scope)
+    assert GetattrQuery(0, 'sep')(scope)[0] == id
+
+
+def test_deleting_unassigned_client_id():
+    scope = _make_scope()
+    DelQuery([CLIENT_ID_BASE])(scope)
+
+
+def test_method_call_doesnt_store_bound_method():
+    scope = _make_scope(items=[3, 1, 2])
+    items_id = GetattrQuery(0, 'items')(scope)[0]
+    MethodCallQuery(items_id, 'sort', (), {})(scope)
+    assert MethodCallQuery(items_id, '__getitem__', (0,), {}, download=True)(scope) == 1
+    assert len(scope._vars) == 3  # module, list and None returned by sort()
+
+
+def test_special_method_fallbacks():
+    scope = _make_scope(sep='/', items=[])
+    sep_id = GetattrQuery(0, 'sep')(scope)[0]
+    items_id = GetattrQuery(0, 'items')(scope)[0]
+    assert MethodCallQuery(sep_id, '__bool__', (), {}, download=True)(scope) is True
+    assert MethodCallQuery(items_id, '__bool__', (), {}, download=True)(scope) is False
+    assert MethodCallQuery(sep_id, '__radd__', ('a',), {}, download=True)(scope) == 'a/'
+
+
+def test_small_primitives_are_inlined():
+    scope = _make_scope(sep='/', items=[], n=2**63, name='x' * 100)
+    assert GetattrQuery(0, 'sep', inline=8)(scope) == ('/',)
+    assert GetattrQuery(0, 'n', inline=8)(scope) == (2**63,)
+    assert len(GetattrQuery(0, 'n', inline=4)(scope)) == 3
+    assert len(GetattrQuery(0, 'name', inline=8)(scope)) == 3
+    assert len(GetattrQuery(0, 'items', inline=8)(scope)) == 3
+    assert len(GetattrQuery(0, 'sep')(scope)) == 3
+
+
+def _join(*paths, sep=None):
+    return os.path.join(*paths) if sep is None else sep.join(paths)
+
+
+def test_run_function():
+    scope = _make_scope(sep='/')
+    sep = ProxyObject(_Remote(), GetattrQuery(0, 'sep')(scope)[0])
+    key, data = _dump_function(_join)
+    assert RunQuery(key, data, ('a', 'b'), {}, inline=8)(scope) == ('a/b',)
+    query = pickle.loads(pickle.dumps(RunQuery(key, None, ('c', 'd'), {'sep': sep}, inline=8)), scope)
+    assert query(scope) == ('c/d',)
+    with pytest.raises(KeyError):
+        RunQuery(key, None, ('a', 'b'), {})(_make_scope())
+
+
+def test_closures_are_not_shipped():
+    sep = '/'
+    with pytest.raises(ValueError):
+        _dump_function(lambda *paths: sep.join(paths))
+
+
+def test_void_call():
+    scope = _make_scope(items=[])
+    items_id = GetattrQuery(0, 'items')(scope)[0]
+    n = len(scope._vars)
+    assert MethodCallQuery(items_id, 'append', (1,), {}, out=VOID_ID)(scope) is None
+    assert len(scope._vars) == n
+    assert scope.get(items_id) == [1]
+
+
+def test_getattrs_query():
+    scope = _make_scope(sep='/', join='/'.join)
+    (sep,), (id, flags, class_name) = GetattrsQuery(0, ['sep', 'join'], inline=8)(scope)
+    assert sep == '/' and class_name == 'builtin_function_or_method' and scope.get(id)(['x', 'y']) == 'x/y'
+    with pytest.raises(AttributeError):
+        GetattrsQuery(0, ['sep', 'missing'])(scope)
+    assert GetattrQuery(0, 'sep')(scope)[0] == id + 1
+
+
+def test_cacheable_proxies():
+    remote = _Remote()
+    assert ProxyObject(remote, 1, proxy_flags(type(os)))._cacheable
+    assert ProxyObject(remote, 2, proxy_flags(type))._cacheable
+    assert not ProxyObject(remote, 3, proxy_flags(list))._cacheable
+    assert not ProxyObject(remote, 4)._cacheable
+
+
+def test_next_query():
+    scope = _make_scope(items=[1, 'x', None])
+    items = GetattrQuery(0, 'items')(scope)[0]
+    it = CLIENT_ID_BASE
+    batch, stop = NextQuery(items, 2, download=True, out=it)(scope)
+    assert [pickle.loads(item) for item in batch] == [1, 'x'] and stop is None
+    batch, stop = NextQuery(it, 2, inline=8)(scope)
+    assert batch == [(None,)] and isinstance(stop, StopIteration)
+
+
+def test_next_query_returns_items_preceding_error():
+    def gen():
+        yield 1
+        raise KeyError('k')
+    scope = _make_scope(gen=gen)
+    gen_id = CallQuery(GetattrQuery(0, 'gen')(scope)[0], (), {})(scope)[0]
+    batch, stop = NextQuery(gen_id, 10, download=True)(scope)
+    assert len(batch) == 1 and isinstance(stop, KeyError)
+    with pytest.raises(KeyError):
+        gen_id = CallQuery(GetattrQuery(0, 'gen')(scope)[0], (), {})(scope)[0]
+        NextQuery(gen_id, 10, max_bytes=1, download=True)(scope)
+        NextQuery(gen_id, 10, download=True)(scope)
+
+
+def test_out_of_band_buffers():
+    scope = _make_scope(len=len)
+    data, buffer = bytes(OOB_MIN_SIZE), bytearray(OOB_MIN_SIZE)
+    pickled, buffers = pickle.dumps_oob(CallQuery(0, (data, buffer, buffer, b'x'), {}))
+    assert len(pickled) < OOB_MIN_SIZE and [view.obj for view in buffers] == [data, buffer]
+    query = pickle.loads(pickled, scope, buffers=[data, buffer])
+    assert query.args[0] is data and query.args[1] is query.args[2] is buffer
+    del buffers, query
+    buffer.append(0)  # views of the buffer are released
+
+
+def _sync(scope, id, synced):
+    version, value = synced.get(id, (0, None))
+    version, is_delta, data = pickle.loads(pickle.dumps(SyncQuery(id, version)(scope)))
+    synced[id] = version, _apply_delta(value, data) if is_delta else data
+    return is_delta, data
+
+
+def test_sync_query():
+    results, rows, log = {'a': 1, 'b': 2}, [1, 2], bytearray(b'xy')
+    scope = _make_scope()
+    ids = [scope.put(value) for value in (results, rows, log, (1, 2))]
+    synced = {}
+    assert [_sync(scope, id, synced)[0] for id in ids] == [False] * 4
+    results['a'] = 3
+    del results['b']
+    rows.append(3)
+    log += b'z'
+    assert [_sync(scope, id, synced) for id in ids] == \
+        [(True, ({'a': 3}, ['b'])), (True, [3]), (True, b'z'), (False, (1, 2))]
+    rows[0] = 0
+    log[0] = 0
+    assert [_sync(scope, id, synced)[0] for id in ids[:3]] == [True, False, False]
+    synced[ids[1]] = 0, None
+    assert not _sync(scope, ids[1], synced)[0]
+    assert [synced[id][1] for id in ids] == [results, rows, log, (1, 2)]
+    scope.pop(ids[0])
+    assert ids[0] not in scope.synced
+
+
+def test_sync_query_detects_changes_in_place():
+    results, rows = {'a': [1], 'b': 'x'}, [[1], 2]
+    scope = _make_scope()
+    ids = [scope.put(results), scope.put(rows)]
+    synced = {}
+    for id in ids:
+        _sync(scope, id, synced)
+    results['a'].append(99)
+    rows[0].append(99)
+    rows.append(3)
+    assert [_sync(scope, id, synced) for id in ids] == [(True, ({'a': [1, 99]}, [])), (False, [[1, 99], 2, 3])]
+    assert [synced[id][1] for id in ids] == [results, rows]
+
+
+def test_sync_snapshots_count_towards_quota():
+    scope = Scope(max_bytes=2**16)
+    id = scope.put(list(range(100)))
+    size = scope.size
+    SyncQuery(id)(scope)
+    assert scope.size > size and id in scope.synced
+    scope.pop(id)
+    assert scope.size == 0
+    id = scope.put(list(range(100)))
+    scope.max_bytes = scope.size
+    # The snapshot doesn't fit, so the object is sent whole.
+    assert SyncQuery(id)(scope)[1:] == (False, list(range(100)))
+    assert id not in scope.synced
+
+
+def test_memoize():
+    calls = []
+
+    def fn(*args, **kwargs):
+        calls.append(args)
+        return len(calls)
+
+    remote = _Remote()
+    a, b = ProxyObject(remote, 1), ProxyObject(remote, 2)
+    memoized = _Memoized(fn, maxsize=2, ttl=None)
+    assert [memoized(a), memoized(a), memoized(b), memoized(x=1, y=2), memoized(y=2, x=1)] == [1, 1, 2, 3, 3]
+    assert memoized(a) == 4  # evicted
+    memoized.invalidate(y=2, x=1)
+    assert memoized(x=1, y=2) == 5 and memoized(lambda: None) == 6 and len(memoized) == 2
+    assert (memoized.hits, memoized.misses) == (2, 6)
+    memoized.clear()
+    expiring = _Memoized(fn, maxsize=None, ttl=0)
+    assert expiring(a) != expiring(a) and len(memoized) == 0
@@ -0,0 +1,229 @@
+import time
+import threading
+import collections
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+import creepy
+from creepy import query
+from creepy.protocol import HandshakeProtocol, QuotaExceededError
+
+
+def test_import_module_in_pipeline(server):
+    with creepy.connect(server.url, server.private_key, pipeline=True) as remote:
+        remote.globals.nonexistent.attribute
+        with pytest.raises(AttributeError):
+            remote.import_module('os')
+        assert creepy.unproxy(remote.import_module('os').sep) == '/'
+
+
+def test_method_call_is_one_request(server):
+    with creepy.connect(server.url, server.private_key) as remote:
+        items = remote.import_module('collections').deque([1, 2])
+        remote.reset_stats()
+        items.append(3)
+        assert {kind: stats.requests for kind, stats in remote.stats.items()} == {'MethodCallQuery': 1}
+        # Other uses of an attribute look it up right away.
+        append = items.append
+        assert remote.stats['GetattrQuery'].requests == 1
+        append(4)
+        assert creepy.unproxy(items) == collections.deque([1, 2, 3, 4])
+        assert creepy.unproxy(getattr(items, 'maxlen')) is None
+        assert not hasattr(items, 'nonexistent')
+        assert getattr(items, 'nonexistent', 5) == 5
+        with pytest.raises(AttributeError):
+            items.nonexistent
+        with pytest.raises(AttributeError):
+            items.nonexistent()
+
+
+@pytest.mark.parametrize('error, fallback', [('Unsupported version', True), ("I don't know you", False)])
+def test_handshake_fallback(monkeypatch, error, fallback):
+    versions = []
+
+    def hi_alice(private_key, public_channel, version=1):
+        versions.append(version)
+        if version == 1:
+            raise RuntimeError(f"http://host: b'{error}'")
+        return b'\0\0\0\1', 'AES256GCM', b'', {}
+
+    monkeypatch.setattr(HandshakeProtocol, 'hi_alice', hi_alice)
+    monkeypatch.setattr(query, '_v0_servers', set())
+    if fallback:
+        query._hi_alice('http://host', None, None)
+    else:
+        with pytest.raises(RuntimeError):
+            query._hi_alice('http://host', None, None)
+    assert versions == [1, 0] if fallback else [1]
+    assert ('http://host' in query._v0_servers) == fallback
+
+
+def test_timed_out_request_is_not_retried(server):
+    with creepy.connect(server.url, server.private_key, request_timeout=0.2) as remote:
+        sleep = remote.import_module('time').sleep
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            sleep(1)
+        assert time.monotonic() - start < 1
+        assert remote.stats['CallQuery'].requests == 1
+        # Let the server finish the query before the remote disconnects.
+        time.sleep(1)
+
+
+def test_iterate_reads_ahead(server):
+    with creepy.connect(server.url, server.private_key) as remote:
+        builtins = remote.import_module('builtins')
+        assert list(creepy.iterate(builtins.range(10), batch_size=3)) == list(range(10))
+        it = builtins.iter(builtins.range(10))
+        items = creepy.iterate(it, batch_size=2, download=False)
+        assert creepy.unproxy(next(items)) == 0
+        # The second batch is requested while the first one is consumed.
+        time.sleep(0.2)
+        assert creepy.unproxy(builtins.next(it)) == 4
+        items.close()
+
+
+def test_void_calls(server, tmp_path):
+    path = str(tmp_path / 'void.txt')
+    with creepy.connect(server.url, server.private_key) as remote:
+        scope = server.app.sessions[remote._session_id].scope
+        with remote.void():
+            with remote.open(path, 'w') as f:
+                remote.flush()
+                n = len(scope)
+                remote.reset_stats()
+                for line in ['a', 'b', 'c']:
+                    f.write(line)
+                assert remote.stats == {}
+                remote.flush()
+                # The writes are sent in one request and their results aren't stored.
+                assert remote.stats['BatchQuery'].requests == 1
+                assert len(scope) == n
+            items = remote.import_module('collections').deque()
+            items.append(1)
+            # Operations which need a value send the queued calls and return it.
+            assert len(items) == 1 and creepy.unproxy(items[0]) == 1
+    with open(path) as f:
+        assert f.read() == 'abc'
+
+
+def test_deletes_wait_for_queued_queries(server, monkeypatch):
+    with creepy.connect(server.url, server.private_key) as remote:
+        posts = []
+        monkeypatch.setattr(remote, '_post', lambda deletes=True: posts.append(deletes))
+        remote._del_queue, remote._deleted_at = [1], time.monotonic() - query.DEL_FLUSH_DELAY
+        # The id is used by a queued query.
+        remote._queued_ids[1] = 1
+        remote._flush_in_background(None)
+        assert posts == []
+        # A heartbeat of an idle remote is sent anyway, without the deletes.
+        remote._last_request = time.monotonic() - 2
+        remote._flush_in_background(1)
+        assert posts == [False]
+        del remote._queued_ids[1]
+        remote._flush_in_background(None)
+        assert posts == [False, True]
+        remote._del_queue = []
+        monkeypatch.undo()
+
+
+def test_heartbeat_renews_lease(server, monkeypatch):
+    monkeypatch.setattr(server.app, 'session_lease', 1.0)
+    monkeypatch.setattr(query, 'DEL_FLUSH_DELAY', 0.05)
+    with creepy.connect(server.url, server.private_key) as remote:
+        time.sleep(1.5)
+        server.app.expire_sessions()
+        assert remote._session_id in server.app.sessions
+        assert remote.stats['Heartbeat'].requests >= 3
+        sep = remote.import_module('os').sep
+        assert creepy.unproxy(sep) == '/'
+
+
+def test_method_call_over_quota(server):
+    with creepy.connect(server.url, server.private_key) as remote:
+        scope = server.app.sessions[remote._session_id].scope
+        items = remote.import_module('builtins').list()
+        remote.flush()
+        scope.max_bytes = scope.size + 4000
+        with pytest.raises(QuotaExceededError):
+            items.extend(list(range(2000)))
+        # The grown object is kept, so the scope stays over its quota until it's deleted.
+        assert creepy.unproxy(len(items)) == 2000
+        del items
+        remote.flush()
+        scope.max_bytes = None
+
+
+def _append(items, item):
+    items.append(item)
+    return len(items)
+
+
+def test_run_is_queued(server):
+    with creepy.connect(server.url, server.private_key, pipeline=True) as remote:
+        items = remote.import_module('collections').deque()
+        size = remote.run(_append, items, 1)
+        assert creepy.unproxy(size) == 1
+    with creepy.connect(server.url, server.private_key) as remote:
+        items = remote.import_module('collections').deque()
+        with remote.void():
+            remote.run(_append, items, 1)
+            remote.run(_append, items, 2)
+        assert creepy.unproxy(items) == collections.deque([1, 2])
+
+
+def test_deletes_wait_for_queries_of_other_threads(server):
+    with creepy.connect(server.url, server.private_key) as remote:
+        items = remote.import_module('collections').deque()
+
+        def append():
+            with remote.void():
+                items.append(1)
+
+        # Leaving `void()` sends the queued calls.
+        thread = threading.Thread(target=append)
+        thread.start()
+        thread.join()
+        assert len(remote._local.queue) == 0 and len(remote._queued_ids) == 0
+        assert creepy.unproxy(items) == collections.deque([1])
+        remote.pipeline = True
+        copied, used = threading.Event(), threading.Event()
+
+        def copy():
+            first = items.copy()
+            second = first.copy()
+            del first
+            copied.set()
+            used.wait()
+            assert creepy.unproxy(second) == collections.deque([1])
+
+        thread = threading.Thread(target=copy)
+        thread.start()
+        copied.wait()
+        # The ids of the first copy and of the bound methods are used by queries queued by the other thread, so their
+        # deletions wait.
+        remote._post()
+        held = list(remote._del_queue)
+        assert len(held) > 0 and all(id in remote._queued_ids for id in held)
+        used.set()
+        thread.join()
+        assert not set(held) & set(remote._del_queue)
+
+
+def test_stale_ticket(server):
+    url = query._normalize_url(server.url)
+    with creepy.connect(server.url, server.private_key):
+        pass
+    ticket, cipher = query._tickets[url]
+    # E.g. a ticket of the server before a restart.
+    query._tickets[url] = bytes(len(ticket)), cipher
+    start = time.monotonic()
+    with creepy.connect(server.url, server.private_key):
+        pass
+    assert time.monotonic() - start < 1
+    assert query._tickets[url][0] != bytes(len(ticket))
+    query._tickets[url] = bytes(len(ticket)), cipher
+    with pytest.raises(Exception):
+        creepy.connect(server.url, ed25519.Ed25519PrivateKey.generate()).__enter__()
+    assert url not in query._tickets
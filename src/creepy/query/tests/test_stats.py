@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from .. import stats
+from ..stats import QueryStats, RoundTripDetector, RoundTripWarning
+
+
+@pytest.fixture
+def outside_package(monkeypatch):
+    # Tests are in the package, its frames aren't call sites.
+    monkeypatch.setattr(stats, '_PACKAGE_DIR', os.path.join(stats._PACKAGE_DIR, 'none', ''))
+
+
+def test_repeated_requests_are_reported_once_per_line(outside_package):
+    detector = RoundTripDetector(count=3)
+    with pytest.warns(RoundTripWarning) as caught:
+        for i in range(10):
+            detector.observe(('GetattrQuery', 'x'))
+            detector.observe(('CallQuery', None))
+    assert len(caught) == 2 and caught[0].filename == __file__ and caught[0].lineno + 1 == caught[1].lineno
+
+
+def test_requests_with_gaps_are_not_reported(outside_package, recwarn):
+    detector = RoundTripDetector(count=3, gap=-1)
+    for i in range(10):
+        detector.observe(('GetattrQuery', 'x'))
+    assert len(recwarn) == 0
+
+
+def test_counters_are_pruned(outside_package, monkeypatch):
+    monkeypatch.setattr(stats, 'MAX_SITES', 10)
+    detector = RoundTripDetector(count=3)
+    for i in range(100):
+        detector.observe(('GetattrQuery', i))
+    assert len(detector._sites) == 10
+    detector.gap = -1
+    detector.observe(('GetattrQuery', 'x'))
+    assert len(detector._sites) == 0
+
+
+def test_timed_chunks():
+    query_stats = QueryStats()
+    assert list(query_stats.timed_chunks([b'ab', memoryview(b'c')])) == [b'ab', b'c']
+    assert query_stats.bytes_sent == 3 and query_stats.encryption > 0
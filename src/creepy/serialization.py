@@ -64,7 +64,7 @@ def load_private_key(path=None, passphrase: Optional[SecureString] = None, ssh_d
     path = _find_key(path, ssh_dir=ssh_dir)
     if path is None:
         raise RuntimeError('Failed to find private key file')
-    process = Pypen('_detail/private_key', hash='e2904bc7b89e6e8d24c20d389f995e02fa4bf245bfa6df58c03e94da07562c6d')
+    process = Pypen('_detail/private_key', hash='a79919222a75a8e37c3ef0de7688da6b004b8ca2c752c06dd81ea803b3dd7f36')
     process.request('load', str(path), passphrase)
     return ProcessifiedPrivateKey(process)
 
@@ -9,6 +9,7 @@ from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+from creepy.protocol import benchmark
 from creepy.protocol.common import make_cipher
 
 
@@ -64,7 +65,8 @@ def secure_bob(send, recv, /, *, make_cipher=make_cipher):
     alice_hello_msg = json.loads(recv().decode())
     alice_public_key = _deserialize_public_key(alice_hello_msg['publicKey'])
     bob_private_key = ec.generate_private_key(ec.SECP384R1())
-    cipher_name = 'ChaCha20Poly1305'
+    # Both ends run on this host, so the fastest cipher here is the fastest for both.
+    cipher_name = benchmark.ranking()[0]
     bob_hello_msg = {
         'publicKey': _serialize_public_key(bob_private_key.public_key()),
         'cipherName': cipher_name,
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from creepy.agent import KeyAgent, load_agent_key
+from creepy.protocol import asymmetric
+from creepy.protocol.asymmetric import generate_private_key
+
+
+@pytest.fixture
+def agent_path(tmpdir):
+    return str(tmpdir / 'agent.sock')
+
+
+def _serve(path, private_key):
+    server = KeyAgent(path, private_key)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.mark.parametrize('make_key', [generate_private_key, ed25519.Ed25519PrivateKey.generate])
+def test_agent_sign(agent_path, make_key):
+    private_key = make_key()
+    server = _serve(agent_path, private_key)
+    try:
+        key = load_agent_key(agent_path)
+        public_key = key.public_key()
+        message = b'KRKR ALLE XX FOLGENDES IST SOFORT BEKANNTZUGEBEN XX'
+        asymmetric.verify(public_key, asymmetric.sign(key, message), message)
+        if not isinstance(private_key, ed25519.Ed25519PrivateKey):
+            assert asymmetric.decrypt(key, asymmetric.encrypt(public_key, message)) == message
+            with pytest.raises(RuntimeError):
+                asymmetric.decrypt(key, b'garbage')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_no_agent(agent_path, monkeypatch):
+    monkeypatch.delenv('CREEPY_AUTH_SOCK', raising=False)
+    assert load_agent_key() is None
+    assert load_agent_key(agent_path) is None
@@ -0,0 +1,75 @@
+import time
+import asyncio
+import importlib
+
+import pytest
+
+from creepy.protocol import Session
+
+
+# `creepy.app` is the application, the module is shadowed by it.
+app = importlib.import_module('creepy.app')
+
+
+class _Request:
+    def __init__(self, chunks, size=None):
+        self.chunks = chunks
+        self.headers = {'content-length': str(size)} if size is not None else {}
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setattr(app, 'sessions', {b'\0\0\0\1': 'session'})
+
+
+def read(chunks, size=None):
+    return asyncio.run(app.request_session_body(_Request(chunks, size)))
+
+
+def test_session_body(session):
+    chunks = [b'\0\0', b'\0\1he', b'llo']
+    assert read(chunks, 9) == ('session', b'hello')
+    assert read(chunks) == ('session', b'hello')
+
+
+def test_session_body_of_unknown_session(session, monkeypatch):
+    monkeypatch.setattr(app, 'max_request_bytes', 2**20)
+    # Nothing is allocated for the size a request claims before its session is found.
+    assert read([b'\0\0\0\2', b'hello'], 2**20) == (None, None)
+
+
+def test_session_body_limit(session, monkeypatch):
+    monkeypatch.setattr(app, 'max_request_bytes', 4)
+    with pytest.raises(ValueError):
+        read([b'\0\0\0\1hello'], 9)
+    with pytest.raises(ValueError):
+        read([b'\0\0\0\1hel', b'lo'])
+    with pytest.raises(ValueError):
+        read([b'\0\0\0\1hel'], 9)
+
+
+def test_reply_cache_of_server_is_bounded(monkeypatch):
+    old, new = Session(cipher=None, last_seen=0), Session(cipher=None, last_seen=1)
+    monkeypatch.setattr(app, 'sessions', {b'old': old, b'new': new})
+    monkeypatch.setattr(app, 'replies_size', 0)
+    monkeypatch.setattr(app, 'max_reply_cache_bytes', 3)
+    app.remember_reply(old, 0, 'reply', 2)
+    app.remember_reply(new, 0, 'reply', 2)
+    assert app.replies_size == 2 and len(old.replies) == 0 and len(new.replies) == 1
+    app.drop_session(b'new')
+    assert app.replies_size == 0
+
+
+def test_idle_sessions_expire(monkeypatch):
+    idle, active = Session(cipher=None, last_seen=0), Session(cipher=None, last_seen=time.monotonic())
+    monkeypatch.setattr(app, 'sessions', {b'idle': idle, b'active': active})
+    monkeypatch.setattr(app, 'replies_size', 0)
+    monkeypatch.setattr(app, 'session_lease', 10)
+    app.remember_reply(idle, 0, 'reply', 2)
+    app.expire_sessions()
+    assert app.sessions == {b'active': active}
+    assert app.replies_size == 0
@@ -0,0 +1,13 @@
+import creepy
+
+
+def test_copy(server, tmp_path):
+    src_dir = tmp_path / 'src'
+    (src_dir / 'sub').mkdir(parents=True)
+    (src_dir / 'a.bin').write_bytes(bytes(range(256)) * 1000)
+    (src_dir / 'sub' / 'b.txt').write_text('b')
+    with creepy.connect(server.url, server.private_key) as remote:
+        creepy.copy(str(src_dir / 'a.bin'), (remote, str(tmp_path / 'a.bin')))
+        assert (tmp_path / 'a.bin').read_bytes() == (src_dir / 'a.bin').read_bytes()
+        creepy.copy((remote, str(src_dir)), str(tmp_path / 'dst'), archive=False)
+        assert (tmp_path / 'dst' / 'sub' / 'b.txt').read_text() == 'b'